@@ -22,19 +22,20 @@ import nlpnet.taggers
 import nlpnet.utils as utils
 import nlpnet.config as config
 
-def interactive_running(task):
+def interactive_running(task, srl_mode='2steps'):
     """
     This function provides an interactive environment for running the system.
     It receives text from the standard input, tokenizes it, and calls the function
     given as a parameter to produce an answer.
     
     :param task: either 'pos', 'srl' or 'ner'
+    :param srl_mode: either '2steps' or '1step' (SRL only)
     """
     task_lower = task.lower()
     if task_lower == 'pos':
         tagger = nlpnet.taggers.POSTagger()
     elif task_lower == 'srl':
-        tagger = nlpnet.taggers.SRLTagger()
+        tagger = nlpnet.taggers.SRLTagger(mode=srl_mode)
     elif task_lower == 'ner':
         tagger = nlpnet.taggers.NERTagger()
     else:
@@ -54,17 +55,18 @@ def interactive_running(task):
         result = tagger.tag(text)        
         _print_tagged(result, task)
 
-def process_input(task):
+def process_input(task, srl_mode='2steps'):
     """
     This function reads input from stdin and processes sentences.
     
     :param task: either 'pos', 'srl' or 'ner'
+    :param srl_mode: either '2steps' or '1step' (SRL only)
     """
     task_lower = task.lower()
     if task_lower == 'pos':
         tagger = nlpnet.taggers.POSTagger()
     elif task_lower == 'srl':
-        tagger = nlpnet.taggers.SRLTagger()
+        tagger = nlpnet.taggers.SRLTagger(mode=srl_mode)
     elif task_lower == 'ner':
         tagger = nlpnet.taggers.NERTagger()
     else:
@@ -128,6 +130,8 @@ if __name__ == '__main__':
     parser.add_argument('-v', help='Verbose mode', action='store_true', dest='verbose')
     parser.add_argument('--no-repeat', dest='no_repeat', action='store_true',
                         help='Forces the classification step to avoid repeated argument labels (SRL only).')
+    parser.add_argument('--1step', dest='srl_mode', action='store_const', const='1step', default='2steps',
+                        help='Identify and classify arguments with a single network (SRL only).')
     args = parser.parse_args()
     
     logging_level = logging.DEBUG if args.verbose else logging.WARNING
@@ -135,6 +139,6 @@ if __name__ == '__main__':
     logger = logging.getLogger("Logger")
     config.set_data_dir(args.data)
     
-    #interactive_running(args.task)
-    process_input(args.task)
+    #interactive_running(args.task, args.srl_mode)
+    process_input(args.task, args.srl_mode)
 
@@ -22,7 +22,21 @@ from collections import Counter, defaultdict
 import nlpnet.config as config
 import nlpnet.utils as utils
 import nlpnet.taggers as taggers
+import nlpnet.reader as reader
 from nlpnet.metadata import Metadata
+from nlpnet.corpus import CorpusCache
+
+def create_codified_reader(md, gold_file):
+    """
+    Creates a reader with the gold data codified. It is loaded from the cache
+    in the data directory if the gold file was codified before with the same
+    dictionaries and features.
+    """
+    def create(filename):
+        return taggers.create_reader(md, gold_file=filename)
+    
+    cache = CorpusCache(config.FILES['corpus_cache'])
+    return reader.load_or_codify(cache, create, md, gold_file)
 
 def evaluate_pos(gold_file=None, oov=None):
     """
@@ -224,10 +238,7 @@ def evaluate_srl_classify(no_repeat=False, gold_file=None):
     # load data
     md = Metadata.load_from_file('srl_classify')
     nn = taggers.load_network(md)
-    r = taggers.create_reader(md, gold_file)
-    r.create_converter(md)
-    
-    r.codify_sentences()
+    r = create_codified_reader(md, gold_file)
     hits = 0
     total_args = 0
     
@@ -381,15 +392,14 @@ def evaluate_srl_predicates(gold_file):
     """
     md = Metadata.load_from_file('srl_predicates')
     nn = taggers.load_network(md)
-    reader = taggers.create_reader(md, gold_file=gold_file)
-    reader.codify_sentences()
+    srl_reader = create_codified_reader(md, gold_file)
     
     total_tokens = 0
     # true/false positives and negatives
     tp, fp, tn, fn = 0, 0, 0, 0
     
     # for each sentence, tags are 0 at non-predicates and 1 at predicates
-    for sent, tags in izip(reader.sentences, reader.tags):
+    for sent, tags in izip(srl_reader.sentences, srl_reader.tags):
         answer = nn.tag_sentence(sent)
         
         for net_tag, gold_tag in izip(answer, tags):
@@ -29,6 +29,8 @@ import nlpnet.ner as ner
 import nlpnet.arguments as arguments
 import nlpnet.reader as reader
 import nlpnet.attributes as attributes
+from nlpnet.corpus import CorpusCache
+from nlpnet.checkpoint import Checkpointer
 from nlpnet.network import Network, ConvolutionalNetwork, LanguageModel, SentimentModel
 
 
@@ -36,43 +38,51 @@ from nlpnet.network import Network, ConvolutionalNetwork, LanguageModel, Sentime
 ### FUNCTION DEFINITIONS ###
 ############################
 
-def create_reader(args, md):
+def create_reader(args, md, filename):
     """
     Creates and returns a TextReader object according to the task at hand.
+    
+    :param filename: the file with the training data. If None, the reader
+        is created without data, to load an already codified corpus.
     """
     logger.info("Reading text...")
     if args.task == 'pos':
-        text_reader = pos.pos_reader.POSReader(md, filename=args.gold, variant=args.variant)
-        if args.suffix:
+        text_reader = pos.pos_reader.POSReader(md, filename=filename, variant=args.variant)
+        # a codified corpus was created with the existing affix lists
+        if args.suffix and filename is not None:
             text_reader.create_suffix_list(args.suffix_size, 5)
-        if args.prefix:
+        if args.prefix and filename is not None:
             text_reader.create_prefix_list(args.prefix_size, 5)
 
     elif args.task == 'ner':
-        text_reader = ner.ner_reader.NerReader(md, filename=args.gold,
+        text_reader = ner.ner_reader.NerReader(md, filename=filename,
                                                variant=args.variant)
 
     elif args.task == 'lm':
-        text_reader = reader.TextReader(md, filename=args.gold,
-                                        variant=args.variant)
-        text_reader.get_dictionaries(args.dict_size_size)
+        text_reader = reader.TextReader(md, filename=filename,
+                                        variant=args.variant,
+                                        num_workers=args.num_workers,
+                                        block_size=args.stream)
+        text_reader.get_dictionaries(args.dict_size)
 
     elif args.task == 'sslm':
-        text_reader = reader.TweetReader(md, filename=args.gold,
-                                         ngrams=args.ngrams, variant=args.variant)
-        text_reader.get_dictionaries(args.dict_size_size)
+        text_reader = reader.TweetReader(md, filename=filename,
+                                         ngrams=args.ngrams, variant=args.variant,
+                                         max_candidates=args.max_candidates)
+        text_reader.get_dictionaries(args.dict_size)
 
     elif args.task.startswith('srl'):
-        text_reader = srl.srl_reader.SRLReader(md, filename=args.gold, only_boundaries=args.identify, 
+        text_reader = srl.srl_reader.SRLReader(md, filename=filename, only_boundaries=args.identify, 
                                                only_classify=args.classify,
                                                only_predicates=args.predicates,
                                                variant=args.variant)
     
-        if args.identify:
+        # the tags of a codified corpus were already converted
+        if filename is not None and args.identify:
             # only identify arguments
             text_reader.convert_tags('iobes', only_boundaries=True)
             
-        elif not args.classify and not args.predicates:
+        elif filename is not None and not args.classify and not args.predicates:
             # this is SRL as one step, we use IOB
             text_reader.convert_tags('iob', update_tag_dict=False)
         
@@ -82,6 +92,45 @@ def create_reader(args, md):
     return text_reader
     
 
+def create_codified_reader(args, md):
+    """
+    Creates a reader with the codified training data. Tagging corpora are
+    cached in the data directory, and the gold file is only read again if
+    it or any of the files used to codify it changed.
+    """
+    if args.task == 'lm' or args.task == 'sslm':
+        text_reader = create_reader(args, md, args.gold)
+        text_reader.create_converter()
+        text_reader.codify_sentences()
+        return text_reader
+    
+    def create(filename):
+        text_reader = create_reader(args, md, filename)
+        text_reader.create_converter()
+        return text_reader
+    
+    if getattr(args, 'load_corpus', False):
+        logger.info("Loading codified corpus...")
+        text_reader = create(None)
+        text_reader.load_codified(config.FILES[md.corpus])
+        return text_reader
+    
+    cache = CorpusCache(config.FILES['corpus_cache'])
+    return reader.load_or_codify(cache, create, md, args.gold, args.variant)
+    
+
+def read_heldout(text_reader, filename):
+    """
+    Reads held-out text and codifies it in the same way as the training text.
+    """
+    heldout_reader = reader.TextReader(text_reader.md, filename=filename,
+                                       variant=text_reader.variant)
+    heldout_reader.converter = text_reader.converter
+    heldout_reader.codify_sentences()
+    
+    return heldout_reader.sentences
+
+
 def create_network(args, text_reader, feature_tables, md=None):
     """Creates and returns the neural network according to the task at hand."""
     logger = logging.getLogger("Logger")
@@ -145,33 +194,34 @@ def create_network(args, text_reader, feature_tables, md=None):
     
     return nn
         
-def save_features(nn, md):
+def feature_files(nn, md):
     """
-    Receives a sequence of feature tables and saves each one in the appropriate file.
+    Returns a list of (filename, table) tuples with each feature table
+    of the network and the file where it is saved.
     
     :param nn: the neural network
     :param md: a Metadata object describing the network
     """
-    iter_tables = iter(nn.feature_tables)
     # word features
-    utils.save_features_to_file(iter_tables.next(), config.FILES[md.type_features])
+    files = [config.FILES[md.type_features]]
     
     # other features - the order is important!
     if md.use_caps:
-        utils.save_features_to_file(iter_tables.next(), config.FILES[md.caps_features])
+        files.append(config.FILES[md.caps_features])
     if md.use_suffix:
-        utils.save_features_to_file(iter_tables.next(), config.FILES[md.suffix_features])
+        files.append(config.FILES[md.suffix_features])
     if md.use_prefix:
-        utils.save_features_to_file(iter_tables.next(), config.FILES[md.prefix_features])
+        files.append(config.FILES[md.prefix_features])
     if md.use_pos:
-        utils.save_features_to_file(iter_tables.next(), config.FILES[md.pos_features])
+        files.append(config.FILES[md.pos_features])
     if md.use_chunk:
-        utils.save_features_to_file(iter_tables.next(), config.FILES[md.chunk_features])
+        files.append(config.FILES[md.chunk_features])
 
     # NER gazetteer features
     if md.use_gazetteer:
-        for file in config.FILES[md.gaz_features]:
-            utils.save_features_to_file(iter_tables.next(), file)
+        files.extend(config.FILES[md.gaz_features])
+    
+    return zip(files, nn.feature_tables)
     
 def load_network_train(args, md):
     """Loads and returns a neural network with all the necessary data."""
@@ -199,20 +249,55 @@ def train(text_reader, args):   # was reader. Attardi
                  args.iterations, report_intervals, args.accuracy, arg_limits)
     elif args.task == 'lm':
         report_intervals = 10000
-        nn.train(text_reader.sentences, args.iterations, report_intervals)
+        heldout = None
+        if args.heldout:
+            heldout = read_heldout(text_reader, args.heldout)
+        word_counts = None
+        stream_windows = 0
+        if args.stream:
+            # a single learning rate schedule for the whole file
+            word_counts = text_reader.get_word_counts()
+            stream_windows = text_reader.estimate_num_tokens()
+        nn.train(text_reader.sentences, args.iterations, report_intervals,
+                 args.num_workers, args.num_negatives, args.sampling_power,
+                 args.subsampling, heldout, args.heldout_windows, word_counts,
+                 stream_windows)
+        
+        if args.stream:
+            # the rest of the text, one block at a time
+            while True:
+                new_types = text_reader.next_block(args.dict_size)
+                if new_types is None:
+                    break
+                if new_types:
+                    logger.info("Added %d new types to the dictionary" % new_types)
+                    nn.grow_vocabulary(len(text_reader.word_dict))
+                    text_reader.save_dictionary()
+                
+                nn.train(text_reader.sentences, args.iterations, report_intervals,
+                         args.num_workers, args.num_negatives, args.sampling_power,
+                         args.subsampling, heldout, args.heldout_windows,
+                         text_reader.get_word_counts(), text_reader.estimate_num_tokens())
     elif args.task == 'sslm':
         report_intervals = 10000
-        nn.train(text_reader.sentences, args.iterations, report_intervals, text_reader.polarities, text_reader.word_dict)
+        nn.train(text_reader.sentences, args.iterations, report_intervals, text_reader.polarities, text_reader.word_dict,
+                 args.ngrams, args.sampling_power)
     else:
         nn.train(text_reader.sentences, text_reader.tags, 
-                 args.iterations, report_intervals, args.accuracy)
+                 args.iterations, report_intervals, args.accuracy, args.batch_size,
+                 args.num_workers, args.sync_interval, args.chunk_size, args.prefetch)
 
-def saver(nn_file, md):
-    """Function to save model periodically"""
-    def save(nn):
-        save_features(nn, md)
-        nn.save(nn_file)
-    return save
+def saver(nn_file, md, keep=1, compact_interval=0):
+    """
+    Returns a Checkpointer to save the model periodically, writing 
+    the feature tables, the network and the training state in the background.
+    """
+    state_file = config.FILES[md.training_state]
+    def get_files(nn):
+        return feature_files(nn, md) + [(nn_file, nn.get_saved_arrays()),
+                                        (state_file, nn.get_training_state())]
+    
+    return Checkpointer(get_files, keep, compact_interval)
 
 if __name__ == '__main__':
     args = arguments.get_args()
@@ -241,14 +326,19 @@ if __name__ == '__main__':
     else:
         md = metadata.Metadata.load_from_file(args.task)
     
-    text_reader = create_reader(args, md)
+    text_reader = create_codified_reader(args, md)
     
-    text_reader.create_converter()
-    text_reader.codify_sentences()
+    if getattr(args, 'save_corpus', False):
+        text_reader.save_codified(config.FILES[md.corpus])
+        logger.info("Saved codified corpus to %s" % config.FILES[md.corpus])
+        sys.exit()
     
     if args.load_network:
         logger.info("Loading provided network...")
         nn = load_network_train(args, md)
+        if args.resume:
+            logger.info("Loading training state...")
+            nn.set_training_state(np.load(config.FILES[md.training_state]))
     else:
         logger.info('Creating new network...')
         feature_tables = utils.load_features(args, md, text_reader)
@@ -260,13 +350,12 @@ if __name__ == '__main__':
     logger.info("Tag transition matrix learning rate: %f" % nn.learning_rate_trans)
     
     filename = config.FILES[md.network]
-    nn.saver = saver(filename, md)
+    nn.saver = saver(filename, md, args.keep_checkpoints, args.compact_interval)
 
     train(text_reader, args)
     
     logger.info("Saving trained models...")
-    save_features(nn, md)
-    
-    nn.save(filename)
+    nn.saver(nn, full=True)
+    nn.saver.wait()
     logger.info("Saved network to %s" % filename)
     
@@ -49,6 +49,10 @@ def get_args():
                              load a dictionary file)", dest='load_types')
     base_parser.add_argument('--load_network', action='store_true',
                              help='Load previously saved network')
+    base_parser.add_argument('--resume', action='store_true',
+                             help='Resume an interrupted training from its last '\
+                             'checkpoint: load the network and the training state '\
+                             '(epoch, learning rates, random state, etc.)')
     base_parser.add_argument('-e', '--epochs', type=int, default=100,
                              help='Number of training epochs (default 100)',
                              dest='iterations')
@@ -70,11 +74,18 @@ def get_args():
     base_parser.add_argument('-v', '--verbose', help='Verbose mode',
                              action="store_true")
     base_parser.add_argument('--gold', type=str, default=None,
-                             help='File with annotated data for training.', required=True)
+                             help='File with annotated data for training.')
     base_parser.add_argument('--data', type=str, default=None,
                              help='Directory to save new models and load partially trained ones', required=True)
     base_parser.add_argument('--variant', type=str, default=None,
                              help='If "polyglot" use Polyglot case conventions; if "senna" use SENNA conventions.')
+    base_parser.add_argument('--keep_checkpoints', type=int, default=1,
+                             help='Number of versions of the model files kept '\
+                             'while saving checkpoints during training (default 1)')
+    base_parser.add_argument('--compact_interval', type=int, default=0,
+                             help='Save feature tables in full only once every this '\
+                             'number of checkpoints, and only their changed rows '\
+                             'the other times (default 0, always in full)')
 
     # parser with arguments shared among convolutional-based tasks
     conv_parser = argparse.ArgumentParser(add_help=False)
@@ -90,9 +101,35 @@ def get_args():
     conv_parser.add_argument('--pred_features', type=int, default=5,
                              help='Number of features for distance to predicate')
 
+    # parser with arguments shared among window-based tasks
+    # (POS, NER and SRL predicate detection)
+    window_parser = argparse.ArgumentParser(add_help=False)
+    window_parser.add_argument('--batch_size', type=int, default=1,
+                               help='Number of sentences whose gradients are summed '\
+                               'before adjusting weights (default 1)')
+    window_parser.add_argument('--workers', type=int, default=1,
+                               help='Number of processes training in parallel (default 1)',
+                               dest='num_workers')
+    window_parser.add_argument('--sync_interval', type=int, default=10,
+                               help='Number of batches each process trains on before '\
+                               'averaging the changes of all of them (default 10)')
+    window_parser.add_argument('--save_corpus', action='store_true',
+                               help='Codify the training data, save it to numpy files '\
+                               'in the data directory and exit without training')
+    window_parser.add_argument('--load_corpus', action='store_true',
+                               help='Train on the corpus saved with --save_corpus, '\
+                               'memory mapped, instead of reading --gold')
+    window_parser.add_argument('--chunk_size', type=int, default=0,
+                               help='Shuffle sentences in chunks of this number of '\
+                               'consecutive ones, reading a memory mapped corpus '\
+                               'one chunk at a time (default 0, shuffle all)')
+    window_parser.add_argument('--prefetch', type=int, default=0,
+                               help='Number of batches prepared in advance by a '\
+                               'background thread (default 0, no prefetching)')
+
     # POS argument parser
     pos_parser = subparsers.add_parser('pos', help='POS tagging', 
-                                       parents=[base_parser])
+                                       parents=[base_parser, window_parser])
     pos_parser.add_argument('--caps', const=5, nargs='?', type=int, default=None,
                              help='Include capitalization features. Optionally, supply the number of features (default 5)')
     pos_parser.add_argument('--suffix', const=5, nargs='?', type=int, default=None,
@@ -131,7 +168,7 @@ Type %(prog)s [SUBTASK] -h to get subtask-specific help.'''
                                                dest='subtask',
                                                description=desc)
     srl_subparsers.add_parser('pred', help='Predicate identification',
-                              parents=[base_parser])
+                              parents=[base_parser, window_parser])
     defaults['srl_predicates'] = dict(window=5, hidden=50, iterations=1, 
                                       learning_rate=0.01, learning_rate_features=0.01,
                                       learning_rate_transitions=0.01,
@@ -159,7 +196,7 @@ Type %(prog)s [SUBTASK] -h to get subtask-specific help.'''
     
     # NER argument parser
     ner_parser = subparsers.add_parser('ner', help='NER tagging', 
-                                       parents=[base_parser])
+                                       parents=[base_parser, window_parser])
     ner_parser.add_argument('--caps', const=5, nargs='?', type=int, default=None,
                              help='Include capitalization features. Optionally, supply the number of features (default 5)')
     ner_parser.add_argument('--suffix', const=5, nargs='?', type=int, default=None,
@@ -175,6 +212,28 @@ Type %(prog)s [SUBTASK] -h to get subtask-specific help.'''
                                       parents=[base_parser])
     lm_parser.add_argument('--dict_size',type=int, default=100000,
                            help='Size of embeddings dictionary (default 100000)')
+    lm_parser.add_argument('--workers', type=int, default=1,
+                           help='Number of processes training in parallel, '\
+                           'sharing weights without locks (default 1)',
+                           dest='num_workers')
+    lm_parser.add_argument('--negatives', type=int, default=1,
+                           help='Number of negative examples for each positive one (default 1)',
+                           dest='num_negatives')
+    lm_parser.add_argument('--sampling_power', type=float, default=0.75,
+                           help='Draw negative examples with probability proportional '\
+                           'to word frequencies raised to this power (default 0.75)')
+    lm_parser.add_argument('--subsampling', type=float, default=0,
+                           help='Randomly skip occurrences of words more frequent than '\
+                           'this threshold, e.g. 1e-5 (default 0, no subsampling)')
+    lm_parser.add_argument('--stream', type=int, default=None,
+                           help='Read and train on this number of sentences at a time, '\
+                           'adding new frequent words to the dictionary as they appear')
+    lm_parser.add_argument('--heldout', type=str, default=None,
+                           help='File with text not used for training. The model '\
+                           'is evaluated on it after each epoch.')
+    lm_parser.add_argument('--heldout_windows', type=int, default=100,
+                           help='Number of windows sampled from the held-out text. '\
+                           'Evaluation time is proportional to it (default 100)')
 
     # SSLM argument parser
     sslm_parser = subparsers.add_parser('sslm', help='Sentiment Specific Language Model creation', 
@@ -183,9 +242,15 @@ Type %(prog)s [SUBTASK] -h to get subtask-specific help.'''
                            help='Size of embeddings dictionary (default 100000)')
     sslm_parser.add_argument('--ngrams',type=int, default=1,
                            help='Length of ngrams to consider (default 1)')
+    sslm_parser.add_argument('--max_candidates', type=int, default=None,
+                           help='Maximum number of distinct ngrams kept in memory '\
+                           'while creating the dictionary (default no limit)')
     sslm_parser.add_argument('--alpha', type=float, default=0.5,
                            help='Weight of syntactic loss (default 0.5)',
                            dest='alpha')
+    sslm_parser.add_argument('--sampling_power', type=float, default=0.75,
+                           help='Draw negative examples with probability proportional '\
+                           'to word frequencies raised to this power (default 0.75)')
 
     args = parser.parse_args()
     if args.task == 'srl':
@@ -199,5 +264,13 @@ Type %(prog)s [SUBTASK] -h to get subtask-specific help.'''
             args.task = 'srl_predicates'
             args.predicates = True
     
+    if args.gold is None and not getattr(args, 'load_corpus', False):
+        parser.error('argument --gold is required')
+    
+    if args.resume:
+        if getattr(args, 'stream', None):
+            parser.error("argument --resume can't be used with --stream")
+        args.load_network = True
+    
     fill_defaults(args, defaults)
     return args
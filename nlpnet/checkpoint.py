@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+
+"""
+Saving models while they are trained.
+
+Checkpoints are copied to staging buffers in memory and written to disk by a
+background thread, so that training goes on during the write. Files are
+replaced atomically: they are written with a temporary name and then renamed,
+so an interrupted run always leaves a complete checkpoint behind.
+
+Feature tables may also be saved as deltas: only the rows changed since the
+previous checkpoint are written, to a file next to the full table. Every 
+so often, the full table is written again and the deltas are removed. 
+load_table() reads a table and applies its deltas.
+
+Besides the model, checkpoints have the state of training (see the
+get_training_state() method of networks), with which an interrupted run
+is resumed. It includes states of the numpy random number generator, which
+are converted to arrays with random_state_arrays().
+"""
+
+import os
+import sys
+import logging
+import threading
+import numpy as np
+
+
+def atomic_save(filename, data, keep=1):
+    """
+    Saves an array (with numpy.save) or a dictionary of arrays (with
+    numpy.savez) to the given file, replacing it atomically.
+
+    :param keep: number of versions of the file to keep. Older versions
+        are renamed to filename.1 (the previous one), filename.2, etc.
+    """
+    temp_filename = '%s.%d.tmp' % (filename, os.getpid())
+    with open(temp_filename, 'wb') as f:
+        if isinstance(data, dict):
+            np.savez(f, **data)
+        else:
+            np.save(f, data)
+
+    if keep > 1:
+        _rotate(filename, keep)
+    os.rename(temp_filename, filename)
+
+def delta_files(filename):
+    """
+    Returns the delta files of the given table, in the order they must be
+    applied.
+    """
+    directory, basename = os.path.split(filename)
+    prefix = '%s.delta.' % basename
+    numbers = [int(name[len(prefix):]) for name in os.listdir(directory or '.')
+               if name.startswith(prefix) and name[len(prefix):].isdigit()]
+    
+    return ['%s.delta.%d' % (filename, number) for number in sorted(numbers)]
+
+def load_table(filename):
+    """
+    Loads a table saved by a Checkpointer (or with numpy.save), applying the
+    changes in its delta files, if there are any.
+    """
+    table = np.load(filename)
+    for delta_filename in delta_files(filename):
+        delta = np.load(delta_filename)
+        num_rows = int(delta['num_rows'])
+        if num_rows > len(table):
+            # the table grew, and the delta has all new rows
+            grown = np.empty((num_rows,) + table.shape[1:], table.dtype)
+            grown[:len(table)] = table
+            table = grown
+        
+        table[delta['rows']] = delta['values']
+    
+    return table
+
+def random_state_arrays(name, states):
+    """
+    Returns a dictionary of arrays with the given states of the numpy random
+    number generator (as returned by numpy.random.get_state), which can be
+    saved with the other arrays of a training state.
+
+    :param name: prefix of the keys in the dictionary.
+    :param states: a list of states.
+    """
+    keys = np.array([state[1] for state in states], np.uint32).reshape(-1, 624)
+    positions = np.array([state[2] for state in states], np.int)
+    has_gauss = np.array([state[3] for state in states], np.int)
+    cached_gaussians = np.array([state[4] for state in states], np.float)
+
+    return {'%s_keys' % name: keys, '%s_positions' % name: positions,
+            '%s_has_gauss' % name: has_gauss,
+            '%s_cached_gaussians' % name: cached_gaussians}
+
+def random_states(arrays, name):
+    """
+    Returns the list of random states saved in the given arrays (a
+    dictionary or a file loaded with numpy.load) by random_state_arrays().
+    """
+    return [('MT19937', keys, int(position), int(has_gauss), float(cached_gaussian))
+            for keys, position, has_gauss, cached_gaussian
+            in zip(arrays['%s_keys' % name], arrays['%s_positions' % name],
+                   arrays['%s_has_gauss' % name],
+                   arrays['%s_cached_gaussians' % name])]
+
+def _rotate(filename, keep):
+    """
+    Renames the previous versions of a file, discarding the oldest one, and
+    links the current version as filename.1. The file itself stays in place
+    until it is replaced.
+    """
+    for i in xrange(keep - 1, 1, -1):
+        older = '%s.%d' % (filename, i - 1)
+        if os.path.isfile(older):
+            os.rename(older, '%s.%d' % (filename, i))
+
+    if os.path.isfile(filename):
+        previous = '%s.1' % filename
+        if os.path.isfile(previous):
+            os.remove(previous)
+        os.link(filename, previous)
+
+
+class Checkpointer(object):
+    """
+    Saves checkpoints of a network without pausing its training. It is called
+    with the network, and copies the arrays to be saved to staging buffers,
+    which are written by a background thread.
+
+    If a checkpoint is requested while the previous one is still being
+    written, the call waits for it to finish.
+    
+    Tables (2-dim arrays) can be saved as deltas. The rows that changed are
+    found by comparing each table with its staging buffer, which still has
+    the values of the previous checkpoint. This also covers tables changed
+    by other processes in shared memory.
+    """
+
+    def __init__(self, get_files, keep=1, compact_interval=0):
+        """
+        :param get_files: a function taking the network and returning a list
+            of (filename, data) tuples, where data is an array or a dictionary
+            of arrays.
+        :param keep: number of versions of each file to keep.
+        :param compact_interval: if greater than 1, tables are saved in full 
+            only once every this number of checkpoints. The other times, only
+            their changed rows are saved to delta files.
+        """
+        self.get_files = get_files
+        self.keep = keep
+        self.compact_interval = compact_interval
+        self.buffers = {}
+        # number of deltas of each table since it was saved in full
+        self.num_deltas = {}
+        self.writer = None
+        self.error = None
+
+    def __call__(self, nn, full=False):
+        """
+        Starts writing a checkpoint of the given network.
+        
+        :param full: if True, tables are saved in full and their deltas
+            are removed.
+        """
+        self.wait()
+
+        writes = []
+        for filename, data in self.get_files(nn):
+            if not full and self._use_delta(filename, data):
+                self.num_deltas[filename] += 1
+                delta_filename = '%s.delta.%d' % (filename, self.num_deltas[filename])
+                writes.append((delta_filename, self._stage_delta(filename, data), True))
+            else:
+                if self.compact_interval > 1 and not isinstance(data, dict):
+                    self.num_deltas[filename] = 0
+                writes.append((filename, self._stage(filename, data), False))
+
+        self.writer = threading.Thread(target=self._write, args=(writes,))
+        self.writer.daemon = True
+        self.writer.start()
+
+    def wait(self):
+        """
+        Waits for the checkpoint being written, if any. Errors that happened
+        while writing it are raised here.
+        """
+        if self.writer is not None:
+            self.writer.join()
+            self.writer = None
+
+        if self.error is not None:
+            error = self.error
+            self.error = None
+            raise error[0], error[1], error[2]
+
+    def _use_delta(self, filename, data):
+        """
+        Returns whether only the rows of the given table that changed since 
+        the last checkpoint should be saved.
+        """
+        if self.compact_interval <= 1 or isinstance(data, dict) or np.ndim(data) != 2:
+            return False
+        
+        # a full table is needed every compact_interval checkpoints, 
+        # and the previous values must be known
+        if self.num_deltas.get(filename, self.compact_interval) >= self.compact_interval - 1:
+            return False
+        
+        buffer_ = self.buffers.get(filename)
+        return buffer_ is not None and buffer_.dtype == data.dtype and \
+            buffer_.shape[1] == data.shape[1] and len(buffer_) <= len(data)
+    
+    def _stage_delta(self, filename, table):
+        """
+        Finds the rows of the given table that differ from its staging buffer
+        and copies them to it.
+        
+        :return: a dictionary with the number of rows in the table, the
+            indices of the changed rows and their values.
+        """
+        buffer_ = self.buffers[filename]
+        old_size = len(buffer_)
+        rows = np.flatnonzero((table[:old_size] != buffer_).any(1))
+        
+        if len(table) > old_size:
+            # new rows are always saved
+            rows = np.concatenate((rows, np.arange(old_size, len(table))))
+            grown = np.empty_like(table)
+            grown[:old_size] = buffer_
+            buffer_ = self.buffers[filename] = grown
+        
+        buffer_[rows] = table[rows]
+        return dict(num_rows=len(table), rows=rows, values=buffer_[rows])
+    
+    def _stage(self, filename, data):
+        """
+        Copies the given array (or dictionary of arrays) to the buffers kept
+        for the given file, which are reused by the following checkpoints.
+        """
+        if isinstance(data, dict):
+            return {name: self._copy((filename, name), array)
+                    for name, array in data.iteritems()}
+
+        return self._copy(filename, data)
+
+    def _copy(self, key, array):
+        """Copies an array to the staging buffer with the given key."""
+        array = np.asarray(array)
+        buffer_ = self.buffers.get(key)
+        if buffer_ is None or buffer_.shape != array.shape or buffer_.dtype != array.dtype:
+            buffer_ = np.empty_like(array)
+            self.buffers[key] = buffer_
+
+        np.copyto(buffer_, array)
+        return buffer_
+
+    def _write(self, files):
+        """Writes the staged files. Runs in the background thread."""
+        logger = logging.getLogger("Logger")
+        try:
+            for filename, data, delta in files:
+                if delta:
+                    atomic_save(filename, data)
+                    continue
+                
+                # the deltas of a table saved in full are no longer needed.
+                # they are removed from the newest, so that an interruption
+                # leaves the old table with the deltas before the removed ones
+                for delta_filename in reversed(delta_files(filename)):
+                    os.remove(delta_filename)
+                atomic_save(filename, data, self.keep)
+            logger.debug("Checkpoint saved to %s" % ', '.join(item[0] for item in files))
+        except:
+            self.error = sys.exc_info()
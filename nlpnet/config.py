@@ -18,16 +18,19 @@ def get_config_paths(directory):
         ('.', '.'), #for data_dir access
         ('vocabulary'                  , 'vocabulary.txt'),
         ('type_features'               , 'vectors.npy'),
+        ('corpus_cache'                , 'corpus-cache'),
 
         # Language Model
         ('lm_network'			, 'lm-network.npz'),
         ('lm_metadata'			, 'lm-metadata.pickle'),
         ('lm_type_features'		, 'lm-vectors.npy'),
+        ('lm_training_state'		, 'lm-training-state.npz'),
 
         # Sentiment Model
         ('sslm_network'			, 'sslm-network.npz'),
         ('sslm_metadata'		, 'sslm-metadata.pickle'),
         ('sslm_type_features'		, 'sslm-vectors.npy'),
+        ('sslm_training_state'		, 'sslm-training-state.npz'),
 
         # POS
         ('pos_network'                 , 'pos-network.npz'),
@@ -39,6 +42,8 @@ def get_config_paths(directory):
         ('pos_caps_features'           , 'pos-caps-vectors.npy'),
         ('pos_suffix_features'         , 'pos-suffix-vectors.npy'),
         ('pos_prefix_features'         , 'pos-prefix-vectors.npy'),
+        ('pos_corpus'                  , 'pos-corpus'),
+        ('pos_training_state'          , 'pos-training-state.npz'),
 
         # NER
         ('ner_metadata'		, 'ner-metadata.pickle'),
@@ -49,6 +54,8 @@ def get_config_paths(directory):
         ('ner_caps_features'	, 'ner-caps-vectors.npy'),
         ('ner_suffix_features'	, 'ner-suffix-vectors.npy'),
         ('ner_gazetteer'	, 'eng.list'),
+        ('ner_corpus'		, 'ner-corpus'),
+        ('ner_training_state'	, 'ner-training-state.npz'),
 
         # chunk
         ('chunk_tag_dict'              , 'chunk-tag-dict.txt'),
@@ -62,6 +69,7 @@ def get_config_paths(directory):
         ('srl_iob_tag_dict'            , 'srl-tags.txt'),
         ('srl_iob_tags'                , 'srl-tags.txt'),
         ('srl_tags'                    , 'srl-tags.txt'),
+        ('srl_tag_dict'                , 'srl-tags.txt'),
         ('srl_classify_tag_dict'       , 'srl-tags.txt'),
         ('srl_classify_tags'           , 'srl-tags.txt'),
         ('srl_predicates_tag_dict'     , 'srl-predicates-tags.txt'),
@@ -85,6 +93,11 @@ def get_config_paths(directory):
         ('srl_boundary_metadata'       , 'srl-metadata-boundary.pickle'),
         ('srl_metadata_classify'       , 'srl-metadata-classify.pickle'),
         ('srl_predicates_metadata'     , 'srl-metadata-predicates.pickle'),
+        ('srl_predicates_corpus'       , 'srl-predicates-corpus'),
+        ('srl_training_state'          , 'srl-training-state.npz'),
+        ('srl_boundary_training_state' , 'srl-id-training-state.npz'),
+        ('srl_classify_training_state' , 'srl-class-training-state.npz'),
+        ('srl_predicates_training_state', 'srl-predicates-training-state.npz'),
         ]
     }
     # NER
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+
+"""
+Compact storage for codified corpora and a cache of them on disk.
+"""
+
+import os
+import hashlib
+import shutil
+import numpy as np
+from itertools import izip
+
+
+class RaggedArray(object):
+    """
+    A sequence of arrays of different lengths, such as the codified sentences
+    of a corpus or their tags, stored one after the other in a single array.
+    Items are views of it, so the sequence can be used in place of a list of
+    arrays without the overhead of one object per sentence.
+    """
+
+    def __init__(self, values, offsets):
+        """
+        :param values: an array with the rows of all items, one after the other.
+        :param offsets: an array with the position in values of the first row
+            of each item, followed by len(values).
+        """
+        self.values = values
+        self.offsets = offsets
+
+    @classmethod
+    def from_arrays(cls, arrays, dtype=np.int32):
+        """
+        Creates a RaggedArray by copying a list of arrays (or lists), which
+        must have the same shape except for the first dimension.
+        """
+        lengths = np.fromiter((len(array) for array in arrays), np.int, len(arrays))
+        offsets = np.zeros(len(arrays) + 1, np.int)
+        np.cumsum(lengths, out=offsets[1:])
+
+        # shape of each row, taken from any non-empty item
+        row_shape = ()
+        for array in arrays:
+            if len(array):
+                row_shape = np.shape(array)[1:]
+                break
+
+        values = np.empty((offsets[-1],) + row_shape, dtype)
+        for array, start, end in izip(arrays, offsets[:-1], offsets[1:]):
+            if end > start:
+                values[start:end] = array
+
+        return cls(values, offsets)
+
+    @classmethod
+    def load(cls, prefix, mmap_mode=None):
+        """
+        Loads a RaggedArray saved with save().
+
+        :param prefix: the path given to save().
+        :param mmap_mode: passed to numpy.load for the values. With 'r', they
+            are memory mapped and read from disk only when items are accessed.
+            The offsets are always loaded into memory.
+        """
+        values = np.load('%s.npy' % prefix, mmap_mode=mmap_mode)
+        offsets = np.load('%s-offsets.npy' % prefix)
+        return cls(values, offsets)
+
+    def save(self, prefix):
+        """
+        Saves the values and offsets as numpy files named after the given
+        prefix: prefix.npy and prefix-offsets.npy.
+        """
+        np.save('%s.npy' % prefix, self.values)
+        np.save('%s-offsets.npy' % prefix, self.offsets)
+
+    @property
+    def lengths(self):
+        """Number of rows in each item."""
+        return np.diff(self.offsets)
+
+    @property
+    def nbytes(self):
+        """Memory used by the values and offsets."""
+        return self.values.nbytes + self.offsets.nbytes
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        """
+        An integer index returns a view of the item. A slice (without step)
+        returns a RaggedArray whose values are a view of these.
+        """
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                raise ValueError("Slices of a RaggedArray can't have a step")
+            stop = max(start, stop)
+            offsets = self.offsets[start:stop + 1]
+            values = self.values[offsets[0]:offsets[-1]]
+            return RaggedArray(values, offsets - offsets[0])
+
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("RaggedArray index out of range: %d" % index)
+
+        return self.values[self.offsets[index]:self.offsets[index + 1]]
+
+    def __iter__(self):
+        for start, end in izip(self.offsets[:-1], self.offsets[1:]):
+            yield self.values[start:end]
+
+    def take(self, indices):
+        """
+        Returns a new RaggedArray with copies of the items at the given indices,
+        in their order.
+        """
+        return RaggedArray.from_arrays([self[i] for i in indices], self.values.dtype)
+
+
+def file_digest(filename, block_size=2 ** 20):
+    """
+    Returns the SHA-1 hex digest of the contents of a file, or None if 
+    it doesn't exist.
+    """
+    if filename is None or not os.path.isfile(filename):
+        return None
+    
+    sha = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), ''):
+            sha.update(block)
+    
+    return sha.hexdigest()
+
+
+class CorpusCache(object):
+    """
+    A directory with codified corpora. Each one is saved by a reader in a 
+    subdirectory named after a key, which is computed from the contents of
+    all files used to create it and any options that change it.
+    """
+    
+    def __init__(self, directory):
+        self.directory = directory
+    
+    def key(self, filenames, *options):
+        """
+        Returns a key identifying the corpus codified from the given files 
+        with the given options. Missing files are also taken into account.
+        """
+        sha = hashlib.sha1()
+        for filename in filenames:
+            sha.update(repr(file_digest(filename)))
+        sha.update(repr(options))
+        
+        return sha.hexdigest()
+    
+    def path(self, key):
+        """Returns the file prefix used to save the corpus with the given key."""
+        return os.path.join(self.directory, key, 'corpus')
+    
+    def __contains__(self, key):
+        return os.path.isdir(os.path.join(self.directory, key))
+    
+    def store(self, key, reader):
+        """
+        Saves the codified corpus of the given reader under the given key.
+        It is written to a temporary directory that is renamed at the end,
+        so an interrupted run never leaves an incomplete corpus behind.
+        """
+        final_dir = os.path.join(self.directory, key)
+        temp_dir = '%s.%d.tmp' % (final_dir, os.getpid())
+        if not os.path.isdir(temp_dir):
+            os.makedirs(temp_dir)
+        
+        reader.save_codified(os.path.join(temp_dir, 'corpus'))
+        try:
+            os.rename(temp_dir, final_dir)
+        except OSError:
+            # another process stored the same corpus first
+            shutil.rmtree(temp_dir)
+    
+    def load(self, key, reader, mmap_mode='r'):
+        """Loads the corpus with the given key into the given reader."""
+        reader.load_codified(self.path(key), mmap_mode)
@@ -30,6 +30,8 @@ class Metadata(object):
         self.use_gazetteer = use_gazetteer
         self.metadata = '%s_metadata' % task
         self.network = '%s_network' % task
+        self.corpus = '%s_corpus' % task
+        self.training_state = '%s_training_state' % task
         
         if task != 'lm' and task != 'sslm':
             self.tag_dict = '%s_tag_dict' % task
@@ -106,14 +108,21 @@ class Metadata(object):
         """
         if paths is None:
             paths = config.FILES
-        md = Metadata(task, paths)
+        md = Metadata(task)
 
         # the actual content of the file is the __dict__ member variable,
         # which contain all the instance's data
         filename = paths[md.metadata]
         with open(filename, 'rb') as f:
             data = cPickle.load(f)
+        
+        # files saved by older versions lack some attributes (e.g., corpus and
+        # training_state) and paths. they keep the defaults set by __init__
+        saved_paths = data.get('paths')
         md.__dict__.update(data)
+        if saved_paths is not None:
+            md.paths = dict(paths)
+            md.paths.update(saved_paths)
         
         return md
 
@@ -10,9 +10,16 @@ import numpy as np
 cimport numpy as np
 cimport cython
 from cpython cimport bool
+from libc.math cimport exp, log
 
 from itertools import izip
+import sys
 import logging
+import multiprocessing
+import threading
+
+import parallel
+import checkpoint
 
 ctypedef np.float_t FLOAT_t
 ctypedef np.int_t INT_t
@@ -81,13 +88,7 @@ cdef hardtanh(np.ndarray[FLOAT_t, ndim=1] weights):
 
 cdef hardtanhd(np.ndarray[FLOAT_t, ndim=2] weights):
     """derivative of hardtanh"""
-    cdef np.ndarray out = np.zeros_like(weights)
-    cdef int i
-    cdef double w
-    for i, w in enumerate(weights.flat):
-        if -1.0 <= w <= 1.0:
-            out.flat[i] = 1.0
-    return out
+    return ((weights >= -1.0) & (weights <= 1.0)).astype(weights.dtype)
 
 cdef hardtanhe(np.ndarray[FLOAT_t] y):
     """derivative of hardtanh in terms of y = hardtanh(x) ="""
@@ -99,6 +100,149 @@ cdef hardtanhe(np.ndarray[FLOAT_t] y):
             out.flat[i] = 0.0
     return out
 
+cdef scatter_add(np.ndarray table, np.ndarray indices, np.ndarray values):
+    """
+    Adds each row in values to the row of table given by indices.
+    Unlike table[indices] += values, rows of repeated indices are all added.
+    """
+    if len(indices) == 0:
+        return
+    
+    order = indices.argsort(kind='mergesort')
+    sorted_indices = indices[order]
+    # the first position of each distinct index
+    firsts = np.flatnonzero(np.concatenate(([True], sorted_indices[1:] != sorted_indices[:-1])))
+    table[sorted_indices[firsts]] += np.add.reduceat(values[order], firsts, axis=0)
+
+cdef list workspace_views(list shapes, dtype=np.float):
+    """
+    Allocates a single array with room for arrays of all the given shapes,
+    and returns a contiguous view of it with each shape.
+    """
+    sizes = [rows * columns for rows, columns in shapes]
+    arena = np.empty(sum(sizes), dtype)
+    views = []
+    start = 0
+    for shape, size in izip(shapes, sizes):
+        views.append(arena[start:start + size].reshape(shape))
+        start += size
+    
+    return views
+
+# ----------------------------------------------------------------------
+# Sentence Level Likelihood
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef double sll_logadd(FLOAT_t[:] values):
+    """Log of the sum of the exponentials of values, computed stably."""
+    cdef int i
+    cdef double maximum = values[0]
+    cdef double total = 0
+    for i in range(1, values.shape[0]):
+        if values[i] > maximum:
+            maximum = values[i]
+    for i in range(values.shape[0]):
+        total += exp(values[i] - maximum)
+    return maximum + log(total)
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef double sll_path_score(FLOAT_t[:, :] scores, INT_t[:] tags,
+                           FLOAT_t[:, :] transitions):
+    """
+    Score of the tag path given by tags: the network scores of each tag plus
+    the transitions between them, starting from the initial transition.
+    """
+    cdef int t
+    cdef int last_tag = scores.shape[1]
+    cdef double total = 0
+    for t in range(scores.shape[0]):
+        total += transitions[last_tag, tags[t]] + scores[t, tags[t]]
+        last_tag = tags[t]
+    return total
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void sll_forward(FLOAT_t[:, :] scores, FLOAT_t[:, :] transitions,
+                      FLOAT_t[:, :] delta):
+    """
+    Forward sweep of the Sentence Level Likelihood. Fills the first len(scores)
+    rows of delta, where delta[t, j] is the logadd of the scores of all paths
+    ending in token t with tag j (delta_t(j) in eq. 14 in the paper):
+
+    delta_0(j) = ftheta_j,0 + A_0,j
+    delta_t(j) = ftheta_j,t + logadd_i(delta_t-1(i) + A_i,j)
+
+    scores is not modified.
+    """
+    cdef int length = scores.shape[0]
+    cdef int num_tags = scores.shape[1]
+    cdef int t, i, j
+    cdef double value, maximum, total
+
+    # transitions[-1] represents initial transition, A_0,i in paper
+    for j in range(num_tags):
+        delta[0, j] = scores[0, j] + transitions[num_tags, j]
+
+    for t in range(1, length):
+        for j in range(num_tags):
+            maximum = delta[t - 1, 0] + transitions[0, j]
+            for i in range(1, num_tags):
+                value = delta[t - 1, i] + transitions[i, j]
+                if value > maximum:
+                    maximum = value
+            total = 0
+            for i in range(num_tags):
+                total += exp(delta[t - 1, i] + transitions[i, j] - maximum)
+            delta[t, j] = scores[t, j] + maximum + log(total)
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void sll_backward(FLOAT_t[:, :] scores, INT_t[:] tags,
+                       FLOAT_t[:, :] transitions, FLOAT_t[:, :] delta,
+                       FLOAT_t[:, :] net_gradients, FLOAT_t[:, :] trans_gradients):
+    """
+    Backward sweep of the Sentence Level Likelihood, using the delta filled by
+    sll_forward. Writes the negative gradients of the cost with respect to the
+    network scores to the first len(scores) rows of net_gradients, and adds
+    the ones with respect to the transitions to trans_gradients.
+    """
+    cdef int length = scores.shape[0]
+    cdef int num_tags = scores.shape[1]
+    cdef int t, i, j, last_tag
+    cdef double logadd, gradient, value
+
+    # dC_logadd / ddelta_T(j) = e(delta_T(j))/Sum_k(e(delta_T(k)))
+    logadd = sll_logadd(delta[length - 1])
+    for j in range(num_tags):
+        net_gradients[length - 1, j] = -exp(delta[length - 1, j] - logadd)
+
+    # the share of each previous tag i in delta_t+1(j) is the softmax
+    # e(delta_t(i) + A_i,j) / Sum_k e(delta_t(k) + A_k,j), whose denominator
+    # is e(delta_t+1(j) - ftheta_j,t+1), already known from the forward sweep
+    for t in range(length - 2, -1, -1):
+        for i in range(num_tags):
+            gradient = 0
+            for j in range(num_tags):
+                value = net_gradients[t + 1, j] * \
+                    exp(delta[t, i] + transitions[i, j] - delta[t + 1, j] + scores[t + 1, j])
+                # dC / dA_i,j
+                trans_gradients[i, j] += value
+                gradient += value
+            net_gradients[t, i] = gradient
+
+    # there is only one possibility to come from, which is the sentence start
+    for j in range(num_tags):
+        trans_gradients[num_tags, j] += net_gradients[0, j]
+
+    # now, add +1 to the correct path
+    last_tag = num_tags
+    for t in range(length):
+        net_gradients[t, tags[t]] += 1
+        trans_gradients[last_tag, tags[t]] += 1
+        last_tag = tags[t]
+
 # ----------------------------------------------------------------------
 
 cdef class Network:
@@ -129,13 +273,31 @@ cdef class Network:
     # gradients
     cdef readonly np.ndarray net_gradients, trans_gradients
     cdef readonly np.ndarray input_sent_values, hidden_sent_values, layer2_sent_values
-    
+
+    # training workspace, with room for the longest sentence. The values
+    # stored for each sentence are views of its first rows
+    cdef int workspace_length
+    cdef np.ndarray padded_workspace, starts_workspace
+    cdef np.ndarray input_workspace, layer2_workspace, hidden_workspace, scores_workspace
+    cdef np.ndarray sll_delta, sll_gradients
+
     # data for statistics during training. 
     cdef float error, accuracy, float_errors
-    cdef int train_items, skips
+    cdef int train_items
+    cdef long skips
     
     # function to save periodically
     cdef public object saver
+    
+    # training progress, saved with checkpoints so that training can be 
+    # resumed: number of epochs trained, the best and last results and the 
+    # order of the sentences, which is shuffled again in each epoch
+    cdef int epoch
+    cdef float min_error, top_accuracy, last_error, last_accuracy
+    cdef np.ndarray order
+    
+    # state given to set_training_state(), restored by the next call to train()
+    cdef dict resume_state
 
     @classmethod
     def create_new(cls, feature_tables, int word_window, int hidden_size, 
@@ -249,6 +411,72 @@ Output size: %d
 
         return self.output_weights.dot(self.hidden_values) + self.output_bias
 
+    def _padded_windows(self, list sentences):
+        """
+        Concatenates the given sentences, each one with its padding.
+
+        :param sentences: a list of 2-dim numpy arrays, each one encoding a sentence.
+        :return: a tuple (padded, starts, offsets). padded has all the padded
+            tokens, starts[j] is the position in padded of the first token
+            of the j-th window and the windows of the i-th sentence are
+            offsets[i]:offsets[i+1].
+        """
+        if self.word_window_size > 1:
+            padded = np.concatenate([np.concatenate((self.pre_padding,
+                                                     sentence,
+                                                     self.pos_padding))
+                                     for sentence in sentences])
+        else:
+            padded = np.concatenate(sentences)
+
+        lengths = np.array([len(sentence) for sentence in sentences], np.int)
+        offsets = np.concatenate(([0], np.cumsum(lengths)))
+
+        # each sentence is shifted by the paddings of the ones before it
+        padding_size = self._padding_size()
+        starts = np.arange(offsets[-1]) + np.repeat(np.arange(len(sentences)) * padding_size,
+                                                    lengths)
+
+        return padded, starts, offsets
+
+    def _padding_size(self):
+        """
+        Returns the number of padding tokens added to each sentence. It is
+        word_window_size - 1 for odd windows, but one more for even ones, 
+        which have word_window_size / 2 tokens on each side.
+        """
+        if self.word_window_size == 1:
+            return 0
+        
+        return len(self.pre_padding) + len(self.pos_padding)
+    
+    def _lookup_windows(self, np.ndarray padded, np.ndarray starts):
+        """
+        Builds the input values for the windows beginning at each position
+        in starts. Feature vectors are looked up once per (padded) token and
+        then concatenated window by window, in the same order used by lookup().
+
+        :return: a (len(starts), input_size) array.
+        """
+        cdef int i
+        # feature vectors of each padded token: (num padded tokens, features_per_token)
+        token_values = np.hstack([table.take(padded[:, i], 0)
+                                  for i, table in enumerate(self.feature_tables)])
+
+        return np.hstack([token_values.take(starts + i, 0)
+                          for i in xrange(self.word_window_size)])
+
+    def _window_inputs(self, list sentences):
+        """
+        Builds the input values for every window of every sentence at once.
+
+        :param sentences: a list of 2-dim numpy arrays, each one encoding a sentence.
+        :return: a tuple (inputs, offsets). inputs is a (total tokens, input_size)
+            array and the rows of the i-th sentence are offsets[i]:offsets[i+1].
+        """
+        padded, starts, offsets = self._padded_windows(sentences)
+        return self._lookup_windows(padded, starts), offsets
+
     property padding_left:
         """
         The padding element filling the "void" before the beginning
@@ -284,6 +512,27 @@ Output size: %d
         # computes full score, combining ftheta and A (if SLL)
         return self._viterbi(scores)
 
+    def tag_sentences(self, list sentences):
+        """
+        Tags a batch of sentences. All windows of all sentences are run
+        through each layer with a single matrix product.
+
+        :param sentences: a list of 2-dim numpy arrays, where each item encodes a sentence.
+        :return: a list with the sequence of tags for each sentence.
+        """
+        if not sentences:
+            return []
+
+        inputs, offsets = self._window_inputs(sentences)
+        # (total_tokens, input_size) (input_size, hidden_size) = (total_tokens, hidden_size)
+        hidden_values = inputs.dot(self.hidden_weights.T) + self.hidden_bias
+        # hardtanh
+        hidden_values = np.clip(hidden_values, -1, 1)
+        scores = hidden_values.dot(self.output_weights.T) + self.output_bias
+
+        return [self._viterbi(scores[offsets[i]:offsets[i + 1]])
+                for i in xrange(len(sentences))]
+
     def _tag_sentence(self, np.ndarray sentence, bool train=False, tags=None):
         """
         Runs the network for each element in the sentence and returns 
@@ -292,24 +541,28 @@ Output size: %d
         :param sentence: a 2-dim numpy array, where each item encodes a token.
         :param train: if True, perform weight and feature correction.
         :param tags: the correct tags (needed when training)
-        :return: a (len(sentence), output_size) array with the scores for all tokens
+        :return: a (len(sentence), output_size) array with the scores for all tokens.
+            When training, it is a view of the training workspace.
         """
-        cdef np.ndarray answer
-        # scores[t, i] = ftheta_i,t = score for i-th tag, t-th word
-        cdef np.ndarray scores = np.empty((len(sentence), self.output_size))
+        cdef np.ndarray answer, scores, input_values, padded_sentence
+        cdef int length = len(sentence)
         
         if train:
-            self.input_sent_values = np.empty((len(sentence), self.input_size))
+            self._ensure_workspace(length)
+            # scores[t, i] = ftheta_i,t = score for i-th tag, t-th word
+            scores = self.scores_workspace[:length]
+            self.input_sent_values = self.input_workspace[:length]
             # layer2_values at each token in the correct path
-            self.layer2_sent_values = np.empty((len(sentence), self.hidden_size))
+            self.layer2_sent_values = self.layer2_workspace[:length]
             # hidden_values at each token in the correct path
-            self.hidden_sent_values = np.empty((len(sentence), self.hidden_size))
-        
-        # add padding to the sentence
-        cdef np.ndarray input_values
-        cdef np.ndarray padded_sentence = np.concatenate((self.pre_padding,
-                                                          sentence,
-                                                          self.pos_padding))
+            self.hidden_sent_values = self.hidden_workspace[:length]
+            padded_sentence = self._pad_sentence(sentence)
+        else:
+            scores = np.empty((length, self.output_size))
+            # add padding to the sentence
+            padded_sentence = np.concatenate((self.pre_padding,
+                                              sentence,
+                                              self.pos_padding))
 
         # run through all windows in the sentence
         for i in xrange(len(sentence)):
@@ -337,59 +590,143 @@ Output size: %d
         Calculates a matrix with the scores for all possible paths at all given
         points (tokens).
         In the returned matrix, delta[i][j] means the sum of all scores 
-        ending in token i with tag j (delta_i(j) in eq. 14 in the paper)
-        """
-        # scores[t][k] = ftheta_k,t
-        delta = scores
-        # logadd for first token. the transition score of the starting tag must be used.
-        # it turns out that logadd = log(exp(score)) = score
-        # transitions[-1] represents initial transition, A_0,i in paper (mispelled as A_i,0)
-        # delta_0(k) = ftheta_k,0 + A_0,i
-        delta[0] += self.transitions[-1]
-        
-        # logadd for the remaining tokens
-        # delta_t(k) = ftheta_k,t + logadd_i(delta_t-1(i) + A_i,k)
-        #            = ftheta_k,t + log(Sum_i(exp(delta_t-1(i) + A_i,k)))
-        transitions = self.transitions[:-1] # A_i,k
-        for token in xrange(1, len(delta)):
-            # add and sum by columns
-            #logadd = np.log(np.sum(np.exp(delta[token - 1] + transitions), 1))
-            logadd = logsumexp(delta[token - 1][:,np.newaxis] + transitions, 0)
-            delta[token] += logadd
-            
+        ending in token i with tag j (delta_i(j) in eq. 14 in the paper).
+        The given scores are not modified.
+        """
+        delta = np.empty_like(scores, np.double)
+        sll_forward(np.asarray(scores, np.double), self.transitions, delta)
         return delta
 
-    @cython.boundscheck(False)
+    def _create_workspace(self, int max_length):
+        """
+        Allocates the buffers used to train with sentences of up to max_length 
+        tokens (or mini-batches with up to max_length tokens in total), all of
+        them in a single array. Training then works on views of them, without
+        allocating arrays sentence by sentence.
+        """
+        self.workspace_length = max_length
+        (self.input_workspace, self.layer2_workspace, self.hidden_workspace,
+         self.scores_workspace, self.sll_delta, self.sll_gradients) = \
+            workspace_views([(max_length, self.input_size),
+                             (max_length, self.hidden_size),
+                             (max_length, self.hidden_size),
+                             (max_length, self.output_size),
+                             (max_length, self.output_size),
+                             (max_length, self.output_size)])
+        self._create_padded_workspace(max_length)
+
+    def _create_padded_workspace(self, int max_length):
+        """
+        Allocates the buffers for padded sentences of up to max_length tokens
+        and for the transition gradients.
+        """
+        self.padded_workspace = np.empty((max_length + self._padding_size(),
+                                          len(self.feature_tables)), np.int)
+        self.starts_workspace = np.arange(max_length)
+        if self.transitions is not None:
+            self.trans_gradients = np.empty_like(self.transitions, np.double)
+
+    def _ensure_workspace(self, int length):
+        """
+        Makes sure the training workspace has room for the given number of tokens.
+        """
+        if length > self.workspace_length:
+            self._create_workspace(length)
+
+    def _pad_sentence(self, np.ndarray sentence):
+        """
+        Copies the sentence with its padding to the workspace.
+        
+        :return: a view of the workspace with the padded sentence.
+        """
+        cdef int length = len(sentence)
+        cdef int pre = self.word_window_size / 2
+        cdef np.ndarray padded = self.padded_workspace[:length + self._padding_size()]
+        
+        padded[pre:pre + length] = sentence
+        if self.word_window_size > 1:
+            padded[:pre] = self.pre_padding
+            padded[pre + length:] = self.pos_padding
+        
+        return padded
+
     def _calculate_gradients_sll(self, tags, scores):
         """
         Calculates the output and transition deltas for each token, using Sentence Level Likelihood.
         The aim is to minimize the cost:
         C(theta,A) = logadd(scores for all possible paths) - score(correct path)
         
+        The net_gradients are a view of a workspace reused by the following calls.
+        If the network has no transitions, Word Level Likelihood is used instead.
+        
         :returns: if True, normal gradient calculation was performed.
             If False, the error was too low and weight correction should be
             skipped.
         """
-        cdef np.ndarray[FLOAT_t, ndim=2] delta # (len(sentence), output_size)
-        cdef np.ndarray[FLOAT_t, ndim=2] path_scores # (output_size, output_size)
+        if self.transitions is None:
+            return self._calculate_gradients_wll(tags, scores)
         
-        # ftheta_i,t = network output for i-th tag, at t-th word
-        # s = Sum_i(A_tags[i-1],tags[i] + ftheta_i,i), i < len(sentence)   (12)
-        correct_path_score = 0
-        last_tag = self.output_size
-        for tag, net_scores in izip(tags, scores):
-            trans = 0 if self.transitions is None else self.transitions[last_tag, tag]
-            correct_path_score += trans + net_scores[tag]
-            last_tag = tag
+        self._ensure_workspace(len(scores))
+        self.trans_gradients.fill(0)
+        if not self._sentence_gradients_sll(np.asarray(tags, np.int), scores, 
+                                            self.sll_gradients):
+            return False
         
-        # delta[t] = delta_t in equation (14)
-        delta = self._calculate_delta(scores)
+        self.net_gradients = self.sll_gradients[:len(scores)]
+        return True
+
+    def _calculate_gradients_sll_batch(self, list tags, np.ndarray scores,
+                                       np.ndarray offsets):
+        """
+        Calculates the output and transition deltas for a mini-batch of sentences,
+        using Sentence Level Likelihood. Each sentence has its own cost, and the
+        transition deltas of all of them are summed. The rows of sentences whose 
+        error is too low are left as zeros.
+        
+        :param tags: the correct tags of each sentence.
+        :param scores: the scores for all tokens of all sentences, one after the other.
+        :param offsets: the position in scores of the first token of each sentence,
+            followed by len(scores).
+        :returns: if True, at least one sentence needs weight correction.
+        """
+        cdef int i
+        correction = False
+        
+        self._ensure_workspace(len(scores))
+        self.trans_gradients.fill(0)
+        gradients = self.sll_gradients[:len(scores)]
+        
+        for i, sent_tags in enumerate(tags):
+            sent_gradients = gradients[offsets[i]:offsets[i + 1]]
+            if self._sentence_gradients_sll(np.asarray(sent_tags, np.int),
+                                            scores[offsets[i]:offsets[i + 1]],
+                                            sent_gradients):
+                correction = True
+            else:
+                sent_gradients.fill(0)
+        
+        self.net_gradients = gradients
+        return correction
 
-        # logadd_i(delta_T(i)) = log(Sum_i(exp(delta_T(i))))
+    def _sentence_gradients_sll(self, np.ndarray[INT_t, ndim=1] tags, 
+                                np.ndarray scores, np.ndarray gradients):
+        """
+        Runs the SLL kernel for one sentence, writing the output deltas to 
+        gradients and adding the transition deltas to self.trans_gradients.
+        
+        :returns: if False, the error was too low and gradients were not computed.
+        """
+        cdef FLOAT_t[:, :] sent_scores = np.asarray(scores, np.double)
+        cdef FLOAT_t[:, :] delta = self.sll_delta
+        cdef double error
+        
+        # delta[t] = delta_t in equation (14)
+        sll_forward(sent_scores, self.transitions, delta)
+        
         # Sentence-level Log-Likelihood (SLL)
         # C(ftheta,A) = logadd_j(s(x, j, theta, A)) - score(correct path)
-        #error = np.log(np.sum(np.exp(delta[-1]))) - correct_path_score
-        error = logsumexp(delta[-1]) - correct_path_score
+        error = sll_logadd(delta[len(tags) - 1]) - \
+            sll_path_score(sent_scores, tags, self.transitions)
         self.error += error
         
         # if the error is too low, don't bother training (saves time and avoids
@@ -402,64 +739,9 @@ Output size: %d
             self.skips += 1
             return False
         
-        # initialize gradients
-        # dC / dftheta
-        self.net_gradients = np.zeros((len(tags), self.output_size))
-        # dC / dA
-        self.trans_gradients = np.zeros_like(self.transitions, np.double)
-        
-        # things get nasty from here
         # refer to the papers to understand what exactly is going on
-        
-        # compute the gradients for the last token
-        # dC_logadd / ddelta_T(i) = e(delta_T(i))/Sum_k(e(delta_T(k)))
-        # negative gradients
-        self.net_gradients[-1] = -softmax(delta[-1])
-
-        transitions_t = 0 if self.transitions is None else self.transitions[:-1].T
-        
-        # delta[i][j]: sum of scores of all path that assign tag j to ith-token
-
-        # now compute the gradients for the other tokens, from last to first
-        for t in range(len(scores) - 2, -1, -1):
-            
-            # sum the scores for all paths ending with each tag i at token t
-            # with the transitions from tag i to the next tag j
-            # Obtained by transposing twice
-            # [delta_t-1(i)+A_j,i]T
-            path_scores = (delta[t] + transitions_t).T
-
-            # normalize over all possible tag paths using a softmax,
-            # along the columns.
-            # softmax is the division of an exponential by the sum of all exponentials
-            # (yields a probability)
-            # e(delta_t-1(i)+A_i,j) / Sum_k e(delta_t-1(k)+A_k,j)
-            path_scores = softmax(path_scores)
-
-            # multiply each value in the softmax by the gradient at the next tag
-            # dC_logadd / ddelta_t(i) * path_scores
-            # Attardi: negative since net_gradients[t + 1] already negative
-            grad_times_softmax = self.net_gradients[t + 1] * path_scores
-            # dC / dA_i,j
-            self.trans_gradients[:-1, :] += grad_times_softmax
-            
-            # sum all transition gradients by row to find the network gradients
-            # Sum_j(dC_logadd / ddelta_t(j) * path_scores(j))
-            # Attardi: negative since grad_times_softmax already negative
-            self.net_gradients[t] = np.sum(grad_times_softmax, 1)
-
-        # find the gradients for the starting transition
-        # there is only one possibility to come from, which is the sentence start
-        self.trans_gradients[-1] = self.net_gradients[0]
-        
-        # now, add +1 to the correct path
-        last_tag = self.output_size
-        for token, tag in enumerate(tags):
-            self.net_gradients[token][tag] += 1 # negative gradient
-            if self.transitions is not None:
-                self.trans_gradients[last_tag][tag] += 1 # negative gradient
-            last_tag = tag
-        
+        sll_backward(sent_scores, tags, self.transitions, delta,
+                     gradients, self.trans_gradients)
         return True
 
     @cython.boundscheck(False)
@@ -544,57 +826,144 @@ Output size: %d
         answer[0] = previous_tag
         return answer
     
-    def train(self, list sentences, list tags, 
+    def train(self, sentences, tags, 
               int epochs, int epochs_between_reports=0,
-              float desired_accuracy=0):
+              float desired_accuracy=0, int batch_size=1,
+              int num_workers=1, int sync_interval=10, int chunk_size=0,
+              int prefetch=0):
         """
         Trains the network to tag sentences.
         
-        :param sentences: a list of 2-dim numpy arrays, where each item 
-            encodes a sentence. Each item in a sentence has the 
+        :param sentences: a list (or RaggedArray) of 2-dim numpy arrays, where 
+            each item encodes a sentence. Each item in a sentence has the 
             indices to its features.
-        :param tags: a list of 1-dim numpy arrays, where each item has
-            the tags of the sentences.
+        :param tags: a list (or RaggedArray) of 1-dim numpy arrays, where each 
+            item has the tags of the sentences.
         :param epochs: number of training epochs
         :param epochs_between_reports: number of epochs to wait between
             reports about the training performance. 0 means no reports.
         :param desired_accuracy: training stops if the desired accuracy
             is reached. Ignored if 0.
+        :param batch_size: number of sentences whose gradients are summed
+            before adjusting weights and features. 1 means adjusting after 
+            each sentence.
+        :param num_workers: number of processes training at the same time,
+            each one with its share of the sentences.
+        :param sync_interval: number of batches each process trains on 
+            before the changes of all of them are put together.
+        :param chunk_size: if greater than 0, sentences are shuffled in
+            chunks of this number of consecutive ones. Chunks are visited in
+            random order and the sentences inside each one are shuffled, so
+            that a memory mapped corpus is read one chunk at a time.
+        :param prefetch: if greater than 0, mini-batches are prepared (padded 
+            and with their tags gathered) in a background thread, up to this 
+            number of batches ahead of the one being trained on. 
         """
+        if batch_size < 1:
+            raise ValueError("Invalid batch size: %d" % batch_size)
+        if num_workers < 1:
+            raise ValueError("Invalid number of workers: %d" % num_workers)
+        if sync_interval < 1:
+            raise ValueError("Invalid sync interval: %d" % sync_interval)
+        if chunk_size < 0:
+            raise ValueError("Invalid chunk size: %d" % chunk_size)
+        if prefetch < 0:
+            raise ValueError("Invalid number of batches to prefetch: %d" % prefetch)
+        
+        # room for the longest sentence, or the longest possible batch
+        lengths = sorted(len(sentence) for sentence in sentences)
+        self._create_workspace(sum(lengths[-batch_size:]))
+        
         logger = logging.getLogger("Logger")
         logger.info("Training for up to %d epochs" % epochs)
-        top_accuracy = 0
-        last_accuracy = 0
-        min_error = np.Infinity 
-        last_error = np.Infinity 
+        self._start_training(len(sentences))
         
         np.seterr(all='raise')
 
-        for i in xrange(epochs):
-            self._train_epoch(sentences, tags)
+        for i in xrange(self.epoch, epochs):
+            self._train_epoch(sentences, tags, self.order, batch_size, num_workers, 
+                              sync_interval, chunk_size, prefetch)
+            self.epoch = i + 1
             
             # normalize error
             self.error = self.error / self.train_items if self.train_items else np.Infinity
-            # Attardi: save model
-            if self.error < min_error:
-                min_error = self.error
-                self.saver(self)
 
-            if self.accuracy > top_accuracy:
-                top_accuracy = self.accuracy
+            if self.accuracy > self.top_accuracy:
+                self.top_accuracy = self.accuracy
             
-            if (epochs_between_reports > 0 and i % epochs_between_reports == 0) \
-                or self.accuracy >= desired_accuracy > 0 \
-                or (self.accuracy < last_accuracy and self.error > last_error):
-                
+            # stop if the desired accuracy was reached or the network is diverging
+            stop = self.accuracy >= desired_accuracy > 0 \
+                or (self.accuracy < self.last_accuracy and self.error > self.last_error)
+            
+            if (epochs_between_reports > 0 and i % epochs_between_reports == 0) or stop:
                 self._epoch_report(i + 1)
-                
-                if self.accuracy >= desired_accuracy > 0 \
-                        or (self.error > last_error and self.accuracy < last_accuracy):
-                    break
-                
-            last_accuracy = self.accuracy
-            last_error = self.error
+            
+            self.last_accuracy = self.accuracy
+            self.last_error = self.error
+            
+            # Attardi: save model
+            # (after updating the progress, which is saved with it)
+            if self.error < self.min_error:
+                self.min_error = self.error
+                self.saver(self)
+            
+            if stop:
+                break
+    
+    def _start_training(self, int num_sentences):
+        """
+        Sets the training progress for a new run, or restores the one given
+        to set_training_state().
+        """
+        state = self.resume_state
+        self.resume_state = None
+        if state is None:
+            # sentences are visited in this order, shuffled in each epoch
+            self.order = np.arange(num_sentences)
+            self.epoch = 0
+            self.top_accuracy = 0
+            self.last_accuracy = 0
+            self.min_error = np.Infinity
+            self.last_error = np.Infinity
+            return
+        
+        if len(state['order']) != num_sentences:
+            raise ValueError("Training state saved with a different number of sentences: %d"
+                             % len(state['order']))
+        
+        self.order = np.array(state['order'])
+        self.epoch = state['epoch']
+        self.top_accuracy = state['top_accuracy']
+        self.last_accuracy = state['last_accuracy']
+        self.min_error = state['min_error']
+        self.last_error = state['last_error']
+        np.random.set_state(checkpoint.random_states(state, 'random')[0])
+        
+        logger = logging.getLogger("Logger")
+        logger.info("Resuming training after %d epochs" % self.epoch)
+    
+    def get_training_state(self):
+        """
+        Returns a dictionary of arrays with the state of training that isn't
+        in the network parameters: the number of epochs trained, the best and
+        last results, the order of the sentences and the state of the random
+        number generator. It can be saved with numpy.savez and given to
+        set_training_state() to resume training.
+        """
+        state = dict(epoch=self.epoch, top_accuracy=self.top_accuracy,
+                     last_accuracy=self.last_accuracy, min_error=self.min_error,
+                     last_error=self.last_error, order=self.order)
+        state.update(checkpoint.random_state_arrays('random', [np.random.get_state()]))
+        
+        return state
+    
+    def set_training_state(self, state):
+        """
+        Sets a state returned by get_training_state() (or loaded from a file
+        where it was saved), so that the next call to train() continues from
+        it instead of starting over. It must be called with the same data.
+        """
+        self.resume_state = dict(state)
             
     def _epoch_report(self, int num):
         """
@@ -610,9 +979,14 @@ Output size: %d
         logger.info("%d epochs   Error: %f   Accuracy: %f%s" \
                         % (num, self.error, self.accuracy, msg))
     
-    def _train_epoch(self, list sentences, list tags):
+    def _train_epoch(self, sentences, tags, np.ndarray order, int batch_size=1,
+                     int num_workers=1, int sync_interval=10, int chunk_size=0,
+                     int prefetch=0):
         """
         Trains for one epoch with all examples.
+        
+        :param order: the indices of all sentences. It is shuffled in place,
+            leaving sentences and tags untouched.
         """
         self.error = 0
         self.skips = 0
@@ -620,35 +994,229 @@ Output size: %d
         self.train_items = 0
         
         # shuffle data
-        # get the random number generator state in order to shuffle
-        # sentences and their tags in the same order
-        random_state = np.random.get_state()
-        np.random.shuffle(sentences)
-        np.random.set_state(random_state)
-        np.random.shuffle(tags)
+        if chunk_size > 0:
+            self._shuffle_chunks(order, chunk_size)
+        else:
+            np.random.shuffle(order)
         
         # keep last 2% for validation
-        validation = int((len(sentences) - 1) * 0.98) + 1 # at least 1
+        validation = int((len(order) - 1) * 0.98) + 1 # at least 1
 
-        i = 0
-        for sent, sent_tags in izip(sentences, tags):
+        if num_workers > 1:
+            self._train_parallel(sentences, tags, order[:validation],
+                                 batch_size, num_workers, sync_interval, prefetch)
+        else:
+            self._train_sentences(sentences, tags, order[:validation], batch_size,
+                                  prefetch)
+
+        self._validate(sentences, tags, order[validation:])
+
+    def _shuffle_chunks(self, np.ndarray order, int chunk_size):
+        """
+        Fills order with the indices of all sentences, keeping together the 
+        ones in each chunk of chunk_size consecutive sentences. Chunks are 
+        shuffled, and so are the sentences inside each chunk.
+        """
+        cdef int num_sentences = len(order)
+        cdef int position = 0
+        cdef int start, end
+        
+        chunks = np.arange(0, num_sentences, chunk_size)
+        np.random.shuffle(chunks)
+        for start in chunks:
+            end = min(start + chunk_size, num_sentences)
+            chunk = order[position:position + end - start]
+            chunk[:] = np.arange(start, end)
+            np.random.shuffle(chunk)
+            position += end - start
+    
+    def _train_sentences(self, sentences, tags, np.ndarray positions, int batch_size=1,
+                         int prefetch=0):
+        """
+        Trains with the sentences at the given positions, in their order, 
+        adjusting the network after each batch.
+        
+        :param prefetch: number of batches that may be prepared in advance
+            in a background thread.
+        """
+        cdef int i
+        if batch_size > 1:
+            batches = [positions[i:i + batch_size] 
+                       for i in xrange(0, len(positions), batch_size)]
+            prepare = lambda batch: self._prepare_batch(sentences, tags, batch)
+            for padded, starts, offsets, batch_tags in parallel.prefetch(prepare, batches,
+                                                                         prefetch):
+                self._train_batch(padded, starts, offsets, batch_tags)
+            return
+        
+        for i in positions:
+            sent = sentences[i]
             try:
-                self._tag_sentence(sent, True, sent_tags)
+                self._tag_sentence(sent, True, tags[i])
                 self.train_items += len(sent)
             except FloatingPointError:
                 # just ignore the sentence in case of an overflow
                 self.float_errors += 1
-            i += 1
-            if i == validation:
-                break
 
-        self._validate(sentences, tags, validation)
+    def _dense_parameters(self):
+        """
+        Returns a list with the weight matrices and bias vectors of the network
+        (and the transitions, if used). Feature tables are not included.
+        """
+        parameters = [self.hidden_weights, self.hidden_bias,
+                      self.output_weights, self.output_bias]
+        if self.transitions is not None:
+            parameters.append(self.transitions)
+        
+        return parameters
 
-    def _validate(self, sentences, tags, idx):
-        """Perform validation on held out data and estimate accuracy"""
+    def _train_parallel(self, sentences, tags, np.ndarray positions, int batch_size,
+                        int num_workers, int sync_interval, int prefetch=0):
+        """
+        Trains with the sentences at the given positions in many processes. Each
+        one has its own copy of the network and trains with its own share of them.
+        Every sync_interval batches, all processes add their changes to shared
+        copies of the parameters and then continue from them. Changes to weights
+        are averaged, while changes to feature table rows are summed.
+        """
+        logger = logging.getLogger("Logger")
+        logger.debug("Training with %d processes" % num_workers)
+        
+        shared_dense = [parallel.shared_copy(p) for p in self._dense_parameters()]
+        shared_tables = [parallel.shared_copy(table) for table in self.feature_tables]
+        lock = multiprocessing.Lock()
+        barrier = parallel.Barrier(num_workers)
+        
+        # all processes must go through the same number of synchronizations
+        shard_size = (len(positions) + num_workers - 1) / num_workers
+        round_size = batch_size * sync_interval
+        num_rounds = (shard_size + round_size - 1) / round_size
+        
+        # each process has its own random seed, drawn from the current state
+        seeds = np.random.randint(0, 2 ** 31 - 1, num_workers)
+        
+        args = (sentences, tags, positions, batch_size, num_workers, round_size, num_rounds,
+                shared_dense, shared_tables, lock, barrier, seeds, prefetch)
+        results = parallel.run_workers(self._train_worker, args, num_workers, barrier)
+        
+        for parameter, shared in izip(self._dense_parameters(), shared_dense):
+            parameter[...] = shared
+        for table, shared in izip(self.feature_tables, shared_tables):
+            table[...] = shared
+        
+        for error, skips, float_errors, train_items in results:
+            self.error += error
+            self.skips += skips
+            self.float_errors += float_errors
+            self.train_items += train_items
+
+    def _train_worker(self, int worker, sentences, tags, np.ndarray positions, int batch_size,
+                      int num_workers, int round_size, int num_rounds,
+                      list shared_dense, list shared_tables, lock, barrier, seeds,
+                      int prefetch=0):
+        """
+        Training loop of each process started by _train_parallel. The network
+        here is a copy of the one in the parent process.
+
+        :return: the training statistics (error, skips, float_errors, train_items)
+        """
+        cdef int i, start
+        np.random.seed(seeds[worker])
+        
+        # worker i takes sentences i, i + num_workers, i + 2 * num_workers...
+        positions = positions[worker::num_workers]
+        dense = self._dense_parameters()
+        
+        for i in xrange(num_rounds):
+            start = i * round_size
+            round_positions = positions[start:start + round_size]
+            
+            # the feature table rows that may change in this round
+            if len(round_positions):
+                padded = self._padded_windows([sentences[j] for j in round_positions])[0]
+                rows = [np.unique(padded[:, t]) for t in xrange(len(self.feature_tables))]
+            else:
+                rows = [np.array([], np.int) for _ in self.feature_tables]
+            
+            dense_before = [parameter.copy() for parameter in dense]
+            rows_before = [table[table_rows] for table, table_rows in izip(self.feature_tables, rows)]
+            
+            self._train_sentences(sentences, tags, round_positions, batch_size, prefetch)
+            
+            with lock:
+                for shared, parameter, before in izip(shared_dense, dense, dense_before):
+                    shared += (parameter - before) / num_workers
+                
+                for shared, table, table_rows, before in izip(shared_tables, self.feature_tables,
+                                                              rows, rows_before):
+                    shared[table_rows] += table[table_rows] - before
+            
+            # wait for all processes before reading the new values, 
+            # and again before anyone changes them
+            barrier.wait()
+            for parameter, shared in izip(dense, shared_dense):
+                parameter[...] = shared
+            for table, shared in izip(self.feature_tables, shared_tables):
+                table[...] = shared
+            barrier.wait()
+        
+        return (self.error, self.skips, self.float_errors, self.train_items)
+
+    def _prepare_batch(self, sentences, tags, np.ndarray positions):
+        """
+        Prepares a mini-batch of the sentences at the given positions for 
+        _train_batch. It doesn't touch the network state, so it may run in 
+        another thread while the network trains on the previous batch.
+        
+        :return: a tuple (padded, starts, offsets, tags), with the first three 
+            as returned by _padded_windows and the tags of each sentence.
+        """
+        padded, starts, offsets = self._padded_windows([sentences[i] for i in positions])
+        batch_tags = [np.asarray(tags[i], np.int) for i in positions]
+        
+        return padded, starts, offsets, batch_tags
+    
+    def _train_batch(self, np.ndarray padded, np.ndarray starts, np.ndarray offsets, 
+                     list tags):
+        """
+        Trains with a mini-batch prepared by _prepare_batch. All windows in the
+        batch go through each layer with a single matrix product, and the 
+        weights, transitions and features are adjusted once with the summed 
+        gradients.
+        """
+        cdef int num_tokens = len(starts)
+        self._ensure_workspace(num_tokens)
+        self.layer2_sent_values = self.layer2_workspace[:num_tokens]
+        self.hidden_sent_values = self.hidden_workspace[:num_tokens]
+        scores = self.scores_workspace[:num_tokens]
+        
+        try:
+            # (total_tokens, input_size)
+            self.input_sent_values = self._lookup_windows(padded, starts)
+            # (total_tokens, input_size) (input_size, hidden_size) = (total_tokens, hidden_size)
+            np.dot(self.input_sent_values, self.hidden_weights.T, out=self.layer2_sent_values)
+            self.layer2_sent_values += self.hidden_bias
+            # hardtanh
+            np.clip(self.layer2_sent_values, -1, 1, out=self.hidden_sent_values)
+            np.dot(self.hidden_sent_values, self.output_weights.T, out=scores)
+            scores += self.output_bias
+            
+            # sentences have their own SLL gradients, which are then put together
+            if self._calculate_gradients_sll_batch(tags, scores, offsets):
+                self._backpropagate_windows(padded, starts)
+            self.train_items += len(scores)
+        except FloatingPointError:
+            # just ignore the batch in case of an overflow
+            self.float_errors += len(tags)
+    
+    def _validate(self, sentences, tags, np.ndarray positions):
+        """
+        Perform validation on held out data (the sentences at the given positions)
+        and estimate accuracy
+        """
         tokens = 0
         hits = 0
-        for i in xrange(idx, len(sentences)):
+        for i in positions:
             sent = sentences[i]
             gold_tags = tags[i]
             scores = self._tag_sentence(sent, False)
@@ -664,7 +1232,20 @@ Output size: %d
 
     def _backpropagate(self, sentence):
         """
-        Backpropagate the gradients of the cost.
+        Backpropagate the gradients of the cost of the sentence last tagged
+        in training, whose padding is still in the workspace.
+        """
+        cdef int length = len(sentence)
+        padded_sentence = self.padded_workspace[:length + self._padding_size()]
+        self._backpropagate_windows(padded_sentence, self.starts_workspace[:length])
+
+    def _backpropagate_windows(self, np.ndarray padded, np.ndarray starts):
+        """
+        Backpropagate the gradients of the cost for a sequence of windows,
+        possibly from different sentences.
+
+        :param padded: the padded tokens the windows come from.
+        :param starts: the position in padded of the first token of each window.
         """
         # f_1 = input_sent_values
         # f_2 = M_1 f_1 + b_2 = layer2_sent_values
@@ -737,43 +1318,50 @@ Output size: %d
         # (len, input_size)
         input_deltas = input_gradients * self.learning_rate_features
         
-        padded_sentence = np.concatenate((self.pre_padding,
-                                          sentence,
-                                          self.pos_padding))
-        
-        cdef np.ndarray[INT_t, ndim=1] features
-        cdef np.ndarray[FLOAT_t, ndim=2] table
+        cdef np.ndarray[FLOAT_t, ndim=2] table, token_deltas
+        cdef int features_per_token = self.input_size / self.word_window_size
         cdef int start, end, t
         cdef int i
 
-        for i, w_deltas in enumerate(input_deltas):
-            # for each window (w_deltas: 300, features: 5)
-            # this tracks where the deltas for the next table begins
-            start = 0
-            for features in padded_sentence[i:i+self.word_window_size]:
-                # select the columns for each feature_tables (t: 3)
-                for t, table in enumerate(self.feature_tables):
-                    end = start + table.shape[1]
-                    table[features[t]] += w_deltas[start:end]
-                    start = end
+        # sum the deltas for each padded token over all the windows it appears in
+        # (num padded tokens, features_per_token)
+        token_deltas = np.zeros((len(padded), features_per_token))
+        for i in xrange(self.word_window_size):
+            start = i * features_per_token
+            token_deltas[starts + i] += input_deltas[:, start:start + features_per_token]
+        
+        # select the columns for each feature_tables (t: 3)
+        # the same feature may be used by many tokens
+        start = 0
+        for t, table in enumerate(self.feature_tables):
+            end = start + table.shape[1]
+            scatter_add(table, padded[:, t], token_deltas[:, start:end])
+            start = end
 
         # Adjusts the transition scores table with the calculated gradients.
         if self.transitions is not None:
             self.transitions += self.trans_gradients * self.learning_rate_trans
 
+    def get_saved_arrays(self):
+        """
+        Returns a dictionary with the arrays saved by save(), which can also
+        be written with numpy.savez.
+        """
+        return dict(hidden_weights=self.hidden_weights,
+                    output_weights=self.output_weights,
+                    hidden_bias=self.hidden_bias, output_bias=self.output_bias,
+                    word_window_size=self.word_window_size, 
+                    input_size=self.input_size, hidden_size=self.hidden_size,
+                    output_size=self.output_size, padding_left=self.padding_left,
+                    padding_right=self.padding_right, transitions=self.transitions)
+    
     def save(self, filename):
         """
         Saves the neural network to a file.
         It will save the weights, biases, sizes, padding and 
         distance tables, but not other feature tables.
         """
-        np.savez(filename, hidden_weights=self.hidden_weights,
-                 output_weights=self.output_weights,
-                 hidden_bias=self.hidden_bias, output_bias=self.output_bias,
-                 word_window_size=self.word_window_size, 
-                 input_size=self.input_size, hidden_size=self.hidden_size,
-                 output_size=self.output_size, padding_left=self.padding_left,
-                 padding_right=self.padding_right, transitions=self.transitions)
+        np.savez(filename, **self.get_saved_arrays())
     
     @classmethod
     def load_from_file(cls, filename):
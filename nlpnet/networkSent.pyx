@@ -80,21 +80,18 @@ cdef class SentimentModel(LanguageModel):
         # token[0] is the list with the WordDictionary index of the word
         middle_token = example[self.half_window]
 
-        if size == 1:
-	   # ensure to generate a different word
-            while True:
-                variant = self._generate_token()
-                if variant[0] != middle_token[0]:
-                    break
+        # ensure to generate a different word
+        while True:
+            variant = self.sampler.next()
+            if variant[0] != middle_token[0]:
+                break
 
         pos_input_values = self.lookup(example)
         pos_score = self.run(pos_input_values)
         pos_hidden_values = self.hidden_values
         
         negative_token = np.array(variant)
-        example[self.half_window] = negative_token
-        neg_input_values = self.lookup(example)
-        neg_score = self.run(neg_input_values)
+        neg_input_values, neg_score = self._run_negative(pos_input_values, negative_token)
         
         errorCW = max(0, 1 - pos_score[0] + neg_score[0])
         errorUS = max(0, 1 - polarity * pos_score[1] + polarity * neg_score[1])
@@ -184,37 +181,68 @@ cdef class SentimentModel(LanguageModel):
                 
                 offset += table.shape[1]
     
-    def train(self, list sentences, int epochs, int iterations_between_reports, list polarities, ngram_dict):
+    def train(self, list sentences, int epochs, int iterations_between_reports, list polarities, ngram_dict,
+              int ngrams=1, double sampling_power=0.75):
         """
         Trains the sentiment language model on the given sentences.
         :param sentences: list of token IDs for each sentence
         :param iterations: number of train iterations
         :param polarities: the polarity of each sentence, +-1.
         :param ngram_dixt: the dictionary of the ngrams on the corpus
+        :param ngrams: maximum length of the ngrams in the center of windows (up to 3)
+        :param sampling_power: negative examples are drawn with probability
+            proportional to word frequencies raised to this power.
         """
-        # generate 1000 random indices at a time to save time
-        # (generating 1000 integers at once takes about ten times the time for a single one)
-        self.random_pool = RandomPool(self.feature_tables)
+        state = self.resume_state
+        self.resume_state = None
+        
+        self.sampler = NegativeSampler(sentences, self.feature_tables[0].shape[0],
+                                       sampling_power)
         self.total_items = 0
+        self.epoch = 0
+        
+        if self.neg_hidden_adagrads is None:
+            # not saved with the network
+            self.neg_hidden_adagrads = np.zeros(self.hidden_size, dtype=FLOAT)
+            self.pos_hidden_adagrads = np.zeros(self.hidden_size, dtype=FLOAT)
+        
+        # number of examples of the first epoch already trained on
+        skip = 0
+        if state is not None:
+            skip = self._restore_progress(state)
+            self.neg_hidden_adagrads = np.array(state['neg_hidden_adagrads'])
+            self.pos_hidden_adagrads = np.array(state['pos_hidden_adagrads'])
+            self.alpha = state['alpha']
+            np.random.set_state(checkpoint.random_states(state, 'random')[0])
+        
+        # the ngram ids are found once for all epochs
+        lattice = self._ngram_lattice(sentences, ngram_dict, ngrams)
 
         # how often to save model
-        save_period = 1000 * RandomPool_size
+        save_period = 1000 * SampleBlock_size
 
-        all_cases = sum([len(sen) for sen in sentences]) * epochs * self.ngrams
+        all_cases = sum([len(sen) for sen in sentences]) * epochs * ngrams
 
-        for epoch in xrange(self.epochs):
-            self.error = 0.0
-            self.skips = 0
+        for epoch in xrange(self.epoch, epochs):
+            self.epoch = epoch
             epoch_examples = 0
-            # update LR by fan-in
-            # decrease linearly by remaining
-            remaining = 1.0 - (self.total_items / float(all_cases))
-            self.LR_0 = max(0.001, self.learning_rate * remaining)
-            self.LR_1 = max(0.001, self.learning_rate / self.input_size * remaining)
-            self.LR_2 = max(0.001, self.learning_rate / self.hidden_size * remaining)
+            if not skip:
+                self.error = 0.0
+                self.skips = 0
+                self.epoch_start_items = self.total_items
+                # update LR by fan-in
+                # decrease linearly by remaining
+                remaining = 1.0 - (self.total_items / float(all_cases))
+                self.LR_0 = max(0.001, self.learning_rate * remaining)
+                self.LR_1 = max(0.001, self.learning_rate / self.input_size * remaining)
+                self.LR_2 = max(0.001, self.learning_rate / self.hidden_size * remaining)
 
-            for num, sentence in enumerate(sentences):
-                for pos in xrange(len(sentence)):
+            for num, (padded, ngram_ids) in enumerate(lattice):
+                for pos in xrange(len(ngram_ids)):
+                    if epoch_examples < skip:
+                        # trained on before resuming
+                        epoch_examples += 1
+                        continue
                 
                     # ngram size changes periodically
                     if self.total_items:
@@ -226,9 +254,10 @@ cdef class SentimentModel(LanguageModel):
                             size = 1
                     else:
                         size = 1
+                    size = min(size, ngrams)
 
                     # extract a window of tokens around the given position
-                    window = self._extract_window(sentence, pos, size, ngram_dict)
+                    window = self._extract_window(padded, ngram_ids, pos, size)
 
                     self._train_pair(window, polarities[num], size)
                     epoch_examples += 1
@@ -239,40 +268,72 @@ cdef class SentimentModel(LanguageModel):
                         self._progress_report(epoch, epoch_examples)
                         # save language model. Attardi
                         if save_period and self.total_items % save_period == 0:
-                            utils.save_features_to_file(self.feature_tables[0], self.filename)
+                            self.saver(self)
+            skip = 0
+    
+    def get_training_state(self):
+        """
+        Returns a dictionary of arrays with the state of training, including
+        the AdaGrad accumulators. See LanguageModel.get_training_state().
+        """
+        state = LanguageModel.get_training_state(self)
+        state.update(neg_hidden_adagrads=self.neg_hidden_adagrads,
+                     pos_hidden_adagrads=self.pos_hidden_adagrads,
+                     alpha=self.alpha)
+        
+        return state
     
-    def _extract_window(self, sentence, position, size=1, ngram_dict=None):
+    def _ngram_lattice(self, list sentences, ngram_dict, int max_size):
+        """
+        Pads each sentence and finds the ids of the ngrams starting at each of
+        its positions. Ngrams not in the dictionary, including those with 
+        unknown words or going past the end of the sentence, get the index
+        of the rare token.
+        :param max_size: the maximum ngram length
+        :return: a list with a tuple (padded, ngram_ids) for each sentence.
+            padded has half_window padding tokens before the sentence and
+            enough after it for any window. ngram_ids[i, n - 1] is the id 
+            of the ngram of length n starting at position i.
+        """
+        cdef int i, n
+        num_words = len(ngram_dict.index)
+        pre_padding = np.tile(self.padding_left, (self.half_window, 1))
+        pos_padding = np.tile(self.padding_right, (self.half_window + max_size - 1, 1))
+        
+        lattice = []
+        for sentence in sentences:
+            # (len, max_size)
+            ngram_ids = np.empty((len(sentence), max_size), dtype=sentence.dtype)
+            ngram_ids[:, 0] = sentence[:, 0]
+            
+            # special tokens are not in the index
+            words = [ngram_dict.index[index] if index < num_words else None
+                     for index in sentence[:, 0]]
+            for n in range(2, max_size + 1):
+                for i in range(len(sentence)):
+                    ngram = words[i:i + n]
+                    if len(ngram) < n or None in ngram:
+                        ngram_ids[i, n - 1] = ngram_dict.index_rare
+                    else:
+                        ngram_ids[i, n - 1] = ngram_dict[' '.join(ngram)]
+            
+            padded = np.concatenate((pre_padding, sentence, pos_padding))
+            lattice.append((padded, ngram_ids))
+        
+        return lattice
+    
+    def _extract_window(self, padded, ngram_ids, position, size=1):
         """
         Extracts a window of tokens from the sentence, with size equal to
         the network's window size.
-        This function takes care of creating padding as necessary.
-	:param sentence: the sentence from which to extract the window
+	:param padded: the padded sentence, as returned by _ngram_lattice
+	:param ngram_ids: the ngram ids of the sentence, as returned by _ngram_lattice
 	:param position: the center token position
         :param size: the size of ngram in the center of thw window
 	:return: a portion of sentence centered at position
         """
-        if position < self.half_window:
-            num_padding = self.half_window - position
-            pre_padding = np.array(num_padding * [self.padding_left])
-            sentence = np.vstack((pre_padding, sentence))
-            position += num_padding
-        
-        # number of tokens in the sentence after the position
-        tokens_after = len(sentence) - (position + size)
-        if tokens_after < self.half_window:
-            num_padding = self.half_window - tokens_after
-            pos_padding = np.array(num_padding * [self.padding_right])
-            sentence = np.vstack((sentence, pos_padding))
-        
-        ngram = sentence[position: position + size]
-        if size > 1:
-            # lookup ngram index
-            tokens = ngram_dict.get_words(ngram)
-            ngram = [[ngram_dict[' '.join(tokens)]]] # one feature_table
-
-        return np.concatenate((sentence[position - self.half_window: position], ngram, sentence[position + size: position + size + self.half_window]))
-    
-    @classmethod
-    def load_from_file(cls, filename):
-        # inherit from base class
-        return LanguageModel.load_from_file.__func__(cls, filename)
+        # position is shifted by the padding in padded
+        return np.concatenate((padded[position:position + self.half_window],
+                               ngram_ids[position:position + 1, size - 1:size],
+                               padded[position + self.half_window + size:
+                                      position + size + 2 * self.half_window]))
@@ -32,6 +32,8 @@ cdef class ConvolutionalNetwork(Network):
     # number of targets (all tokens in a sentence or the provided arguments)
     # and variables for argument classifying
     cdef int num_targets
+    # (num_targets, len(sentence)) distance from each token to each target
+    cdef np.ndarray target_distances
     cdef bool only_classify
     
     # for faster access 
@@ -41,6 +43,10 @@ cdef class ConvolutionalNetwork(Network):
     cdef np.ndarray hidden_gradients, hidden2_gradients
     cdef np.ndarray input_deltas
     
+    # training workspace for the values above (see Network._create_workspace)
+    cdef np.ndarray convolution_workspace, hidden2_workspace, max_indices_workspace
+    cdef np.ndarray input_deltas_workspace, grad_workspace
+    
     @classmethod
     def create_new(cls, feature_tables, target_dist_table, pred_dist_table, 
                    int word_window, int hidden1_size, int hidden2_size, int output_size):
@@ -132,25 +138,32 @@ Output size: %d
         self.hidden2_weights = hidden2_weights
         self.hidden2_bias = hidden2_bias
         
+    def get_saved_arrays(self):
+        """
+        Returns a dictionary with the arrays saved by save(), which can also
+        be written with numpy.savez.
+        """
+        return dict(hidden_weights=self.hidden_weights,
+                    target_dist_table=self.target_dist_table,
+                    pred_dist_table=self.pred_dist_table,
+                    target_dist_weights=self.target_dist_weights,
+                    pred_dist_weights=self.pred_dist_weights,
+                    output_weights=self.output_weights,
+                    transitions=self.transitions,
+                    hidden_bias=self.hidden_bias, output_bias=self.output_bias,
+                    word_window_size=self.word_window_size, 
+                    input_size=self.input_size, hidden_size=self.hidden_size,
+                    output_size=self.output_size, hidden2_size=self.hidden2_size,
+                    hidden2_weights=self.hidden2_weights, hidden2_bias=self.hidden2_bias,
+                    padding_left=self.padding_left, padding_right=self.padding_right)
+    
     def save(self, filename):
         """
         Saves the neural network to a file.
         It will save the weights, biases, sizes, padding and 
         distance tables, but not other feature tables.
         """
-        np.savez(filename, hidden_weights=self.hidden_weights,
-                 target_dist_table=self.target_dist_table,
-                 pred_dist_table=self.pred_dist_table,
-                 target_dist_weights=self.target_dist_weights,
-                 pred_dist_weights=self.pred_dist_weights,
-                 output_weights=self.output_weights,
-                 transitions=self.transitions,
-                 hidden_bias=self.hidden_bias, output_bias=self.output_bias,
-                 word_window_size=self.word_window_size, 
-                 input_size=self.input_size, hidden_size=self.hidden_size,
-                 output_size=self.output_size, hidden2_size=self.hidden2_size,
-                 hidden2_weights=self.hidden2_weights, hidden2_bias=self.hidden2_bias,
-                 padding_left=self.padding_left, padding_right=self.padding_right)
+        np.savez(filename, **self.get_saved_arrays())
 
     @classmethod
     def load_from_file(cls, filename):
@@ -197,74 +210,92 @@ Output size: %d
         
         return nn
     
-    def train(self, list sentences, list predicates, list tags,  
+    def train(self, sentences, predicates, list tags,  
               int epochs, int epochs_between_reports=0,
               float desired_accuracy=0, list arguments=None):
         """
         Trains the convolutional network. Refer to the basic Network
         train method for detailed explanation.
         
-        :param predicates: a list of 1-dim numpy array
+        :param predicates: a list (or RaggedArray) of 1-dim numpy array
             indicating the indices of predicates in each sentence.
         :param arguments: (only for argument classifying) a list of 2-dim
             numpy arrays indicating the start and end of each argument. 
         """
         self.only_classify = arguments is not None
+        self._create_workspace(max(len(sentence) for sentence in sentences))
         
         print "Training for up to %d epochs" % epochs
-        last_accuracy = 0
-        last_error = np.Infinity 
+        self._start_training(len(sentences))
         
-        for i in range(epochs):
-            self._train_epoch(sentences, predicates, tags, arguments)
+        for i in range(self.epoch, epochs):
+            self._train_epoch(sentences, predicates, tags, arguments, self.order)
+            self.epoch = i + 1
             self.accuracy = float(self.train_hits) / self.total_items
             
             if (epochs_between_reports > 0 and i % epochs_between_reports == 0) \
                 or self.accuracy >= desired_accuracy > 0 \
-                or (self.accuracy < last_accuracy and self.error > last_error):
+                or (self.accuracy < self.last_accuracy and self.error > self.last_error):
                 
                 self._print_epoch_report(i + 1)
 
                 if self.accuracy >= desired_accuracy > 0:
                     break
                 
-                if self.accuracy < last_accuracy and self.error > last_error:
+                if self.accuracy < self.last_accuracy and self.error > self.last_error:
                     # accuracy is falling, the network is probably diverging
                     break
             
-            last_accuracy = self.accuracy
-            last_error = self.error
+            self.last_accuracy = self.accuracy
+            self.last_error = self.error
         
         self.error = 0
         self.train_hits = 0
         self.total_items = 0
 
-    def _train_epoch(self, sentences, predicates, tags, arguments):
-        """Trains for one epoch with all examples."""
+    def _train_epoch(self, sentences, predicates, tags, arguments, np.ndarray order):
+        """
+        Trains for one epoch with all examples.
+        
+        :param order: the indices of all sentences. It is shuffled in place,
+            leaving the data untouched.
+        """
         self.train_hits = 0
         self.error = 0
         self.total_items = 0
         self.skips = 0
         
         # shuffle data
-        # get the random number generator state in order to shuffle
-        # sentences and their tags in the same order
-        random_state = np.random.get_state()
-        np.random.shuffle(sentences)
-        np.random.set_state(random_state)
-        np.random.shuffle(predicates)
-        np.random.set_state(random_state)
-        np.random.shuffle(tags)
-        if arguments is not None:
-            np.random.set_state(random_state)
-            np.random.shuffle(arguments)
-            i_args = iter(arguments)
-        else:
-            sent_args = None
+        np.random.shuffle(order)
+        sent_args = None
         
-        for sent, sent_preds, sent_tags in izip(sentences, predicates, tags):
-            if arguments is not None: sent_args = i_args.next()
-            self._tag_sentence(sent, sent_preds, True, sent_tags, sent_args)
+        for i in order:
+            if arguments is not None: sent_args = arguments[i]
+            self._tag_sentence(sentences[i], predicates[i], True, tags[i], sent_args)
+    
+    def _create_workspace(self, int max_length):
+        """
+        Allocates the buffers used to train with sentences of up to max_length 
+        tokens. There can't be more targets than tokens, so they also have room
+        for the values of all targets.
+        """
+        cdef int hidden2_size = self.hidden2_size if self.hidden2_weights is not None else 0
+        
+        self.workspace_length = max_length
+        (self.input_workspace, self.input_deltas_workspace, self.convolution_workspace,
+         self.grad_workspace, self.hidden_workspace, self.hidden2_workspace,
+         self.scores_workspace, self.sll_delta, self.sll_gradients) = \
+            workspace_views([(max_length, self.input_size),
+                             (max_length, self.input_size),
+                             (max_length, self.hidden_size),
+                             (max_length, self.hidden_size),
+                             (max_length, self.hidden_size),
+                             (max_length, hidden2_size),
+                             (max_length, self.output_size),
+                             (max_length, self.output_size),
+                             (max_length, self.output_size)])
+        self.max_indices_workspace = np.empty((max_length, self.hidden_size), np.int)
+        self._create_padded_workspace(max_length)
     
     def tag_sentence(self, np.ndarray sentence, np.ndarray predicates, 
                      list arguments=None, bool logprob=False,
@@ -282,53 +313,94 @@ Output size: %d
             argument classes (only for separate argument classification).
         """
         self.only_classify = arguments is not None
-        return self._tag_sentence(sentence, predicates, train=False, arguments=arguments, 
+        return self._tag_sentence(sentence, predicates, train=False, arguments=arguments,
                                   logprob=logprob, allow_repeats=allow_repeats)
-    
-    cdef np.ndarray argument_distances(self, positions, argument):
+
+    def tag_sentences(self, list sentences, list predicates, list arguments=None,
+                      bool logprob=False, bool allow_repeats=True):
         """
-        Calculates the distance from each token in the sentence to the argument.
+        Tags a batch of sentences. The convolution values for the tokens of
+        all sentences are computed with a single matrix product, and then
+        each sentence is processed as in tag_sentence.
+
+        :param sentences: a list of 2-dim numpy arrays, each one encoding a sentence.
+        :param predicates: a list of 1-dim numpy arrays with the positions
+            of the predicates in each sentence.
+        :param arguments: (only for argument classifying) a list with the
+            arguments of each sentence, as expected by tag_sentence.
+        :return: a list with the answer for each sentence.
         """
-        distances = positions.copy()
+        self.only_classify = arguments is not None
+        if not sentences:
+            return []
+
+        inputs, offsets = self._window_inputs(sentences)
+        # (total_tokens, input_size) (input_size, hidden_size) = (total_tokens, hidden_size)
+        convolution_lookup = inputs.dot(self.hidden_weights.T)
+
+        answers = []
+        for i, (sentence, sent_preds) in enumerate(izip(sentences, predicates)):
+            sent_args = None if arguments is None else arguments[i]
+            sent_lookup = convolution_lookup[offsets[i]:offsets[i + 1]]
+            answers.append(self._tag_sentence(sentence, sent_preds, train=False,
+                                              arguments=sent_args, logprob=logprob,
+                                              allow_repeats=allow_repeats,
+                                              convolution_lookup=sent_lookup))
+
+        return answers
+
+    cdef np.ndarray _target_distances(self, int num_tokens, arguments=None):
+        """
+        Calculates the distance from each token in the sentence to each target,
+        all at once. Line i has the distances to the i-th target.
         
-        # the ones before the argument
-        lo = np.less(positions, argument[0])
-        distances[lo] -= argument[0]
+        :param arguments: if None, every token is a target. Otherwise, an array
+            with the (start, end) of each argument. Distances are then taken to
+            the closest boundary of the argument, and are 0 inside it.
+        """
+        positions = np.arange(num_tokens)
+        if arguments is None:
+            return positions - positions[:, np.newaxis]
         
-        # the ones after the argument
-        hi = np.greater(positions, argument[1])
-        distances[hi] -= argument[1]
+        if len(arguments) == 0:
+            return np.empty((0, num_tokens), np.int)
         
-        # the ones inside the argument
-        distances[np.logical_not(hi | lo)] = 0
+        arguments = np.asarray(arguments)
+        starts = arguments[:, 0:1]
+        ends = arguments[:, 1:2]
         
-        return distances
+        # negative before the argument and positive after it
+        return np.minimum(positions - starts, 0) + np.maximum(positions - ends, 0)
     
     @cython.boundscheck(False)
     @cython.wraparound(False)
     def _tag_sentence(self, np.ndarray sentence, np.ndarray predicates, 
                       bool train=False, list tags=None, list arguments=None, 
-                      bool logprob=False, bool allow_repeats=True):
+                      bool logprob=False, bool allow_repeats=True,
+                      np.ndarray convolution_lookup=None):
         """
         Runs the network for every predicate in the sentence.
         Refer to the Network class for more information.
-        
+
         :param tags: this is a list rather than a numpy array because in
             argument classification, each predicate may have a differente number
             of arguments.
         :param predicates: a numpy array with the indices of the predicates in the sentence.
+        :param convolution_lookup: the convolution values for the sentence tokens,
+            if already computed (only when not training).
         """
         cdef list answer = []
-        cdef np.ndarray[FLOAT_t, ndim=2] convolution_lookup
-        
+
         if train:
+            self._ensure_workspace(len(sentence))
             # this table will store the values of the neurons for each input token
             # they will be needed during weight adjustments
-            self.input_sent_values = np.empty((len(sentence), self.input_size))
-            
+            self.input_sent_values = self.input_workspace[:len(sentence)]
+
         # store the convolution values to save time
-        convolution_lookup = self._convolution_lookup(sentence, train)
-        cdef np.ndarray[FLOAT_t, ndim=2] target_dist_features, pred_dist_features
+        if convolution_lookup is None:
+            convolution_lookup = self._convolution_lookup(sentence, train)
+        cdef np.ndarray[FLOAT_t, ndim=2] target_dist_projection, pred_dist_projection
         
         # store the values found by each convolution neuron here and then find the max
         cdef np.ndarray[FLOAT_t, ndim=2] convolution_values
@@ -350,38 +422,39 @@ Output size: %d
             if self.only_classify: pred_arguments = iter_args.next()
             
             self.num_targets = len(sentence) if arguments is None else len(pred_arguments)
-            scores = np.empty((self.num_targets, self.output_size))
             
             if train: 
                 pred_tags = iter_tags.next()
-                self.hidden_sent_values = np.empty((self.num_targets, self.hidden_size))
-                self.max_indices = np.empty((self.num_targets, self.hidden_size), np.int)
+                scores = self.scores_workspace[:self.num_targets]
+                self.hidden_sent_values = self.hidden_workspace[:self.num_targets]
+                self.max_indices = self.max_indices_workspace[:self.num_targets]
                 if self.hidden2_weights is not None:
-                    self.hidden2_sent_values = np.empty((self.num_targets, self.hidden2_size))
+                    self.hidden2_sent_values = self.hidden2_workspace[:self.num_targets]
+            else:
+                scores = np.empty((self.num_targets, self.output_size))
         
+            # project the distance vectors onto the convolution layer once,
+            # and then just pick the lines for each distance. (this must be done
+            # for each predicate, as weights change during training)
+            # (num_distances, dist_features) (dist_features, hidden) = (num_distances, hidden)
+            target_dist_projection = self.target_dist_lookup.dot(self.target_dist_weights)
+            pred_dist_projection = self.pred_dist_lookup.dot(self.pred_dist_weights)
+            
             # predicate distances are the same across all targets
             pred_dist_indices = np.arange(len(sentence)) - predicate
-            pred_dist_features = self.pred_dist_lookup.take(pred_dist_indices + self.pred_dist_offset,
-                                                            0, mode='clip')
-            pred_dist_values = pred_dist_features.dot(self.pred_dist_weights)
+            pred_dist_values = pred_dist_projection.take(pred_dist_indices + self.pred_dist_offset,
+                                                         0, mode='clip')
+            
+            # if we are classifying all tokens, pick the distance to the target
+            # if we are classifying arguments, pick the distance to the closest boundary 
+            # of the argument (beginning or end)
+            self.target_distances = self._target_distances(len(sentence), pred_arguments)
             
             # add the weighted distance features to each token 
             for target in range(self.num_targets):
                 
-                # distance features for each window
-                # if we are classifying all tokens, pick the distance to the target
-                # if we are classifying arguments, pick the distance to the closest boundary 
-                # of the argument (beginning or end)
-                if arguments is None:
-                    target_dist_indices = np.arange(len(sentence)) - target
-                else:
-                    argument = pred_arguments[target]
-                    target_dist_indices = self.argument_distances(np.arange(len(sentence)), argument)
-                
-                target_dist_features = self.target_dist_lookup.take(target_dist_indices + self.target_dist_offset,
-                                                                    0, mode='clip')
-
-                convolution_values = target_dist_features.dot(self.target_dist_weights) \
+                target_dist_indices = self.target_distances[target] + self.target_dist_offset
+                convolution_values = target_dist_projection.take(target_dist_indices, 0, mode='clip') \
                                      + pred_dist_values + convolution_lookup
                 
                 # now, find the maximum values
@@ -412,8 +485,8 @@ Output size: %d
                 self._evaluate(pred_answer, pred_tags)
                 if self._calculate_gradients(pred_tags, scores):
                     self._backpropagate(sentence)
-                    self._calculate_input_deltas(sentence, predicate, pred_arguments)
-                    self._adjust_weights(predicate, pred_arguments)
+                    self._calculate_input_deltas(sentence, predicate)
+                    self._adjust_weights(predicate)
                     self._adjust_features(sentence, predicate)
                     if not self.only_classify: self._adjust_transitions()
                 
@@ -448,7 +521,9 @@ Output size: %d
         
         :returns: whether a correction is necessary or not.
         """
-        self.net_gradients = np.zeros_like(scores, np.float)
+        self._ensure_workspace(len(scores))
+        self.net_gradients = self.sll_gradients[:len(scores)]
+        self.net_gradients.fill(0)
         correction = False
         
         for i, tag_scores in enumerate(scores):
@@ -501,7 +576,7 @@ Output size: %d
     
     @cython.boundscheck(False)
     @cython.wraparound(False)
-    def _adjust_weights(self, predicate, arguments=None):
+    def _adjust_weights(self, predicate):
         """Adjusts the network weights after gradients have been calculated."""
         cdef int last_size, i
         cdef np.ndarray[FLOAT_t, ndim=1] gradients_t
@@ -546,11 +621,7 @@ Output size: %d
             
             # target distance weights
             # get the relative distance from each max token to its target
-            if arguments is None:
-                target_dists = neuron_maxes - i
-            else:
-                argument = arguments[i]
-                target_dists = self.argument_distances(neuron_maxes, argument)
+            target_dists = self.target_distances[i].take(neuron_maxes)
             
             dist_features = self.target_dist_lookup.take(target_dists + self.target_dist_offset, 
                                                          0, mode='clip')
@@ -572,12 +643,13 @@ Output size: %d
             
     @cython.boundscheck(False)
     @cython.wraparound(False)
-    def _calculate_input_deltas(self, sentence, predicate, arguments=None):
+    def _calculate_input_deltas(self, sentence, predicate):
         """Calculates the input deltas to be applied in the feature tables."""
         cdef np.ndarray[FLOAT_t, ndim=2] grad_matrix, hidden_gradients
         
         # this gradient matrix has a whole window in each line
-        self.input_deltas = np.zeros((len(sentence), self.input_size))
+        self.input_deltas = self.input_deltas_workspace[:len(sentence)]
+        self.input_deltas.fill(0)
         self.target_dist_deltas = np.zeros_like(self.target_dist_lookup, np.float)
         self.pred_dist_deltas = np.zeros_like(self.pred_dist_lookup, np.float)
         
@@ -588,12 +660,7 @@ Output size: %d
             # the token that yielded the maximum value in each neuron
             convolution_max = self.max_indices[target]
             
-            if not self.only_classify:
-                target_dists = convolution_max - target
-            else:
-                argument = arguments[target]
-                target_dists = self.argument_distances(convolution_max, argument)
-            
+            target_dists = self.target_distances[target].take(convolution_max)
             target_dists = np.clip(target_dists + self.target_dist_offset, 0,
                                    self.target_dist_lookup.shape[0] - 1)
             pred_dists = convolution_max - predicate
@@ -604,7 +671,8 @@ Output size: %d
             
             # sparse matrix with gradients to be applied over the input
             # line i has the gradients for the i-th token in the sentence
-            grad_matrix = np.zeros((len(sentence), self.hidden_size)) 
+            grad_matrix = self.grad_workspace[:len(sentence)]
+            grad_matrix.fill(0)
             grad_matrix[convolution_max, np.arange(self.hidden_size)] = gradients
             
             self.input_deltas += grad_matrix.dot(self.hidden_weights) 
@@ -631,12 +699,7 @@ Output size: %d
         # in the lookup distance tables
         pre_dist = self.word_window_size
         pos_dist = 1
-        if self.word_window_size > 1:
-            padded_sentence = np.concatenate((self.pre_padding,
-                                              sentence,
-                                              self.pos_padding))
-        else:
-            padded_sentence = sentence
+        padded_sentence = self._pad_sentence(sentence)
         
         for i in range(self.word_window_size):
             
@@ -802,16 +865,20 @@ Output size: %d
         Biases are not included.
         """
         cdef np.ndarray padded_sentence
+        cdef np.ndarray[FLOAT_t, ndim=2] lookup
         
         # add padding to the sentence
-        if self.word_window_size > 1:
-            padded_sentence = np.vstack((self.pre_padding,
-                                         sentence,
-                                         self.pos_padding))
+        if train:
+            padded_sentence = self._pad_sentence(sentence)
+            lookup = self.convolution_workspace[:len(sentence)]
         else:
-            padded_sentence = sentence
-        
-        cdef np.ndarray[FLOAT_t, ndim=2] lookup = np.empty((len(sentence), self.hidden_size))
+            if self.word_window_size > 1:
+                padded_sentence = np.vstack((self.pre_padding,
+                                             sentence,
+                                             self.pos_padding))
+            else:
+                padded_sentence = sentence
+            lookup = np.empty((len(sentence), self.hidden_size))
         
         # first window
         cdef np.ndarray window = padded_sentence[:self.word_window_size]
@@ -1,37 +1,211 @@
 # -*- coding: utf-8 -*-
 
 from numpy import float as FLOAT
+from numpy.lib.stride_tricks import as_strided
 
 import utils
 
-# batch size for traing the LanguageModel
+# number of negative examples drawn at a time by the NegativeSampler
 # should be a class variable (not allowed in Cython)
-cdef int RandomPool_size = 1000
+cdef int SampleBlock_size = 1000
 
-cdef class RandomPool:
+# number of held-out windows used to evaluate a LanguageModel during training
+cdef int HeldoutSample_size = 100
 
-    cdef pool
-    cdef tables
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef inline float window_score(float[:, ::1] word_values, int word,
+                               float[:, ::1] context_values, int window,
+                               float[::1] output_weights) nogil:
+    """
+    Score of a window with the given word in the middle, from the hidden 
+    layer contributions of the word and of the rest of the window.
+    The output bias is left out.
+    """
+    cdef int h
+    cdef float value
+    cdef float score = 0
+    for h in range(word_values.shape[1]):
+        value = word_values[word, h] + context_values[window, h]
+        # hardtanh
+        if value > 1:
+            value = 1
+        elif value < -1:
+            value = -1
+        score += value * output_weights[h]
+    return score
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void count_higher_scores(float[:, ::1] word_values, float[:, ::1] context_values,
+                              float[::1] output_weights, int[::1] middle_words,
+                              np.uint8_t[::1] candidates, float[::1] middle_scores,
+                              long[::1] counts) nogil:
+    """
+    Counts, for each window, the candidate words scoring higher than its
+    actual middle word, whose scores are stored in middle_scores. The 
+    vocabulary is traversed once for all windows, so that the values of 
+    each word are read from memory only once.
+    """
+    cdef int word, i
+    cdef int num_windows = context_values.shape[0]
+    
+    for i in range(num_windows):
+        middle_scores[i] = window_score(word_values, middle_words[i], context_values,
+                                        i, output_weights)
+        counts[i] = 0
+    
+    for word in range(word_values.shape[0]):
+        if not candidates[word]:
+            continue
+        for i in range(num_windows):
+            if window_score(word_values, word, context_values, i,
+                            output_weights) > middle_scores[i]:
+                counts[i] += 1
+
+cdef class NegativeSampler:
+    """
+    Draws random tokens to be used as negative examples. Words are drawn
+    with probability proportional to their frequency in the training text
+    raised to some power, using the alias method (Walker 1977, Vose 1991),
+    which takes constant time per word.
+    The other features of a sampled token (e.g., capitalization) are those
+    of an occurrence of the sampled word in the text.
+    """
+    
+    # probability of keeping each column of the alias table, and the word
+    # taken otherwise
+    cdef np.ndarray probabilities
+    cdef np.ndarray aliases
+    
+    # features of one occurrence of each word. (num_words, num_tables)
+    cdef np.ndarray token_features
+    
+    # whether each word occurred in the sentences given so far
+    cdef np.ndarray seen
+    
+    cdef double power
+    
+    # block of tokens already drawn
+    cdef np.ndarray pool
     cdef int current
 
-    def __init__(self, tables):
-        self.tables = tables
+    def __init__(self, list sentences, int num_words, double power=0.75, 
+                 np.ndarray counts=None):
+        """
+        :param sentences: the training sentences, as 2-dim arrays with the
+            features of one token in each row. The first one is the word index.
+        :param num_words: number of rows in the word feature table
+        :param power: exponent applied to word frequencies. 1 samples words
+            as often as they appear in the text, 0 samples them uniformly 
+            among the words seen.
+        :param counts: number of occurrences of each word. If None, words
+            are counted in the given sentences.
+        """
+        self.power = power
+        self.update(sentences, counts, num_words)
+    
+    def update(self, list sentences, np.ndarray counts=None, int num_words=0):
+        """
+        Takes the features of the words in more sentences and draws words
+        according to new counts. This way, a text trained on in blocks 
+        doesn't need a new sampler for each one, even if the word feature
+        table grows.
+        
+        :param counts: number of occurrences of each word in all the text 
+            (possibly more than the sentences given so far). If None, words
+            are counted in the given sentences.
+        :param num_words: minimum number of words to draw from.
+        """
+        tokens = np.concatenate([sentence for sentence in sentences if len(sentence)])
+        if counts is None:
+            counts = np.bincount(tokens[:, 0], minlength=num_words)
+        
+        num_words = max(num_words, len(counts))
+        if self.token_features is None:
+            self.token_features = np.zeros((num_words, tokens.shape[1]), dtype=np.int32)
+            self.seen = np.zeros(num_words, dtype=np.bool)
+        elif num_words > len(self.token_features):
+            old_size = len(self.token_features)
+            self.token_features = np.resize(self.token_features, 
+                                            (num_words, tokens.shape[1]))
+            self.token_features[old_size:] = 0
+            self.seen = np.resize(self.seen, num_words)
+            self.seen[old_size:] = False
+        
+        # each word gets the features of its last occurrence
+        self.token_features[tokens[:, 0]] = tokens
+        self.seen[tokens[:, 0]] = True
+        
+        # words not seen yet can't be drawn, since their features are unknown
+        weights = np.zeros(len(self.token_features))
+        weights[:len(counts)] = np.power(counts, self.power) * (counts > 0)
+        weights *= self.seen
+        if np.count_nonzero(weights) < 2:
+            raise ValueError("Not enough distinct words to draw negative examples")
+        
+        self._build_alias_table(weights / weights.sum())
         self._new_pool()
-
-    def _new_pool(self):            
+    
+    def _build_alias_table(self, np.ndarray[FLOAT_t, ndim=1] distribution):
+        """
+        Splits the distribution into columns with the same total probability,
+        each one shared by at most two words (Vose's algorithm).
+        """
+        cdef int num_words = len(distribution)
+        cdef np.ndarray[FLOAT_t, ndim=1] probabilities = distribution * num_words
+        cdef np.ndarray[np.int32_t, ndim=1] aliases = np.arange(num_words, dtype=np.int32)
+        
+        # stacks of words with less and more than the average probability
+        cdef np.ndarray[np.int32_t, ndim=1] small = np.empty(num_words, dtype=np.int32)
+        cdef np.ndarray[np.int32_t, ndim=1] large = np.empty(num_words, dtype=np.int32)
+        cdef int num_small = 0, num_large = 0
+        cdef int i, less, more
+        
+        for i in range(num_words):
+            if probabilities[i] < 1:
+                small[num_small] = i
+                num_small += 1
+            else:
+                large[num_large] = i
+                num_large += 1
+        
+        while num_small > 0 and num_large > 0:
+            num_small -= 1
+            less = small[num_small]
+            more = large[num_large - 1]
+            
+            # the column of the less probable word is filled up with the other one
+            aliases[less] = more
+            probabilities[more] -= 1 - probabilities[less]
+            if probabilities[more] < 1:
+                num_large -= 1
+                small[num_small] = more
+                num_small += 1
+        
+        # whatever is left only differs from 1 by rounding errors
+        probabilities[small[:num_small]] = 1
+        probabilities[large[:num_large]] = 1
+        
+        self.probabilities = probabilities
+        self.aliases = aliases
+    
+    def _new_pool(self):
         """
-        Creates a pool of random feature indices, used for negative examples.
+        Draws a block of tokens to be used as negative examples.
         """
-        # generate 1000 indices for each table and then transpose
-        # so that each row represents a token
-        self.pool = np.array([np.random.random_integers(0, table.shape[0] - 1, RandomPool_size) 
-                                    for table in self.tables], dtype=FLOAT).T
+        # pick a column of the alias table, then one of its two words
+        columns = np.random.randint(0, len(self.aliases), SampleBlock_size).astype(np.int32)
+        coins = np.random.random(SampleBlock_size)
+        words = np.where(coins < self.probabilities[columns], columns, self.aliases[columns])
+        
+        self.pool = self.token_features.take(words, 0)
         self.current = 0
 
     def next(self):
         """
-        Generates randomly a token for use as a negative example.
-        :return: a list of token features, one for each feature table
+        Draws a token for use as a negative example.
+        :return: an int array of token features, one for each feature table
         """
         if self.current == len(self.pool):
             self._new_pool()
@@ -41,6 +215,19 @@ cdef class RandomPool:
         
         return token
 
+    def next_block(self, int size):
+        """
+        Draws many tokens at once for use as negative examples.
+        :return: a 2-dim int array with the features of one token in each row
+        """
+        if self.current + size > len(self.pool):
+            self._new_pool()
+        
+        block = self.pool[self.current:self.current + size].copy()
+        self.current += size
+        
+        return block
+
 
 cdef class LanguageModel(Network): 
     """
@@ -52,16 +239,54 @@ cdef class LanguageModel(Network):
     cdef int half_window
     
     # data for statistics during training. 
-    cdef int total_items
+    cdef long total_items
+    
+    # value of total_items at the start of the current epoch
+    cdef long epoch_start_items
+    
+    # total number of training examples, used to decay learning rates
+    cdef long all_cases
+    
+    # when training in many processes: lock and shared values for the number 
+    # of items, error and skips, and their values the last time they were synced
+    cdef object shared_counters
+    cdef long synced_items, synced_skips
+    cdef float synced_error
+    
+    # draws the tokens of negative examples
+    cdef NegativeSampler sampler
+    
+    # whether the last training was on a block of a stream (see train)
+    cdef bint in_stream
+    
+    # the padded training text as windows, corpus_windows[i] being the one
+    # starting at its i-th token, and the start of the window around each token
+    cdef np.ndarray corpus_windows, window_starts
     
-    # pool of random numbers (used for efficiency)
-    cdef RandomPool random_pool
+    # probability of training on each window when subsampling frequent words
+    cdef np.ndarray keep_probabilities
+    
+    # windows used for evaluation after each epoch
+    cdef np.ndarray heldout_windows
+    
+    # random states at the start of each epoch, from which the windows of
+    # the epochs are drawn again when training is resumed
+    cdef list epoch_random_states
+    
+    # array with room for new words, of which the word table is a view
+    cdef np.ndarray word_table_buffer
+    
+    # whether the parameters are in shared memory (see _share_parameters)
+    cdef bint shared_parameters
 
     # file where to save model (Attardi)
     cdef public char* filename
     
     # learning rates for each layer
     cdef float LR_0, LR_1, LR_2
+    
+    # number of negative examples for each positive one
+    cdef int num_negatives
 
     @classmethod
     def create_new(cls, feature_tables, int word_window, int hidden_size):
@@ -118,7 +343,34 @@ cdef class LanguageModel(Network):
         self.output_weights = output_weights
         self.output_bias = output_bias
         self.filename = ''      # Attardi
+        self.num_negatives = 1
+    
     
+    def grow_vocabulary(self, int num_words):
+        """
+        Adds randomly initialized vectors to the word feature table, so that 
+        it has num_words rows. The table is a view of a larger array, whose 
+        capacity is doubled when exhausted. This way, adding words one at a 
+        time takes amortized constant time. If parameters are shared by
+        processes training in parallel, so is the larger array.
+        """
+        table = self.feature_tables[0]
+        cdef int old_size = len(table)
+        if num_words <= old_size:
+            return
+        
+        buffer_ = self.word_table_buffer
+        if buffer_ is None or not np.may_share_memory(table, buffer_) or \
+                num_words > len(buffer_):
+            buffer_ = np.empty((max(num_words, 2 * old_size), table.shape[1]))
+            if self.shared_parameters:
+                buffer_ = parallel.shared_copy(buffer_)
+            buffer_[:old_size] = table
+            self.word_table_buffer = buffer_
+        
+        buffer_[old_size:num_words] = utils.generate_feature_vectors(num_words - old_size,
+                                                                     table.shape[1])
+        self.feature_tables[0] = buffer_[:num_words]
     
     def _train_pair(self, example):
         """
@@ -126,7 +378,7 @@ cdef class LanguageModel(Network):
         The negative one is randomly generated.
 	:param example: the positive example, i.e. a list of a list of token IDs
         """
-        cdef np.ndarray[INT_t, ndim=1] token
+        cdef np.ndarray[np.int32_t, ndim=1] token
         cdef int i, j
         cdef np.ndarray[FLOAT_t, ndim=2] table
         
@@ -135,7 +387,7 @@ cdef class LanguageModel(Network):
         middle_token = example[self.half_window]
         while True:
             # ensure to get a different word
-            variant = self.random_pool.next()
+            variant = self.sampler.next()
             if variant[0] != middle_token[0]:
                 break
         
@@ -143,10 +395,8 @@ cdef class LanguageModel(Network):
         pos_score = self.run(pos_input_values)
         pos_hidden_values = self.hidden_values
         
-        negative_token = np.array(variant, dtype=FLOAT)
-        example[self.half_window] = negative_token
-        neg_input_values = self.lookup(example)
-        neg_score = self.run(neg_input_values)
+        negative_token = np.array(variant)
+        neg_input_values, neg_score = self._run_negative(pos_input_values, negative_token)
         
         # hinge loss
         error = max(0, 1 - pos_score + neg_score)
@@ -212,114 +462,598 @@ cdef class LanguageModel(Network):
                 
                 offset += table.shape[1]
 
+    
+    def _run_negative(self, np.ndarray[FLOAT_t] input_values, negative_token):
+        """
+        Runs the network for the input last given to run() with its middle 
+        token replaced. Only the contribution of the middle token to the hidden
+        layer is recomputed, instead of the whole window.
+        :param input_values: the input of the last call to run()
+        :param negative_token: the feature indices of the replacing token
+        :return: a tuple with the new input values and the network output
+        """
+        cdef int features_per_token = self.input_size / self.word_window_size
+        cdef int middle_start = self.half_window * features_per_token
+        cdef int middle_end = middle_start + features_per_token
+        
+        neg_input_values = input_values.copy()
+        neg_input_values[middle_start:middle_end] = self.lookup(negative_token.reshape(1, -1))
+        
+        # (hidden_size, features_per_token) . features_per_token = hidden_size
+        middle_weights = self.hidden_weights[:, middle_start:middle_end]
+        self.layer2_values = self.layer2_values + \
+            middle_weights.dot(neg_input_values[middle_start:middle_end] - 
+                               input_values[middle_start:middle_end])
+        self.hidden_values = hardtanh(self.layer2_values)
+        
+        return neg_input_values, self.output_weights.dot(self.hidden_values) + self.output_bias
+    
+    def _train_negatives(self, example):
+        """
+        Trains the network with a positive example and num_negatives negative
+        ones, created by replacing its middle token with random ones.
+        All of them are scored with a single matrix product, and the hinge
+        loss gradients of every negative example scoring too high are applied
+        at once.
+        :param example: the positive example, i.e. a list of a list of token IDs
+        """
+        cdef int i, j, offset
+        cdef int num_negatives = self.num_negatives
+        cdef int features_per_token = self.input_size / self.word_window_size
+        cdef np.ndarray[FLOAT_t, ndim=2] table
+        
+        middle_token = example[self.half_window]
+        negative_tokens = self.sampler.next_block(num_negatives)
+        # ensure to get different words
+        same = negative_tokens[:, 0] == middle_token[0]
+        while same.any():
+            negative_tokens[same] = self.sampler.next_block(same.sum())
+            same = negative_tokens[:, 0] == middle_token[0]
+        
+        # first row is the positive example, the others only differ
+        # in the columns of the middle token
+        # (1 + num_negatives, input_size)
+        input_values = np.tile(self.lookup(example), (1 + num_negatives, 1))
+        middle_start = self.half_window * features_per_token
+        input_values[1:, middle_start:middle_start + features_per_token] = \
+            np.hstack([table.take(negative_tokens[:, j], 0)
+                       for j, table in enumerate(self.feature_tables)])
+        
+        # (1 + num_negatives, input_size) (input_size, hidden_size) = (1 + num_negatives, hidden_size)
+        hidden_values = np.clip(input_values.dot(self.hidden_weights.T) + self.hidden_bias, -1, 1)
+        scores = hidden_values.dot(self.output_weights) + self.output_bias
+        
+        # hinge loss for each negative example
+        errors = np.maximum(0, 1 - scores[0] + scores[1:])
+        self.error += errors.sum()
+        self.total_items += 1
+        violations = errors > 0
+        if not violations.any():
+            self.skips += 1
+            return
+        
+        # negative gradients: -1 for each negative example with error
+        # and +1 for the positive one for each of them
+        score_grads = np.empty(1 + num_negatives)
+        score_grads[1:] = -1.0 * violations
+        score_grads[0] = violations.sum()
+        
+        # hidden gradients (hardtanh derivative is 0 where it saturates)
+        # (1 + num_negatives, hidden_size)
+        layer2_grads = np.outer(score_grads, self.output_weights) * (np.abs(hidden_values) != 1)
+        
+        # input gradients
+        # (1 + num_negatives, hidden_size) (hidden_size, input_size) = (1 + num_negatives, input_size)
+        input_grads = self.LR_0 * layer2_grads.dot(self.hidden_weights)
+        
+        # weight adjustment
+        # output bias is left unchanged -- the deltas cancel each other
+        self.output_weights += self.LR_2 * score_grads.dot(hidden_values)
+        self.hidden_weights += self.LR_1 * layer2_grads.T.dot(input_values)
+        self.hidden_bias += self.LR_1 * layer2_grads.sum(0)
+        
+        # all examples share the tokens outside the middle position
+        context_grads = input_grads.sum(0)
+        
+        # this tracks where the deltas for the next table begins
+        offset = 0
+        for i, token in enumerate(example):
+            for j, table in enumerate(self.feature_tables):
+                if i == self.half_window:
+                    table[middle_token[j]] += input_grads[0, offset:offset + table.shape[1]]
+                    scatter_add(table, negative_tokens[:, j],
+                                input_grads[1:, offset:offset + table.shape[1]])
+                else:
+                    table[token[j]] += context_grads[offset:offset + table.shape[1]]
                 
-    def train(self, list sentences, int epochs, int iterations_between_reports):
+                offset += table.shape[1]
+    
+    def train(self, list sentences, int epochs, int iterations_between_reports,
+              int num_workers=1, int num_negatives=1, double sampling_power=0.75,
+              double subsampling=0, list heldout=None, 
+              int heldout_windows=HeldoutSample_size, np.ndarray word_counts=None,
+              long stream_windows=0):
         """
         Trains the language model over the given sentences.
         :param epochs: number of iterations over the sentences
+        :param num_workers: number of processes training at the same time.
+            They share weights and feature tables and update them without 
+            locking (asynchronous SGD, a.k.a. Hogwild).
+        :param num_negatives: number of negative examples for each positive one.
+        :param sampling_power: negative examples are drawn with probability
+            proportional to word frequencies raised to this power.
+        :param subsampling: if greater than 0, windows around frequent words 
+            are randomly skipped in each epoch (Mikolov et al. 2013). A window
+            whose middle word has relative frequency f is kept with probability
+            min(1, sqrt(subsampling / f) + subsampling / f).
+        :param heldout: sentences not used for training. If given, the model
+            is evaluated on a sample of their windows after each epoch.
+        :param heldout_windows: number of held-out windows in the sample. 
+            The evaluation time is proportional to it (see _rank_windows).
+        :param word_counts: number of occurrences of each word in the whole
+            text, used to draw negative examples and to subsample windows.
+            If None, words are counted in the given sentences.
+        :param stream_windows: if greater than 0, the sentences are a block of
+            a longer text with about this number of windows, read in blocks 
+            (one window for each token). The first call with a stream_windows
+            starts training on it, the next ones go on with the following 
+            blocks: the learning rates decay over the whole text, and the 
+            negative sampler is updated instead of created again.
         """
+        if num_workers < 1:
+            raise ValueError("Invalid number of workers: %d" % num_workers)
+        if not 0 < num_negatives <= SampleBlock_size:
+            raise ValueError("Invalid number of negative examples: %d" % num_negatives)
+        if subsampling < 0:
+            raise ValueError("Invalid subsampling threshold: %f" % subsampling)
+        if heldout_windows < 1:
+            raise ValueError("Invalid number of held-out windows: %d" % heldout_windows)
+        if stream_windows < 0:
+            raise ValueError("Invalid number of windows in the stream: %d" % stream_windows)
+        self.num_negatives = num_negatives
+        state = self.resume_state
+        self.resume_state = None
+        
+        cdef bint next_block = stream_windows > 0 and self.in_stream
+        if next_block:
+            # a following block of the stream
+            self.sampler.update(sentences, word_counts, self.feature_tables[0].shape[0])
+        else:
+            self.sampler = NegativeSampler(sentences, self.feature_tables[0].shape[0],
+                                           sampling_power, word_counts)
+            self.total_items = 0
+        self.in_stream = stream_windows > 0
         
-        # generate 1000 random indices at a time to save time
-        # (generating 1000 integers at once takes about ten times the time for a single one)
-        self.random_pool = RandomPool(self.feature_tables)
-        self.total_items = 0
+        self._index_corpus(sentences)
+        self.epoch = 0
+        self.epoch_random_states = []
         
         # how often to save model
-        save_period = 1000 * RandomPool_size
-
-        all_cases = sum([len(sen) for sen in sentences]) * epochs
-
-        # TODO: parallelize
-        # see: http://radimrehurek.com/2013/10/parallelizing-word2vec-in-python/
-        # all threads access the same matrix of neural weights, and there’s no
-        # locking, so they may be overwriting the same weights willy-nilly at
-        # the same time. Apparently this hack even has a fancy name in
-        # academia: “asynchronous stochastic gradient descent”.
-
-#         from queue import Queue
-#
-#         jobs = Queue(maxsize=2 * self.workers)  # buffer ahead only a limited number of jobs
-#         lock = threading.Lock()  # for shared state
-#
-#         def worker_train():
-#             """Train the model, lifting lists of sentences from the jobs queue."""
-#             params = Params()  # each thread has its own hidden weights
-#             gradients = Params()  # and gradients
-#
-#             while True:
-#                 job = jobs.get()
-#                 if job is None:  # data finished, exit
-#                     break
-#                 job_words = self._train_batch(self, params, gradients)
-#                 with lock:
-#                     word_count[0] += job_words
-#                     elapsed = time.time() - start
-#                     if elapsed >= next_report[0]:
-#                         logger.info("PROGRESS: at %.2f%% examples" %
-#                             (100.0 * word_count[0] / total_words))
-#                         # wait at least one second between progress reports
-#                         next_report[0] = elapsed + 1.0
-#         workers = [threading.Thread(target=worker_train) for _ in xrange(self.workers)]
-#         for thread in workers:
-#             thread.daemon = True  # make interrupting the process with ctrl+c easier
-#             thread.start()
-#
-#         # fill the job queue
-#         for job in grouper(sentences, chunksize):
-#             jobs.put(job)
-#         for _ in xrange(self.workers):
-#             jobs.put(None)  # signal finish
-#
-#         for thread in workers:
-#             thread.join()
+        save_period = 1000 * SampleBlock_size
 
-        for epoch in xrange(epochs):
-            self.error = <FLOAT_t>0.0
-            self.skips = 0
-            epoch_examples = 0
-            # update LR by fan-in
-            # decrease linearly by remaining
-            remaining = 1.0 - (self.total_items / float(all_cases))
-            self.LR_0 = max(0.001, self.learning_rate * remaining)
-            self.LR_1 = max(0.001, self.learning_rate / self.input_size * remaining)
-            self.LR_2 = max(0.001, self.learning_rate / self.hidden_size * remaining)
-
-            for sentence in sentences:
-                for pos in xrange(len(sentence)):
-                    # extract the window around the given position
-                    window = self._extract_window(sentence, pos)
+        if subsampling > 0:
+            self.keep_probabilities = self._keep_probabilities(subsampling, word_counts)
+            # learning rates decay according to the expected number of windows
+            examples_per_epoch = self.keep_probabilities.sum()
+        else:
+            self.keep_probabilities = None
+            examples_per_epoch = len(self.window_starts)
+        if stream_windows > 0:
+            # the rest of the stream is assumed to keep as many windows as this block
+            examples_per_epoch *= stream_windows / float(max(1, len(self.window_starts)))
+        self.all_cases = <long>(examples_per_epoch * epochs)
+        
+        if heldout is not None and (not next_block or self.heldout_windows is None):
+            # the same windows in every epoch (and block of a stream), 
+            # so that results are comparable
+            self.heldout_windows = self._sample_windows(heldout, heldout_windows)
+        
+        # the following blocks of a stream train on the same shared arrays
+        if num_workers > 1 and not (next_block and self.shared_parameters):
+            self._share_parameters()
+        
+        if state is not None:
+            positions = self._resume_epoch(state)
+            if 'heldout_windows' in state and heldout is not None:
+                self.heldout_windows = state['heldout_windows']
+        
+        for epoch in xrange(self.epoch, epochs):
+            self.epoch = epoch
+            if state is None:
+                self.error = <FLOAT_t>0.0
+                self.skips = 0
+                self.epoch_start_items = self.total_items
+                self._update_learning_rates()
                 
-                    self._train_pair(window)
-                    epoch_examples += 1
-
-                    if iterations_between_reports > 0 and \
-                       (self.total_items and
-                        self.total_items % iterations_between_reports == 0):
-                        self._progress_report(epoch, epoch_examples)
-                        # save language model. Attardi
-                        if save_period and self.total_items % save_period == 0:
-                            utils.save_features_to_file(self.feature_tables[0], self.filename)
-    
-    def _extract_window(self, sentence, position):
-        """
-        Extracts a token window from the sentence, with the size equal to the
-        network's window size.
-        This function takes care of creating padding as necessary.
-        """
-        if position < self.half_window:
-            num_padding = self.half_window - position
-            pre_padding = np.array(num_padding * [self.padding_left], dtype=np.int)
-            sentence = np.concatenate((pre_padding, sentence))
-            position += num_padding
-        
-        # number of tokens in the sentence after the position
-        tokens_after = len(sentence) - position - 1
-        if tokens_after < self.half_window:
-            num_padding = self.half_window - tokens_after
-            pos_padding = np.array(num_padding * [self.padding_right], dtype=np.int)
-            sentence = np.concatenate((sentence, pos_padding))
-        
-        return sentence[position - self.half_window : position + self.half_window + 1]
+                self.epoch_random_states.append(np.random.get_state())
+                positions = self._epoch_positions()
+            else:
+                # the epoch being resumed goes on with the remaining windows
+                state = None
+            
+            if num_workers > 1:
+                self._train_parallel(positions, epoch, iterations_between_reports,
+                                     save_period, num_workers)
+            else:
+                self._train_epoch(positions, epoch, iterations_between_reports, save_period)
+            
+            if heldout is not None:
+                self._evaluation_report(epoch)
+    
+    def _index_corpus(self, list sentences):
+        """
+        Pads all sentences and concatenates them into a single int32 array, 
+        so that training windows are views into it instead of being built 
+        for each token. Sets corpus_windows and window_starts.
+        """
+        sentences = [sentence for sentence in sentences if len(sentence)]
+        padded, starts, _ = self._padded_windows(sentences)
+        padded = np.ascontiguousarray(padded, dtype=np.int32)
+        
+        # a window starts at each token, except the last ones
+        # (num_windows, window_size, num_tables)
+        num_windows = len(padded) - self.word_window_size + 1
+        row_stride, column_stride = padded.strides
+        self.corpus_windows = as_strided(padded, 
+                                         (num_windows, self.word_window_size, padded.shape[1]),
+                                         (row_stride, row_stride, column_stride))
+        self.window_starts = starts
+    
+    def _keep_probabilities(self, double threshold, np.ndarray counts=None):
+        """
+        Returns the probability of keeping each window when subsampling 
+        frequent words, given by the frequency of its middle word.
+        
+        :param counts: number of occurrences of each word. If None, words
+            are counted in the windows.
+        """
+        words = self.corpus_windows[self.window_starts, self.half_window, 0]
+        if counts is None:
+            counts = np.bincount(words, minlength=self.feature_tables[0].shape[0])
+        
+        # words not in the text get any value, they are never looked up
+        frequencies = np.maximum(counts, 1) / float(counts.sum())
+        ratios = threshold / frequencies
+        word_probabilities = np.minimum(1, np.sqrt(ratios) + ratios)
+        
+        return word_probabilities.take(words)
+    
+    def _epoch_positions(self):
+        """
+        Returns the starts of the windows to train on in an epoch, 
+        in random order.
+        """
+        if self.keep_probabilities is None:
+            # no need to keep the original order
+            positions = self.window_starts
+        else:
+            kept = np.random.random(len(self.window_starts)) < self.keep_probabilities
+            positions = self.window_starts[kept]
+        
+        np.random.shuffle(positions)
+        return positions
+    
+    def _update_learning_rates(self):
+        """
+        Sets the learning rate of each layer according to the training progress.
+        """
+        # update LR by fan-in
+        # decrease linearly by remaining
+        remaining = 1.0 - (self.total_items / float(self.all_cases))
+        self.LR_0 = max(0.001, self.learning_rate * remaining)
+        self.LR_1 = max(0.001, self.learning_rate / self.input_size * remaining)
+        self.LR_2 = max(0.001, self.learning_rate / self.hidden_size * remaining)
+    
+    def _train_epoch(self, np.ndarray positions, int epoch, int iterations_between_reports,
+                     int save_period):
+        """
+        Trains with the windows of the corpus starting at the given positions.
+        """
+        windows = self.corpus_windows
+        epoch_examples = 0
+        for start in positions:
+            window = windows[start]
+            
+            if self.num_negatives > 1:
+                self._train_negatives(window)
+            else:
+                self._train_pair(window)
+            epoch_examples += 1
+            
+            if self.shared_counters is not None:
+                if epoch_examples % SampleBlock_size == 0:
+                    self._sync_counters(epoch, iterations_between_reports, save_period)
+            
+            elif iterations_between_reports > 0 and \
+               (self.total_items and
+                self.total_items % iterations_between_reports == 0):
+                self._progress_report(epoch, self.total_items - self.epoch_start_items)
+                # save language model. Attardi
+                if save_period and self.total_items % save_period == 0:
+                    self.saver(self)
+    
+    def _resume_epoch(self, state):
+        """
+        Restores a state given to set_training_state(), which may be in the
+        middle of an epoch.
+        :return: the starts of the windows not yet trained on in that epoch
+        """
+        epoch_examples = self._restore_progress(state)
+        
+        # window_starts is shuffled in place, so the windows of an epoch 
+        # depend on those of all the previous ones
+        self.epoch_random_states = checkpoint.random_states(state, 'epoch_random')
+        for random_state in self.epoch_random_states:
+            np.random.set_state(random_state)
+            positions = self._epoch_positions()
+        
+        if 'random_keys' in state:
+            np.random.set_state(checkpoint.random_states(state, 'random')[0])
+        
+        return positions[epoch_examples:]
+    
+    def _restore_progress(self, state):
+        """
+        Restores the counters, learning rates and negative examples of a
+        training state returned by get_training_state().
+        :return: the number of examples already trained on in the current epoch
+        """
+        cdef long epoch_examples = state['epoch_examples']
+        self.epoch = state['epoch']
+        self.total_items = state['total_items']
+        self.epoch_start_items = self.total_items - epoch_examples
+        self.error = state['error']
+        self.skips = state['skips']
+        self.LR_0 = state['LR_0']
+        self.LR_1 = state['LR_1']
+        self.LR_2 = state['LR_2']
+        
+        if 'sampler_pool' in state:
+            self.sampler.pool = np.array(state['sampler_pool'])
+            self.sampler.current = state['sampler_current']
+        
+        logger = logging.getLogger("Logger")
+        logger.info("Resuming training in epoch %d, after %d examples" 
+                    % (self.epoch + 1, epoch_examples))
+        
+        return epoch_examples
+    
+    def get_training_state(self):
+        """
+        Returns a dictionary of arrays with the state of training that isn't
+        in the network parameters: the current epoch, the number of examples
+        trained on, error, learning rates, the negative examples already drawn
+        and random states. See Network.get_training_state().
+        """
+        state = dict(epoch=self.epoch, total_items=self.total_items,
+                     epoch_examples=self.total_items - self.epoch_start_items,
+                     error=self.error, skips=self.skips,
+                     LR_0=self.LR_0, LR_1=self.LR_1, LR_2=self.LR_2)
+        
+        if self.sampler is not None:
+            state.update(sampler_pool=self.sampler.pool,
+                         sampler_current=self.sampler.current)
+        if self.epoch_random_states:
+            state.update(checkpoint.random_state_arrays('epoch_random', 
+                                                        self.epoch_random_states))
+        if self.shared_counters is None:
+            # processes training in parallel have random states of their own, 
+            # which aren't restored
+            state.update(checkpoint.random_state_arrays('random', [np.random.get_state()]))
+        if self.heldout_windows is not None:
+            state['heldout_windows'] = self.heldout_windows
+        
+        return state
+    
+    def _share_parameters(self):
+        """
+        Moves weights and feature tables to shared memory, so that they are
+        updated by all training processes.
+        """
+        self.hidden_weights = parallel.shared_copy(self.hidden_weights)
+        self.hidden_bias = parallel.shared_copy(self.hidden_bias)
+        self.output_weights = parallel.shared_copy(self.output_weights)
+        self.output_bias = parallel.shared_copy(self.output_bias)
+        self.feature_tables = [parallel.shared_copy(table) for table in self.feature_tables]
+        self.shared_parameters = True
+    
+    def _train_parallel(self, np.ndarray positions, int epoch, int iterations_between_reports,
+                        int save_period, int num_workers):
+        """
+        Trains one epoch in many processes, each one with its share of the
+        windows. Parameters must be in shared memory (see _share_parameters).
+        """
+        # values shared by all processes: number of items, error and skips,
+        # and a queue where they request checkpoints
+        lock = multiprocessing.Lock()
+        counters = (lock, multiprocessing.RawValue('l', self.total_items),
+                    multiprocessing.RawValue('d', self.error),
+                    multiprocessing.RawValue('l', self.skips),
+                    multiprocessing.Queue())
+        
+        # each process has its own random seed, drawn from the current state
+        seeds = np.random.randint(0, 2 ** 31 - 1, num_workers)
+        
+        # checkpoints are written by this process only, so that a single saver
+        # keeps track of the files (e.g., the deltas of the feature tables)
+        save_errors = []
+        saving = threading.Thread(target=self._save_requested, args=(counters, save_errors))
+        saving.daemon = True
+        saving.start()
+        
+        args = (positions, num_workers, epoch, iterations_between_reports,
+                save_period, counters, seeds)
+        try:
+            parallel.run_workers(self._train_worker, args, num_workers)
+        finally:
+            counters[4].put(None)
+            saving.join()
+        
+        if save_errors:
+            error_info = save_errors[0]
+            raise error_info[0], error_info[1], error_info[2]
+        
+        _, items, error, skips, _ = counters
+        self.total_items = items.value
+        self.error = error.value
+        self.skips = skips.value
+    
+    def _train_worker(self, int worker, np.ndarray positions, int num_workers, int epoch,
+                      int iterations_between_reports, int save_period, counters, seeds):
+        """
+        Training loop of each process started by _train_parallel. 
+        """
+        np.random.seed(seeds[worker])
+        # otherwise all processes would start with the same negative examples
+        self.sampler._new_pool()
+        
+        self.shared_counters = counters
+        self.synced_items = self.total_items
+        self.synced_error = self.error
+        self.synced_skips = self.skips
+        
+        # worker i takes windows i, i + num_workers, i + 2 * num_workers...
+        self._train_epoch(positions[worker::num_workers], epoch, 
+                          iterations_between_reports, save_period)
+        self._sync_counters(epoch, iterations_between_reports, save_period)
+    
+    def _save_requested(self, counters, errors):
+        """
+        Saves the model whenever a process training in parallel requests it,
+        until None is requested. Runs in a thread of the process that started
+        them, where parameters are the same shared arrays. Errors are 
+        appended to the given list, and stop the saving.
+        """
+        _, items, error, skips, requests = counters
+        while True:
+            request = requests.get()
+            if request is None:
+                break
+            if errors:
+                continue
+            
+            try:
+                # the training state has the overall progress
+                self.total_items = items.value
+                self.error = error.value
+                self.skips = skips.value
+                self.saver(self)
+            except:
+                errors.append(sys.exc_info())
+        
+        # a checkpoint still being written would be lost if training stopped
+        wait = getattr(self.saver, 'wait', None)
+        if wait is not None and not errors:
+            try:
+                wait()
+            except:
+                errors.append(sys.exc_info())
+    
+    def _sync_counters(self, int epoch, int iterations_between_reports, int save_period):
+        """
+        Adds the progress of this process to the values shared by all of them,
+        and takes the overall values. This is used to decay learning rates, 
+        report progress and save the model.
+        """
+        lock, items, error, skips, requests = self.shared_counters
+        with lock:
+            last_items = items.value
+            items.value += self.total_items - self.synced_items
+            error.value += self.error - self.synced_error
+            skips.value += self.skips - self.synced_skips
+            
+            self.total_items = self.synced_items = items.value
+            self.error = self.synced_error = error.value
+            self.skips = self.synced_skips = skips.value
+        
+        self._update_learning_rates()
+        
+        # only the process crossing a multiple of the intervals reports or saves
+        if iterations_between_reports > 0 and \
+                last_items / iterations_between_reports < self.total_items / iterations_between_reports:
+            self._progress_report(epoch, self.total_items - self.epoch_start_items)
+        
+        if save_period and last_items / save_period < self.total_items / save_period:
+            # the process that started this one saves the model
+            requests.put(self.total_items)
+    
+    def evaluate(self, list sentences, int num_windows=HeldoutSample_size):
+        """
+        Evaluates the model on windows sampled from the given sentences, 
+        ranking all words in the vocabulary as the middle token of each one.
+        :param num_windows: number of windows to sample. If there are fewer,
+            all of them are used.
+        :return: a tuple (mean rank, mean reciprocal rank) of the actual 
+            middle words. Rank 1 is the highest score.
+        """
+        return self._rank_windows(self._sample_windows(sentences, num_windows))
+    
+    def _sample_windows(self, list sentences, int num_windows):
+        """
+        Returns a random sample of the windows in the given sentences as a
+        3-dim array (num_windows, window_size, num_tables).
+        """
+        sentences = [sentence for sentence in sentences if len(sentence)]
+        padded, starts, _ = self._padded_windows(sentences)
+        if num_windows < len(starts):
+            starts = np.random.choice(starts, num_windows, replace=False)
+        
+        return padded[starts[:, np.newaxis] + np.arange(self.word_window_size)]
+    
+    def _rank_windows(self, np.ndarray windows):
+        """
+        Ranks all words in the vocabulary as the middle token of each of the
+        given windows. The other features of the middle token are kept.
+        
+        The hidden layer pre-activation is computed once for the rest of each
+        window, and added to the contribution of each word in the vocabulary, 
+        which is the same for all windows. Still, the cost is proportional to 
+        num_windows * vocabulary size * hidden_size: with 100 windows, 100,000
+        words and 200 hidden units, it takes a few seconds.
+        :return: a tuple (mean rank, mean reciprocal rank)
+        """
+        cdef int features_per_token = self.input_size / self.word_window_size
+        cdef int word_start = self.half_window * features_per_token
+        cdef int word_end = word_start + self.feature_tables[0].shape[1]
+        
+        # (num_windows, input_size)
+        input_values = np.array([self.lookup(window) for window in windows])
+        word_weights = self.hidden_weights[:, word_start:word_end]
+        
+        # (num_windows, hidden_size) without the middle word
+        context_values = input_values.dot(self.hidden_weights.T) + self.hidden_bias - \
+            input_values[:, word_start:word_end].dot(word_weights.T)
+        
+        # (vocabulary, word features) (word features, hidden_size) = (vocabulary, hidden_size)
+        # single precision is enough for ranking and twice as fast
+        word_values = np.ascontiguousarray(self.feature_tables[0].dot(word_weights.T), 
+                                           np.float32)
+        context_values = np.ascontiguousarray(context_values, np.float32)
+        output_weights = np.ascontiguousarray(self.output_weights, np.float32)
+        middle_words = np.ascontiguousarray(windows[:, self.half_window, 0], np.int32)
+        
+        # padding is not a word 
+        cdef np.ndarray candidates = np.ones(len(word_values), np.uint8)
+        candidates[self.padding_left[0]] = False
+        candidates[self.padding_right[0]] = False
+        
+        middle_scores = np.empty(len(windows), np.float32)
+        counts = np.empty(len(windows), np.long)
+        count_higher_scores(word_values, context_values, output_weights, middle_words,
+                            candidates, middle_scores, counts)
+        ranks = 1.0 + counts
+        
+        return ranks.mean(), (1 / ranks).mean()
+    
+    def _evaluation_report(self, int num):
+        """
+        Reports the performance of the network on the held-out windows 
+        after the given epoch.
+        """
+        mean_rank, mrr = self._rank_windows(self.heldout_windows)
+        logger = logging.getLogger("Logger")
+        logger.info("Epoch %d, held-out mean rank: %.1f, MRR: %.4f" 
+                    % (num + 1, mean_rank, mrr))
     
     def description(self):
         """
@@ -337,18 +1071,25 @@ Hidden layer size: %d
         
         return desc
     
+    def get_saved_arrays(self):
+        """
+        Returns a dictionary with the arrays saved by save(), which can also
+        be written with numpy.savez.
+        """
+        return dict(hidden_weights=self.hidden_weights,
+                    output_weights=self.output_weights,
+                    hidden_bias=self.hidden_bias, output_bias=self.output_bias,
+                    word_window_size=self.word_window_size, 
+                    input_size=self.input_size, hidden_size=self.hidden_size,
+                    padding_left=self.padding_left, padding_right=self.padding_right)
+    
     def save(self, filename):
         """
         Saves the neural network to a file.
         It will save the weights, biases, sizes, and padding,
         but not the feature tables nor the vocabulary.
         """
-        np.savez(filename, hidden_weights=self.hidden_weights,
-                 output_weights=self.output_weights,
-                 hidden_bias=self.hidden_bias, output_bias=self.output_bias,
-                 word_window_size=self.word_window_size, 
-                 input_size=self.input_size, hidden_size=self.hidden_size,
-                 padding_left=self.padding_left, padding_right=self.padding_right)
+        np.savez(filename, **self.get_saved_arrays())
     
     
     @classmethod
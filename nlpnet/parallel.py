@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+
+"""
+Utilities for training networks in many processes at once.
+
+Worker processes are forked, so they see all the data the parent process had
+before starting them (this only works in POSIX systems). Arrays that must be
+seen and changed by all of them are kept in shared memory.
+
+There is also a helper for preparing training data in a background thread
+while the network is busy with the data prepared before.
+"""
+
+import sys
+import Queue
+import threading
+import multiprocessing
+import traceback
+import numpy as np
+from multiprocessing.sharedctypes import RawArray, RawValue
+
+
+def shared_copy(array):
+    """
+    Returns a copy of the given numpy array whose data is in shared memory.
+    Changes made to it by processes forked after its creation are seen by
+    all of them.
+    """
+    array = np.asarray(array)
+    # a byte array is allocated in order to support any dtype
+    buffer_ = RawArray('b', max(array.nbytes, 1))
+    shared = np.frombuffer(buffer_, dtype=array.dtype, count=array.size)
+    shared = shared.reshape(array.shape)
+    shared[...] = array
+
+    return shared
+
+
+class BrokenBarrierError(RuntimeError):
+    """Raised when a process waits on a barrier aborted by another one."""
+    pass
+
+
+class Barrier(object):
+    """
+    A barrier for a fixed number of processes. Each one blocks on wait()
+    until all of them have called it. (Python 2 multiprocessing lacks one)
+    """
+
+    def __init__(self, parties):
+        self.parties = parties
+        self.condition = multiprocessing.Condition()
+        self.waiting = RawValue('i', 0)
+        self.generation = RawValue('i', 0)
+        self.broken = RawValue('b', 0)
+
+    def wait(self):
+        """Blocks until all processes have called this function."""
+        with self.condition:
+            if self.broken.value:
+                raise BrokenBarrierError()
+
+            generation = self.generation.value
+            self.waiting.value += 1
+            if self.waiting.value == self.parties:
+                self.waiting.value = 0
+                self.generation.value += 1
+                self.condition.notify_all()
+            else:
+                while generation == self.generation.value and not self.broken.value:
+                    self.condition.wait()
+
+                if self.broken.value:
+                    raise BrokenBarrierError()
+
+    def abort(self):
+        """
+        Breaks the barrier, releasing the processes waiting on it. Used when
+        a process fails and the others would wait for it forever.
+        """
+        with self.condition:
+            self.broken.value = 1
+            self.condition.notify_all()
+
+
+def _run_worker(function, worker, args, results, barrier):
+    """Runs function in a worker process and sends back its result."""
+    try:
+        result = function(worker, *args)
+        results.put((worker, True, result))
+    except BrokenBarrierError:
+        # some other process failed and will report it
+        results.put((worker, False, None))
+    except:
+        if barrier is not None:
+            barrier.abort()
+        results.put((worker, False, traceback.format_exc()))
+
+
+def run_workers(function, args, num_workers, barrier=None):
+    """
+    Calls function(worker, *args) in num_workers forked processes, where
+    worker is the index of each process, and waits for all of them.
+
+    :param barrier: a Barrier used by the workers. It is aborted if any of
+        them fails, so that the others don't wait forever.
+    :return: a list with the value returned in each worker.
+    """
+    results = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=_run_worker,
+                                         args=(function, worker, args, results, barrier))
+                 for worker in xrange(num_workers)]
+    for process in processes:
+        process.start()
+
+    # results must be read before joining, or processes may block
+    # when sending large values
+    answers = [None] * num_workers
+    errors = []
+    for _ in xrange(num_workers):
+        worker, success, result = results.get()
+        if success:
+            answers[worker] = result
+        elif result is not None:
+            errors.append('Worker %d failed:\n%s' % (worker, result))
+
+    for process in processes:
+        process.join()
+
+    if errors:
+        raise RuntimeError('\n'.join(errors))
+
+    return answers
+
+
+def prefetch(function, items, size=2):
+    """
+    Generates function(item) for each of the given items, in order. The 
+    results are computed in a background thread, up to size items ahead of
+    the one being used, so that preparing the next items overlaps with the
+    work done with the current one (numpy releases the GIL in long operations,
+    such as matrix products). Exceptions raised by function are raised here.
+    
+    :param size: maximum number of results waiting to be used. If 0, 
+        results are computed in the calling thread when needed.
+    """
+    if size == 0:
+        for item in items:
+            yield function(item)
+        return
+    
+    results = Queue.Queue(size)
+    stopped = threading.Event()
+    
+    def put(result):
+        # give up if the consumer stopped, instead of blocking forever
+        while not stopped.is_set():
+            try:
+                results.put(result, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+    
+    def produce():
+        try:
+            for item in items:
+                if not put((True, function(item))):
+                    return
+        except:
+            put((False, sys.exc_info()))
+        else:
+            put((False, None))
+    
+    producer = threading.Thread(target=produce)
+    producer.daemon = True
+    producer.start()
+    
+    try:
+        while True:
+            success, result = results.get()
+            if success:
+                yield result
+            elif result is None:
+                break
+            else:
+                raise result[0], result[1], result[2]
+    finally:
+        stopped.set()
+        producer.join()
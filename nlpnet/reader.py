@@ -7,38 +7,77 @@ Base class for reading NLP tagging data.
 
 import os
 import logging
+import itertools
 import numpy as np
 from collections import Counter
 
 import attributes
 import metadata
 import config
-from word_dictionary import WordDictionary, NgramDictionary
+from word_dictionary import WordDictionary, NgramDictionary, count_ngrams, count_tokens
 from attributes import get_capitalizations, Prefix, Suffix
+from corpus import RaggedArray
 
 class TextReader(object):
     
-    def __init__(self, md=None, sentences=None, filename=None, variant=None):
+    def __init__(self, md=None, sentences=None, filename=None, variant=None, num_workers=1,
+                 block_size=None):
         """
         :param sentences: A list of lists of tokens.
         :param filename: Alternatively, the name of the file from where sentences 
             can be read. The file should have one sentence per line, with tokens
             separated by white spaces.
+        :param num_workers: number of processes counting words in the file
+            when creating a dictionary.
+        :param block_size: if given, only this number of sentences is read from
+            the file at first. The next ones are read by next_block().
         """
         self.variant = variant
+        self.filename = filename
+        self.num_workers = num_workers
         if sentences is not None:
             self.sentences = sentences
+        elif block_size:
+            self.blocks = read_sentence_blocks(filename, block_size)
+            self.sentences, self.bytes_read = next(self.blocks, ([], 0))
+            self.word_counts = count_tokens(self.sentences, variant)
+            self.tokens_read = sum(self.word_counts.itervalues())
+            self.file_size = os.path.getsize(filename)
+            # a dictionary must be created only from the text read so far
+            self.filename = None
         else:
-            self.sentences = []
-            with open(filename, 'rb') as f:
-                for line in f:
-                    sentence = unicode(line, 'utf-8').split()
-                    self.sentences.append(sentence)
+            # the file is only read when the sentences are needed, so that
+            # a dictionary can be created without loading the whole text
+            self._unread_file = filename
                     
         self.converter = None
         self.task = 'lm'
         self._set_metadata(md)
     
+    _sentences = None
+    _unread_file = None
+    
+    @property
+    def sentences(self):
+        """
+        The sentences of the reader. If they come from a file, it is read 
+        the first time they are accessed.
+        """
+        if self._sentences is None and self._unread_file is not None:
+            sentences = []
+            with open(self._unread_file, 'rb') as f:
+                for line in f:
+                    sentences.append(unicode(line, 'utf-8').split())
+            self._sentences = sentences
+            self._unread_file = None
+        
+        return self._sentences
+    
+    @sentences.setter
+    def sentences(self, sentences):
+        self._sentences = sentences
+        self._unread_file = None
+    
     def _set_metadata(self, md):
         if md is None:
             #metadata not provided = using global data_dir for files
@@ -52,11 +91,66 @@ class TextReader(object):
         sequences of tokens.
         """
         self.sentences.extend(text)
+        # the file no longer has all the text
+        self.filename = None
     
     def get_dictionaries(self, dict_size=None):
         self.load_or_create_dictionary(dict_size)
         self.load_or_create_tag_dict()
 
+    def next_block(self, dict_size=None, minimum_occurrences=2):
+        """
+        Reads the next block of sentences from the file, replacing the current
+        ones, and codifies them. Before that, types that occurred at least
+        minimum_occurrences times in all the text read so far are added to the
+        dictionary, up to dict_size types.
+        
+        Only available if the reader was created with a block_size.
+        
+        :return: the number of types added, or None if the whole file was read.
+        """
+        block = next(self.blocks, None)
+        if block is None:
+            return None
+        
+        sentences, num_bytes = block
+        block_counts = count_tokens(sentences, self.variant)
+        self.word_counts.update(block_counts)
+        self.tokens_read += sum(block_counts.itervalues())
+        self.bytes_read += num_bytes
+        old_size = len(self.word_dict)
+        self.word_dict.update_tokens(None, dict_size, minimum_occurrences, 
+                                     freqs=self.word_counts)
+        
+        self.sentences = sentences
+        self.codify_sentences()
+        
+        return len(self.word_dict) - old_size
+    
+    def get_word_counts(self):
+        """
+        Returns an array with the number of occurrences of each entry of the
+        dictionary in all the text read so far. Tokens without an entry are
+        counted as the rare token. Only available if the reader was created
+        with a block_size.
+        """
+        counts = np.zeros(len(self.word_dict), np.int64)
+        for word, count in self.word_counts.iteritems():
+            counts[self.word_dict[word]] += count
+        
+        return counts
+    
+    def estimate_num_tokens(self):
+        """
+        Estimates the number of tokens in the whole file read in blocks,
+        assuming that the text not read yet has as many tokens per byte as
+        the text read so far. Once the whole file is read, the count is exact.
+        """
+        if not self.bytes_read:
+            return self.tokens_read
+        
+        return long(self.tokens_read * (self.file_size / float(self.bytes_read)))
+    
     def load_or_create_dictionary(self, dict_size=None):
         """
         Try to load the vocabulary from the default location. If the vocabulary
@@ -101,8 +195,14 @@ class TextReader(object):
         logger = logging.getLogger("Logger")
         logger.info("Creating dictionary...")
         
-        self.word_dict = WordDictionary(self.sentences, dict_size,
-                                        minimum_occurrences, variant=self.variant)
+        if self.filename is not None:
+            # the file is read again in chunks, possibly by many processes 
+            self.word_dict = WordDictionary.init_from_file(self.filename, dict_size,
+                                                           minimum_occurrences, self.variant,
+                                                           self.num_workers)
+        else:
+            self.word_dict = WordDictionary(self.sentences, dict_size,
+                                            minimum_occurrences, variant=self.variant)
             
         logger.info("Done. Dictionary size is %d tokens" % self.word_dict.num_tokens)
     
@@ -209,6 +309,20 @@ class TextReader(object):
             add_affix_extractors(Suffix)
 
 
+def read_sentence_blocks(filename, block_size):
+    """
+    Generates lists of block_size sentences (the last one may be smaller) read
+    from a file with one sentence per line, with tokens separated by white spaces.
+    Each list comes in a tuple with the number of bytes it took in the file.
+    """
+    with open(filename, 'rb') as f:
+        while True:
+            lines = list(itertools.islice(f, block_size))
+            if not lines:
+                return
+            yield [unicode(line, 'utf-8').split() for line in lines], sum(map(len, lines))
+
+
 class TaggerReader(TextReader):
     """
     Abstract class extending TextReader with useful functions
@@ -252,9 +366,11 @@ class TaggerReader(TextReader):
         logger = logging.getLogger("Logger")
         logger.info("Creating dictionary...")
         
-        tokens = [token for sent in self.sentences for token, _ in sent]
-        self.word_dict = WordDictionary(tokens, dict_size, minimum_occurrences,
-                                        variant=self.variant)
+        # tokens are counted as they are read, without a list of all of them
+        tokens = ((token for token, _ in sent) for sent in self.sentences)
+        freqs = count_tokens(tokens, self.variant)
+        self.word_dict = WordDictionary(None, dict_size, minimum_occurrences,
+                                        variant=self.variant, freqs=freqs)
             
         logger.info("Done. Dictionary size is %d tokens" % self.word_dict.num_tokens)
 
@@ -272,22 +388,53 @@ class TaggerReader(TextReader):
         """
         Converts each token in each sequence into indices to their feature vectors
         in feature matrices. The previous sentences as text are not accessible anymore.
+        The codified sentences and their tags are stored in RaggedArrays.
         """
         new_sentences = []
-        self.tags = []
+        tags = []
         rare_tag_value = self.tag_dict.get(self.rare_tag)
         
         for sent in self.sentences:
-            sentence_tags = []
-            
             new_sent = self.converter.convert([token for token, tag in sent])
             sentence_tags = [self.tag_dict.get(tag, rare_tag_value) for token, tag in sent]
             new_sentences.append(new_sent)
-            self.tags.append(np.array(sentence_tags))
+            tags.append(sentence_tags)
         
-        self.sentences = new_sentences
+        self.sentences = RaggedArray.from_arrays(new_sentences)
+        self.tags = RaggedArray.from_arrays(tags)
         self.codified = True
-    
+
+    def save_codified(self, filename=None):
+        """
+        Saves the codified sentences and tags as numpy files, which can be
+        loaded by load_codified without reading the text again.
+
+        :param filename: prefix of the saved files. If None, the default
+            corpus filename for the task will be used.
+        """
+        if filename is None:
+            filename = self.md.paths[self.md.corpus]
+
+        self.sentences.save('%s-sentences' % filename)
+        self.tags.save('%s-tags' % filename)
+
+    def load_codified(self, filename=None, mmap_mode='r'):
+        """
+        Loads the codified sentences and tags saved with save_codified.
+
+        :param filename: prefix of the saved files. If None, the default
+            corpus filename for the task will be used.
+        :param mmap_mode: by default, the files are memory mapped, and
+            sentences are only read from disk when they are accessed.
+            Use None to load everything into memory.
+        """
+        if filename is None:
+            filename = self.md.paths[self.md.corpus]
+
+        self.sentences = RaggedArray.load('%s-sentences' % filename, mmap_mode)
+        self.tags = RaggedArray.load('%s-tags' % filename, mmap_mode)
+        self.codified = True
+
     def get_word_counter(self):
         """
         Returns a Counter object with word type occurrences.
@@ -348,13 +495,16 @@ class TweetReader(TextReader):
     polarity_field = 2
     text_field = 3
 
-    def __init__(self, md=None, ngrams=1, filename=None, variant=None):
+    def __init__(self, md=None, ngrams=1, filename=None, variant=None, max_candidates=None):
         """
 	:param ngrams: the lenght of ngrams to consider
         :param filename: the name of the file containing tweets. The file should have one tweet per line.
 	:param variant: whether to use native, or SENNA or Polyglot conventions
+        :param max_candidates: maximum number of distinct ngrams kept in memory
+            while creating the dictionary (None for no limit)
         """
 	self.ngrams = ngrams
+        self.max_candidates = max_candidates
         self.variant = variant
         self.sentences = []
         self.polarities = []
@@ -374,25 +524,82 @@ class TweetReader(TextReader):
         self.task = 'sslm'
         self._set_metadata(md)
     
-    def generate_dictionary(self, dict_size=None, minimum_occurrences=None):
+    def generate_dictionary(self, dict_size=None, minimum_occurrences=None, exact=True):
         """
         Generates a dictionary of all ngrams from the given sentences.
         
         :param dict_size: Max number of tokens to be included in the dictionary.
         :param minimum_occurrences: Minimum number of times that a token must
             appear in the text in order to be included in the dictionary. 
+        :param exact: if the number of ngrams is limited by max_candidates, 
+            count the selected ones exactly in a second pass over the text.
         """
         logger = logging.getLogger("Logger")
         logger.info("Creating dictionary...")
         
-        # unigrams
-        ngrams = [[token for sent in self.sentences for token in sent]]
-        # multigrams
-	for n in xrange(2, self.ngrams + 1):
-            ngrams.append([])
-	    for sent in self.sentences:
-	    	for i in xrange(len(sent) + 1 - n):
-		    ngrams[n-1].append(' '.join(sent[i:i+n]))
-        self.word_dict = NgramDictionary(ngrams, dict_size, minimum_occurrences, variant=self.variant)
+        variant = self.variant.lower() if self.variant else None
+        freqs = count_ngrams(self.sentences, self.ngrams, self.max_candidates,
+                             exact, variant)
+        self.word_dict = NgramDictionary(None, dict_size, minimum_occurrences, 
+                                         variant=self.variant, freqs=freqs)
 
         logger.info("Done. Dictionary size is %d tokens" % self.word_dict.num_tokens)
+
+
+def codified_dependencies(md):
+    """
+    Returns the paths of the data files used to codify a corpus for the task
+    described by the given metadata: the vocabulary, the tag dictionary and
+    the files read by the extractors of additional features.
+    """
+    paths = md.paths
+    files = [paths['vocabulary'], paths.get('%s_tag_dict' % md.task)]
+    if md.use_suffix:
+        files.append(paths['suffixes'])
+    if md.use_prefix:
+        files.append(paths['prefixes'])
+    if md.use_pos:
+        files.append(paths.get('pos_tag_dict'))
+    if md.use_chunk:
+        files.append(paths.get('chunk_tag_dict'))
+    if md.use_gazetteer:
+        files.append(paths[md.gazetteer])
+    
+    return files
+
+def load_or_codify(cache, create_reader, md, filename, *options):
+    """
+    Returns a reader with the codified contents of the given file. If it was
+    codified before with the same data files, metadata and options, it is
+    loaded from the cache without reading the file. Otherwise, the file is
+    read, codified and stored in the cache.
+    
+    :param cache: a CorpusCache
+    :param create_reader: function taking a filename (or None, for no data)
+        and returning a TaggerReader with its converter already created.
+    :param md: the Metadata for the task
+    :param filename: the file with the corpus
+    :param options: anything else that changes the codified corpus
+    """
+    logger = logging.getLogger("Logger")
+    flags = sorted((name, value) for name, value in md.__dict__.iteritems()
+                   if name.startswith('use_'))
+    
+    def get_key():
+        files = [filename] + codified_dependencies(md)
+        return cache.key(files, md.task, flags, *options)
+    
+    key = get_key()
+    if key in cache:
+        logger.info("Loading codified corpus from the cache...")
+        text_reader = create_reader(None)
+        cache.load(key, text_reader)
+        return text_reader
+    
+    text_reader = create_reader(filename)
+    text_reader.codify_sentences()
+    
+    # reading the text may have created the dictionaries
+    cache.store(get_key(), text_reader)
+    
+    return text_reader
@@ -14,8 +14,9 @@ from .. import config
 from .. import read_data
 from .. import attributes
 from .. import utils
-from ..word_dictionary import WordDictionary
+from ..word_dictionary import WordDictionary, count_tokens
 from ..reader import TaggerReader
+from ..corpus import RaggedArray
 
 class SRLReader(TaggerReader):
     
@@ -91,8 +92,9 @@ class SRLReader(TaggerReader):
         logger = logging.getLogger("Logger")
         logger.info("Creating dictionary...")
         
-        all_tokens = [tokens for sent in self.sentences for tokens, _ in sent]
-        self.word_dict = WordDictionary(all_tokens, dict_size, minimum_occurrences)
+        all_tokens = (tokens for sent in self.sentences for tokens, _ in sent)
+        self.word_dict = WordDictionary(None, dict_size, minimum_occurrences,
+                                        freqs=count_tokens(all_tokens))
             
         logger.info("Done. Dictionary size is %d tokens" % self.word_dict.num_tokens)
     
@@ -125,43 +127,54 @@ class SRLReader(TaggerReader):
             
             self.predicates.append(np.array(sentence_preds))
     
-    def create_converter(self, metadata):
+    def create_converter(self, metadata=None):
         """
         This function overrides the TextReader's one in order to deal with Token
         objects instead of raw strings.
+
+        The extractors are also kept in `feature_extractors` as (name, function)
+        tuples, in the same order as the converter columns. Extractors with the
+        same name yield the same column for readers sharing the vocabulary.
         """
+        if metadata is None:
+            metadata = self.md
+
         self.converter = attributes.TokenConverter()
-        
+        self.feature_extractors = []
+
         if metadata.use_lemma:
-            # look up word lemmas 
+            # look up word lemmas
             word_lookup = lambda tokens: [self.word_dict.get(t.lemma) for t in tokens]
+            self.feature_extractors.append(('lemma', word_lookup))
         else:
             # look up the word itself
             word_lookup = lambda tokens: [self.word_dict.get(t.word) for t in tokens]
-             
-        self.converter.add_extractor(word_lookup)
-        
+            self.feature_extractors.append(('word', word_lookup))
+
         if metadata.use_caps:
             caps_lookup = lambda tokens: [attributes.get_capitalization(t.word) for t in tokens]
-            self.converter.add_extractor(caps_lookup)
-        
+            self.feature_extractors.append(('caps', caps_lookup))
+
         if metadata.use_pos:
             with open(config.FILES['pos_tag_dict']) as f:
                 pos_dict = cPickle.load(f)
-                
+
             pos_def_dict = defaultdict(lambda: pos_dict['other'])
             pos_def_dict.update(pos_dict)
             pos_lookup = lambda tokens: [pos_def_dict[t.pos] for t in tokens]
-            self.converter.add_extractor(pos_lookup)
-        
+            self.feature_extractors.append(('pos', pos_lookup))
+
         if metadata.use_chunk:
             with open(config.FILES['chunk_tag_dict']) as f:
                 chunk_dict = cPickle.load(f)
-            
+
             chunk_def_dict = defaultdict(lambda: chunk_dict['O'])
             chunk_def_dict.update(chunk_dict)
             chunk_lookup = lambda tokens: [chunk_def_dict[t.chunk] for t in tokens]
-            self.converter.add_extractor(chunk_lookup)
+            self.feature_extractors.append(('chunk', chunk_lookup))
+
+        for _, extractor in self.feature_extractors:
+            self.converter.add_extractor(extractor)
     
     def generate_tag_dict(self):
         """
@@ -213,7 +226,10 @@ class SRLReader(TaggerReader):
             new_sentences.append(np.array(new_sent))
             self.tags.append(sentence_tags)
         
-        self.sentences = new_sentences
+        self.sentences = RaggedArray.from_arrays(new_sentences)
+        self.predicates = RaggedArray.from_arrays(self.predicates)
+        if self.task == 'srl_predicates':
+            self.tags = RaggedArray.from_arrays(self.tags)
         self.codified = True
     
     def codify_sentences(self):
@@ -222,6 +238,8 @@ class SRLReader(TaggerReader):
         in feature matrices. The previous sentences as text are not accessible anymore.
         Tags are also encoded. This function takes care of the case of classifying 
         pre-delimited arguments.
+        Sentences and predicates (and tags, for predicate detection) are stored
+        in RaggedArrays.
         """
         self._codify_sentences()
         self.arg_limits = []
@@ -267,6 +285,72 @@ class SRLReader(TaggerReader):
                 self.tags[i] = new_sent_tags
                      
     
+    def save_codified(self, filename=None):
+        """
+        Saves the codified sentences, predicates and tags as numpy files,
+        which can be loaded by load_codified without reading the text again.
+        Tags and argument limits of each proposition are saved one after the
+        other, as the number of propositions in each sentence is given by its
+        predicates. The tag dictionary is also pickled, since tag conversions
+        may have changed it and mapped more than one tag to the same code.
+
+        :param filename: prefix of the saved files. If None, the default
+            corpus filename for the task will be used.
+        """
+        if filename is None:
+            filename = self.md.paths[self.md.corpus]
+
+        self.sentences.save('%s-sentences' % filename)
+        self.predicates.save('%s-predicates' % filename)
+        with open('%s-tag-dict.pickle' % filename, 'wb') as f:
+            cPickle.dump(self.tag_dict, f, 2)
+
+        if self.task == 'srl_predicates':
+            self.tags.save('%s-tags' % filename)
+            return
+
+        prop_tags = [tags for sent_tags in self.tags for tags in sent_tags]
+        RaggedArray.from_arrays(prop_tags).save('%s-tags' % filename)
+        if self.task == 'srl_classify':
+            prop_args = [args for sent_args in self.arg_limits for args in sent_args]
+            RaggedArray.from_arrays(prop_args).save('%s-arg-limits' % filename)
+
+    def load_codified(self, filename=None, mmap_mode='r'):
+        """
+        Loads the codified sentences, predicates and tags saved with
+        save_codified, as well as the tag dictionary.
+
+        :param filename: prefix of the saved files. If None, the default
+            corpus filename for the task will be used.
+        :param mmap_mode: by default, the files are memory mapped, and
+            sentences are only read from disk when they are accessed.
+            Use None to load everything into memory.
+        """
+        if filename is None:
+            filename = self.md.paths[self.md.corpus]
+
+        self.sentences = RaggedArray.load('%s-sentences' % filename, mmap_mode)
+        self.predicates = RaggedArray.load('%s-predicates' % filename, mmap_mode)
+        with open('%s-tag-dict.pickle' % filename, 'rb') as f:
+            self.tag_dict = cPickle.load(f)
+        self.arg_limits = []
+        self.codified = True
+
+        if self.task == 'srl_predicates':
+            self.tags = RaggedArray.load('%s-tags' % filename, mmap_mode)
+            return
+
+        # regroup the propositions of each sentence
+        prop_offsets = np.zeros(len(self.predicates) + 1, np.int)
+        np.cumsum(self.predicates.lengths, out=prop_offsets[1:])
+        bounds = zip(prop_offsets[:-1], prop_offsets[1:])
+
+        prop_tags = RaggedArray.load('%s-tags' % filename, mmap_mode)
+        self.tags = [list(prop_tags[start:end]) for start, end in bounds]
+        if self.task == 'srl_classify':
+            prop_args = RaggedArray.load('%s-arg-limits' % filename, mmap_mode)
+            self.arg_limits = [list(prop_args[start:end]) for start, end in bounds]
+
     def convert_tags(self, scheme, update_tag_dict=True, only_boundaries=False):
         """
         Replaces each word label with an IOB or IOBES version, appending a prefix
@@ -16,7 +16,7 @@ from metadata import Metadata
 from pos.pos_reader import POSReader
 from srl.srl_reader import SRLReader
 from ner.ner_reader import NerReader, NerTagReader
-from network import Network, ConvolutionalNetwork
+from network import Network, ConvolutionalNetwork, LanguageModel, SentimentModel
 
 def load_network(md):
     """
@@ -28,6 +28,10 @@ def load_network(md):
     logger.info('Loading network')
     if is_srl:
         net_class = ConvolutionalNetwork
+    elif md.task == 'lm':
+        net_class = LanguageModel
+    elif md.task == 'sslm':
+        net_class = SentimentModel
     else:
         net_class = Network
     nn = net_class.load_from_file(md.paths[md.network])
@@ -137,6 +141,36 @@ def _group_arguments(tokens, predicate_positions, boundaries, labels):
     return arg_structs
         
 
+def _split_iob_tags(tags):
+    """
+    Splits a sequence of IOB tags (e.g. B-A0, I-A0, O) into the IOBES 
+    block delimiters and the list of argument labels used by _group_arguments.
+    An I tag not continuing a block of the same label starts a new one.
+    """
+    boundaries = []
+    labels = []
+    last_label = None
+    
+    for tag, next_tag in izip(tags, tags[1:] + [None]):
+        if tag == 'O':
+            boundaries.append('O')
+            last_label = None
+            continue
+        
+        label = tag[2:]
+        block_continues = next_tag == 'I-%s' % label
+        
+        if tag[0] == 'B' or label != last_label:
+            boundaries.append('B' if block_continues else 'S')
+            labels.append(label)
+        else:
+            boundaries.append('I' if block_continues else 'E')
+        
+        last_label = label
+    
+    return boundaries, labels
+
+
 class SRLAnnotatedSentence(object):
     """
     Class storing a sentence with annotated semantic roles.
@@ -185,28 +219,83 @@ class SRLTagger(Tagger):
     """
     An SRLTagger loads the models and performs SRL on text.
     
-    It works on three stages: predicate identification, argument detection and
-    argument classification.    
+    In the default mode ('2steps'), it works on three stages: predicate 
+    identification, argument detection and argument classification.
+    In '1step' mode, after predicate identification, a single network 
+    trained with IOB tags detects and classifies arguments together.
     """
     
+    def __init__(self, tokenizer=None, mode='2steps'):
+        """
+        Creates an SRL tagger and loads its models.
+        
+        :param mode: either '2steps' (separate networks for argument
+            detection and classification) or '1step' (a single joint network).
+        """
+        if mode not in ('1step', '2steps'):
+            raise ValueError("Unknown SRL mode: %s" % mode)
+        
+        self.mode = mode
+        super(SRLTagger, self).__init__(tokenizer)
+    
     def _load_data(self):
         """Loads data for SRL"""
-        # load boundary identification network and reader 
-        md_boundary = Metadata.load_from_file('srl_boundary')
-        self.boundary_nn = load_network(md_boundary)
-        self.boundary_reader = create_reader(md_boundary)
-        self.boundary_itd = self.boundary_reader.get_inverse_tag_dictionary()
-        
-        # same for arg classification
-        md_classify = Metadata.load_from_file('srl_classify')
-        self.classify_nn = load_network(md_classify)
-        self.classify_reader = create_reader(md_classify)
-        self.classify_itd = self.classify_reader.get_inverse_tag_dictionary()
-        
         # predicate detection
         md_pred = Metadata.load_from_file('srl_predicates')
         self.pred_nn = load_network(md_pred)
         self.pred_reader = create_reader(md_pred)
+        
+        if self.mode == '1step':
+            # argument identification and classification together
+            md_srl = Metadata.load_from_file('srl')
+            self.srl_nn = load_network(md_srl)
+            self.srl_reader = create_reader(md_srl)
+            self.srl_itd = self.srl_reader.get_inverse_tag_dictionary()
+            readers = (self.pred_reader, self.srl_reader)
+        
+        else:
+            # load boundary identification network and reader 
+            md_boundary = Metadata.load_from_file('srl_boundary')
+            self.boundary_nn = load_network(md_boundary)
+            self.boundary_reader = create_reader(md_boundary)
+            self.boundary_itd = self.boundary_reader.get_inverse_tag_dictionary()
+            
+            # same for arg classification
+            md_classify = Metadata.load_from_file('srl_classify')
+            self.classify_nn = load_network(md_classify)
+            self.classify_reader = create_reader(md_classify)
+            self.classify_itd = self.classify_reader.get_inverse_tag_dictionary()
+            readers = (self.pred_reader, self.boundary_reader, self.classify_reader)
+        
+        # the networks share the vocabulary, so each feature column
+        # (word indices, capitalization, POS, chunk) is extracted only once
+        # and each network picks the columns it was trained with
+        self.extractors = {}
+        self.network_features = []
+        for reader in readers:
+            for name, extractor in reader.feature_extractors:
+                self.extractors.setdefault(name, extractor)
+            self.network_features.append([name for name, _ in reader.feature_extractors])
+    
+    def _convert_sentences(self, sentences):
+        """
+        Converts sentences into the input of each of the networks.
+        
+        :param sentences: a list of lists of attribute.Token elements
+        :returns: a list with the inputs for each network, in the order 
+            they were loaded (predicates first). The inputs of a network
+            are a list with a 2-dim array for each sentence.
+        """
+        inputs = [[] for _ in self.network_features]
+        
+        for tokens in sentences:
+            columns = dict((name, extractor(tokens)) 
+                           for name, extractor in self.extractors.iteritems())
+            
+            for network_inputs, names in izip(inputs, self.network_features):
+                network_inputs.append(np.array(zip(*[columns[name] for name in names])))
+        
+        return inputs
     
     def find_predicates(self, tokens):
         """
@@ -225,15 +314,11 @@ class SRLTagger(Tagger):
         
         :param text: unicode or str encoded in utf-8.
         :param no_repeats: whether to prevent repeated argument labels
+            (only in '2steps' mode)
         :returns: a list of SRLAnnotatedSentence objects
         """
         tokens = utils.tokenize(text, clean=False)
-        result = []
-        for sent in tokens:
-            tagged = self.tag_tokens(sent)
-            result.append(tagged)
-        
-        return result
+        return self.tag_sentences(tokens, no_repeats)
 
     def tag_tokens(self, tokens, no_repeats=False):
         """
@@ -241,33 +326,101 @@ class SRLTagger(Tagger):
         
         :param tokens: a list of tokens (as strings)
         :param no_repeats: whether to prevent repeated argument labels
-        :returns: a list of lists (one list for each sentence). Sentences have tuples 
-            (all_tokens, predicate, arg_structure), where arg_structure is a dictionary 
-            mapping argument labels to the words it includes.
+            (only in '2steps' mode)
+        :returns: an SRLAnnotatedSentence object
+        """
+        return self.tag_sentences([tokens], no_repeats)[0]
+    
+    def tag_sentences(self, sentences, no_repeats=False):
+        """
+        Runs the SRL process on a batch of sentences. Tokens are converted
+        only once, and each step processes all sentences together.
+        
+        :param sentences: a list of lists of tokens (as strings)
+        :param no_repeats: whether to prevent repeated argument labels
+            (only in '2steps' mode)
+        :returns: a list of SRLAnnotatedSentence objects
         """
-        tokens_obj = [attributes.Token(utils.clean_text(t, False)) for t in tokens]
-        converted_bound = self.boundary_reader.converter.convert(tokens_obj)
-        converted_class = self.classify_reader.converter.convert(tokens_obj)
+        if not sentences:
+            return []
+        
+        tokens_obj = [[attributes.Token(utils.clean_text(t, False)) for t in tokens]
+                      for tokens in sentences]
+        inputs = self._convert_sentences(tokens_obj)
+        
+        # predicate detection
+        answers = self.pred_nn.tag_sentences(inputs[0])
+        pred_positions = [np.array(answer).nonzero()[0] for answer in answers]
+        
+        if self.mode == '1step':
+            boundaries, arguments = self._tag_1step(inputs[1], pred_positions)
+        else:
+            boundaries, arguments = self._tag_2steps(inputs[1], inputs[2], 
+                                                     pred_positions, no_repeats)
+        
+        result = []
+        for tokens, sent_preds, sent_boundaries, sent_arguments in izip(sentences, 
+                                                                        pred_positions,
+                                                                        boundaries,
+                                                                        arguments):
+            structures = _group_arguments(tokens, sent_preds, sent_boundaries, sent_arguments)
+            result.append(SRLAnnotatedSentence(tokens, structures))
         
-        pred_positions = self.find_predicates(tokens_obj)
+        return result
+    
+    def _tag_2steps(self, boundary_sents, classify_sents, pred_positions, no_repeats):
+        """
+        Detects argument boundaries and then classifies the arguments found.
         
-        # first, argument boundary detection
-        # the answer includes all predicates
-        answers = self.boundary_nn.tag_sentence(converted_bound, pred_positions)
-        boundaries = [[self.boundary_itd[x] for x in pred_answer] 
-                      for pred_answer in answers]
-        arg_limits = [utils.boundaries_to_arg_limits(pred_boundaries) 
-                      for pred_boundaries in boundaries]
+        :returns: a tuple (boundaries, arguments). Each one has a list for
+            each sentence, which in turn has a list for each predicate with 
+            the IOBES block tags or the argument labels, respectively.
+        """
+        # argument boundary detection
+        # the answer for each sentence includes all its predicates
+        answers = self.boundary_nn.tag_sentences(boundary_sents, pred_positions)
+        boundaries = [[[self.boundary_itd[x] for x in pred_answer] 
+                       for pred_answer in sent_answer]
+                      for sent_answer in answers]
+        arg_limits = [[utils.boundaries_to_arg_limits(pred_boundaries) 
+                       for pred_boundaries in sent_boundaries]
+                      for sent_boundaries in boundaries]
         
         # now, argument classification
-        answers = self.classify_nn.tag_sentence(converted_class, 
-                                                pred_positions, arg_limits,
-                                                allow_repeats=not no_repeats)
-        arguments = [[self.classify_itd[x] for x in pred_answer] 
-                     for pred_answer in answers]
-        
-        structures = _group_arguments(tokens, pred_positions, boundaries, arguments)
-        return SRLAnnotatedSentence(tokens, structures)
+        answers = self.classify_nn.tag_sentences(classify_sents, pred_positions, 
+                                                 arg_limits, 
+                                                 allow_repeats=not no_repeats)
+        arguments = [[[self.classify_itd[x] for x in pred_answer] 
+                      for pred_answer in sent_answer]
+                     for sent_answer in answers]
+        
+        return boundaries, arguments
+    
+    def _tag_1step(self, srl_sents, pred_positions):
+        """
+        Detects and classifies arguments with the joint network, splitting 
+        its IOB answers into block tags and argument labels.
+        
+        :returns: a tuple (boundaries, arguments), like _tag_2steps.
+        """
+        answers = self.srl_nn.tag_sentences(srl_sents, pred_positions)
+        boundaries = []
+        arguments = []
+        
+        for sent_answer in answers:
+            sent_boundaries = []
+            sent_arguments = []
+            
+            for pred_answer in sent_answer:
+                pred_boundaries, pred_arguments = _split_iob_tags([self.srl_itd[x] 
+                                                                   for x in pred_answer])
+                sent_boundaries.append(pred_boundaries)
+                sent_arguments.append(pred_arguments)
+            
+            boundaries.append(sent_boundaries)
+            arguments.append(sent_arguments)
+        
+        return boundaries, arguments
         
 
 class POSTagger(Tagger):
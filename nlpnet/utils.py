@@ -13,6 +13,7 @@ import numpy as np
 from nltk.tokenize.regexp import RegexpTokenizer
 import config
 import attributes
+import checkpoint
 
 
 # these variables appear at module level for faster access and to avoid
@@ -420,8 +421,11 @@ def set_logger(level):
     logger.setLevel(level)
 
 def load_features_from_file(features_file):
-    """Reads a file with features written as binary data."""
-    return np.load(features_file)
+    """
+    Reads a file with features written as binary data, applying the changes
+    saved in delta checkpoints, if any.
+    """
+    return checkpoint.load_table(features_file)
 
 def save_features_to_file(table, features_file):
     """Saves a feature table to a given file, writing binary data."""
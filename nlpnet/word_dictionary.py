@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 
+import heapq
 import itertools
+import multiprocessing
 from collections import Counter, OrderedDict as OD
 
 import re
@@ -22,7 +24,8 @@ class WordDictionary(dict):
     padding_right = 'PADDING'
     rare = 'UNKNOWN'
     
-    def __init__(self, tokens, size=None, minimum_occurrences=None, wordlist=None, variant=None):
+    def __init__(self, tokens, size=None, minimum_occurrences=None, wordlist=None, variant=None,
+                 freqs=None):
         """
         Fills a dictionary (to be used for indexing) with the most
         common words in the given text.
@@ -36,6 +39,7 @@ class WordDictionary(dict):
         :param wordlist: Use this list of words to build the dictionary. Overrides tokens
             if not None and ignores maximum size.
         :param variant: either 'polyglot' or 'senna' conventions, i.e. keep upper case, use different padding tokens.
+        :param freqs: a Counter providing a token count. Overrides tokens if not None.
         """
         self.variant = variant
         if variant:
@@ -49,16 +53,25 @@ class WordDictionary(dict):
             # work with the supplied tokens. extract frequencies.
             
             # gets frequency count
-            c = self._get_frequency_count(tokens)
+            if freqs is None:
+                c = self._get_frequency_count(tokens)
+            else:
+                c = freqs
         
             if minimum_occurrences is None:
                 minimum_occurrences = 1
             
-            words = [key for key, number in c.most_common() 
-                     if number >= minimum_occurrences]
-            
-            if size is not None and size < len(words):
-                words = words[:size]
+            # most frequent first. ties are broken alphabetically, so that the 
+            # order doesn't depend on how tokens were counted
+            candidates = ((key, number) for key, number in c.iteritems()
+                          if number >= minimum_occurrences)
+            sort_key = lambda item: (-item[1], item[0])
+            if size is None:
+                words = sorted(candidates, key=sort_key)
+            else:
+                # a heap is faster when only the top size are needed
+                words = heapq.nsmallest(size, candidates, key=sort_key)
+            words = [key for key, _ in words]
         
         else:
             # using ordered dict as an ordered set
@@ -99,6 +112,19 @@ class WordDictionary(dict):
         """
         return cls(None, wordlist=wordlist)
     
+    @classmethod
+    def init_from_file(cls, filename, size=None, minimum_occurrences=None, variant=None,
+                       num_workers=1):
+        """
+        Initializes the WordDictionary instance with the most common words in 
+        a file with one sentence per line and tokens separated by white spaces. 
+        The file is read in chunks, so it doesn't need to fit in memory.
+        
+        :param num_workers: number of processes counting words at the same time.
+        """
+        freqs = count_file_tokens(filename, num_workers, variant)
+        return cls(None, size, minimum_occurrences, variant=variant, freqs=freqs)
+    
     @classmethod
     def init_empty(cls):
         """
@@ -285,7 +311,8 @@ class NgramDictionary(WordDictionary):
     Class to store ngrams and their corresponding indices in
     the network lookup table.
     """
-    def __init__(self, ngrams, size=None, minimum_occurrences=None, variant=None):
+    def __init__(self, ngrams, size=None, minimum_occurrences=None, variant=None,
+                 freqs=None):
         """
         Fills a dictionary (to be used for indexing) with the most
         common ngrams.
@@ -296,6 +323,128 @@ class NgramDictionary(WordDictionary):
         :param minimum_occurrences: The minimum number of occurrences an ngram must 
             have in order to be included.
         :param variant: either 'polyglot' or 'senna' conventions, i.e. keep upper case, use different padding tokens.
+        :param freqs: a Counter providing an ngram count (see count_ngrams). 
+            Overrides ngrams if not None.
         """
         WordDictionary.__init__(self, ngrams, size, minimum_occurrences,
-                                 variant=variant)
+                                 variant=variant, freqs=freqs)
+
+
+def iter_ngrams(sentences, max_size, variant=None):
+    """
+    Generates the ngrams of all lengths up to max_size in the given sentences, 
+    one at a time, as strings with tokens separated by whitespace.
+    They are lower cased except when variant is 'polyglot'.
+    """
+    for sent in sentences:
+        if variant != 'polyglot':
+            sent = [token.lower() for token in sent]
+        for n in xrange(1, max_size + 1):
+            for i in xrange(len(sent) + 1 - n):
+                yield ' '.join(sent[i:i + n])
+
+
+def count_ngrams(sentences, max_size, max_candidates=None, exact=True, variant=None):
+    """
+    Counts the ngrams in the given sentences without building a list of them.
+    
+    :param max_candidates: If not None, the maximum number of distinct ngrams
+        kept while counting. Whenever it is exceeded, only the most frequent
+        half is kept, so the least frequent ngrams may be undercounted or 
+        missed (they are unlikely to be chosen for a dictionary anyway).
+    :param exact: If True and some ngrams were dropped, the remaining ones are
+        counted again in a second pass over the sentences, so that their 
+        counts are exact.
+    :return: a Counter of ngrams.
+    """
+    c = Counter()
+    pruned = False
+    for ngram in iter_ngrams(sentences, max_size, variant):
+        c[ngram] += 1
+        if max_candidates is not None and len(c) > max_candidates:
+            _prune(c, max_candidates / 2)
+            pruned = True
+    
+    if pruned and exact:
+        candidates = c
+        c = Counter()
+        for ngram in iter_ngrams(sentences, max_size, variant):
+            if ngram in candidates:
+                c[ngram] += 1
+    
+    return c
+
+
+def _prune(counter, size):
+    """
+    Removes the least frequent entries of the counter, leaving at most size.
+    Entries with the same count are either all kept or all removed.
+    """
+    counts = sorted(counter.itervalues(), reverse=True)
+    threshold = counts[size]
+    
+    for key in [key for key, count in counter.iteritems() if count <= threshold]:
+        del counter[key]
+
+
+def count_tokens(sentences, variant=None):
+    """
+    Counts the tokens in a list of lists of tokens. They are lower cased
+    except when variant is 'polyglot'.
+    """
+    if variant and variant.lower() == 'polyglot':
+        return Counter(token for sent in sentences for token in sent)
+    else:
+        return Counter(token.lower() for sent in sentences for token in sent)
+
+
+def _count_lines(args):
+    """
+    Counts the tokens in a list of lines. Used by the processes started by
+    count_file_tokens.
+    """
+    lines, variant = args
+    if variant == 'polyglot':
+        return Counter(token for line in lines for token in unicode(line, 'utf-8').split())
+    else:
+        return Counter(token.lower() for line in lines 
+                       for token in unicode(line, 'utf-8').split())
+
+
+def count_file_tokens(filename, num_workers=1, variant=None, chunk_size=100000):
+    """
+    Counts the tokens in a file with one sentence per line, reading a chunk of
+    lines at a time. Tokens are lower cased except when variant is 'polyglot'.
+    
+    :param num_workers: number of processes counting chunks at the same time.
+        The counts of each chunk are added up in the calling process.
+    :param chunk_size: number of lines in each chunk
+    :return: a Counter of tokens
+    """
+    if variant:
+        variant = variant.lower()
+    
+    c = Counter()
+    with open(filename, 'rb') as f:
+        chunks = iter(lambda: list(itertools.islice(f, chunk_size)), [])
+        
+        if num_workers == 1:
+            for chunk in chunks:
+                c.update(_count_lines((chunk, variant)))
+            return c
+        
+        pool = multiprocessing.Pool(num_workers)
+        try:
+            # one chunk for each process at a time, so that only a bounded
+            # part of the file is in memory
+            while True:
+                batch = [(chunk, variant) for chunk in itertools.islice(chunks, num_workers)]
+                if not batch:
+                    break
+                for partial in pool.map(_count_lines, batch):
+                    c.update(partial)
+        finally:
+            pool.close()
+            pool.join()
+    
+    return c
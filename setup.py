@@ -9,6 +9,13 @@ except ImportError:
     print "copy from www.numpy.org and install it"
     sys.exit(1)
 
+try:
+    from Cython.Build import cythonize
+except ImportError:
+    print "You don't seem to have Cython installed. Please get a"
+    print "copy from www.cython.org and install it"
+    sys.exit(1)
+
 def readme():
     with open('README.rst') as f:
         text = f.read()
@@ -18,11 +25,13 @@ setup(
       name = 'nlpnet',
       description = 'Neural networks for NLP tasks',
       packages = ['nlpnet', 'nlpnet.pos', 'nlpnet.srl', 'nlpnet.ner'],
-      ext_modules = [Extension("nlpnet.network", 
-                               ["nlpnet/network.c"],
-                               include_dirs=['.', np.get_include()]
-                               )
-                     ],
+      # the C file is always generated again from the Cython sources, since 
+      # file times don't tell whether a C file that came with them is older
+      ext_modules = cythonize([Extension("nlpnet.network", 
+                                         ["nlpnet/network.pyx"],
+                                         include_dirs=['.', np.get_include()]
+                                         )
+                               ], force=True),
       scripts = ['bin/nlpnet-tag.py',
                  'bin/nlpnet-train.py',
                  'bin/nlpnet-test.py',